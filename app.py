@@ -1,41 +1,1763 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, make_response, stream_template, stream_with_context
+from flask import before_render_template, template_rendered
 from flask_pymongo import PyMongo
-from werkzeug.security import generate_password_hash, check_password_hash
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import hashlib
 import os
 from bson.objectid import ObjectId
+from itertools import islice
 from datetime import datetime, date, timedelta
+
+try:
+    import openpyxl  # Opcional: solo se necesita para cargar archivos .xlsx
+except ImportError:
+    openpyxl = None
 from config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import wraps
+import cache_respuestas
 import calendar
+import click
+import csv
+import io
+import json
+import metricas
+import passwords
+import re
+import secrets
+import threading
+import time
+import unicodedata
 
 app = Flask(__name__)
 app.config.from_object(Config)
 app.secret_key = app.config['SECRET_KEY']
 
-# Inicializar PyMongo
-mongo = PyMongo(app)
+# Inicializar PyMongo (con el listener que mide los comandos de cada petición)
+mongo = PyMongo(app, event_listeners=[metricas.MonitorMongo()])
+
+# Caché de respuestas de las vistas del tutor (None si está desactivada)
+respuestas_cache = cache_respuestas.crear_backend(app.config)
 
 _initialized = False
 
+# --- Métricas ---
+
+# Histogramas por endpoint; se exponen en /metrics (formato de Prometheus)
+METRICA_PETICION = metricas.Histograma(
+    'edutrack_peticion_segundos', 'Duración total de la petición.',
+    metricas.BUCKETS_SEGUNDOS, ('endpoint',))
+METRICA_MONGO_COMANDOS = metricas.Histograma(
+    'edutrack_mongo_comandos', 'Comandos enviados a Mongo por petición.',
+    metricas.BUCKETS_CONTEO, ('endpoint',))
+METRICA_MONGO_SEGUNDOS = metricas.Histograma(
+    'edutrack_mongo_segundos', 'Tiempo total en Mongo por petición.',
+    metricas.BUCKETS_SEGUNDOS, ('endpoint',))
+METRICA_MONGO_DOCUMENTOS = metricas.Histograma(
+    'edutrack_mongo_documentos', 'Documentos devueltos por Mongo por petición.',
+    metricas.BUCKETS_DOCUMENTOS, ('endpoint',))
+METRICA_RENDER_SEGUNDOS = metricas.Histograma(
+    'edutrack_render_segundos', 'Tiempo de renderizado de plantillas Jinja por petición.',
+    metricas.BUCKETS_SEGUNDOS, ('endpoint',))
+METRICA_PETICIONES = metricas.Contador(
+    'edutrack_peticiones_total', 'Peticiones atendidas por endpoint y código de estado.',
+    ('endpoint', 'estado'))
+METRICA_CACHE_RESPUESTAS = metricas.Contador(
+    'edutrack_cache_respuestas_total', 'Aciertos y fallos de la caché de respuestas del tutor.',
+    ('endpoint', 'resultado'))
+# Contadores de la cola de hashes de contraseñas (los lleva passwords.metricas)
+METRICAS_PASSWORDS = [
+    metricas.Contador(f'edutrack_passwords_{nombre}_total', ayuda,
+                      leer=lambda campo=campo: {(): passwords.metricas()[campo]})
+    for nombre, campo, ayuda in (
+        ('completados', 'completados', 'Hashes de contraseñas terminados.'),
+        ('rechazados', 'rechazados', 'Hashes rechazados por cola llena (respuesta 503).'),
+        ('segundos', 'segundos_total', 'Segundos acumulados de espera y cálculo de hashes.'))]
+METRICAS = [METRICA_PETICION, METRICA_MONGO_COMANDOS, METRICA_MONGO_SEGUNDOS,
+            METRICA_MONGO_DOCUMENTOS, METRICA_RENDER_SEGUNDOS, METRICA_PETICIONES,
+            METRICA_CACHE_RESPUESTAS, *METRICAS_PASSWORDS]
+
+# Endpoints que no se miden
+_SIN_METRICAS = {'static', 'metricas_prometheus'}
+
+
+@app.before_request
+def iniciar_metricas():
+    g._inicio_peticion = time.perf_counter()
+    metricas.nueva_peticion(app.debug or app.config['DETECTAR_N_MAS_1'])
+
+
+@before_render_template.connect_via(app)
+def _inicio_render(sender, template, context, **extra):
+    g._inicio_render = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _fin_render(sender, template, context, **extra):
+    estado = metricas.peticion_actual.get()
+    inicio = g.pop('_inicio_render', None)
+    if estado is not None and inicio is not None:
+        estado['segundos_render'] += time.perf_counter() - inicio
+
+
+@app.after_request
+def registrar_metricas(respuesta):
+    """Registra las métricas de la petición y agrega el encabezado Server-Timing."""
+    estado = metricas.peticion_actual.get()
+    inicio = g.get('_inicio_peticion')
+    if estado is None or inicio is None:
+        return respuesta
+    total = time.perf_counter() - inicio
+    endpoint = request.endpoint or 'desconocido'
+    if endpoint not in _SIN_METRICAS:
+        METRICA_PETICION.observar(total, endpoint)
+        METRICA_MONGO_COMANDOS.observar(estado['comandos'], endpoint)
+        METRICA_MONGO_SEGUNDOS.observar(estado['segundos_mongo'], endpoint)
+        METRICA_MONGO_DOCUMENTOS.observar(estado['documentos'], endpoint)
+        METRICA_RENDER_SEGUNDOS.observar(estado['segundos_render'], endpoint)
+        METRICA_PETICIONES.incrementar(endpoint, respuesta.status_code)
+        if 'X-Cache' in respuesta.headers:
+            METRICA_CACHE_RESPUESTAS.incrementar(endpoint, respuesta.headers['X-Cache'].lower())
+        for forma, veces in metricas.repetidos(estado, app.config['N_MAS_1_UMBRAL']):
+            app.logger.warning(f"Posible N+1 en {endpoint}: {veces} comandos con la forma {forma}")
+    respuesta.headers['Server-Timing'] = (
+        f'mongo;dur={estado["segundos_mongo"] * 1000:.1f};'
+        f'desc="{estado["comandos"]} comandos, {estado["documentos"]} documentos", '
+        f'render;dur={estado["segundos_render"] * 1000:.1f}, '
+        f'total;dur={total * 1000:.1f}')
+    return respuesta
+
+
+@app.teardown_request
+def terminar_metricas(error=None):
+    metricas.peticion_actual.set(None)
+
+
+@app.route('/metrics')
+def metricas_prometheus():
+    """Expone las métricas de este proceso en formato de texto de Prometheus.
+
+    Con METRICAS_TOKEN exige ese token; sin él solo responde a peticiones
+    locales, salvo que METRICAS_PUBLICAS lo abra explícitamente.
+    """
+    token = app.config['METRICAS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return 'No autorizado', 401
+    elif not app.config['METRICAS_PUBLICAS'] and request.remote_addr not in ('127.0.0.1', '::1'):
+        return 'No autorizado', 401
+    lineas = []
+    for metrica in METRICAS:
+        lineas.extend(metrica.exponer())
+    cola = passwords.metricas()
+    lineas.extend(metricas.gauges(
+        'edutrack_passwords', {k: cola[k] for k in ('en_cola', 'max_en_cola')},
+        'Estado de la cola de hashes de contraseñas (ver passwords.metricas).'))
+    return app.response_class('\n'.join(lineas) + '\n',
+                              mimetype='text/plain; version=0.0.4')
+
 # --- Funciones auxiliares ---
 
 
+def semilla_avatar(email):
+    return hashlib.sha256(email.encode('utf-8')).hexdigest()
+
+
+def avatar_de_semilla(seed):
+    return f"https://api.dicebear.com/9.x/thumbs/svg?seed={seed}&background=%23ffffff"
+
+
 def get_avatar_url(email):
     """Genera la URL del avatar con DiceBear."""
-    seed = hashlib.sha256(email.encode('utf-8')).hexdigest()
-    return f"https://api.dicebear.com/9.x/thumbs/svg?seed={seed}&background=%23ffffff"
+    return avatar_de_semilla(semilla_avatar(email))
 
 
-def get_current_user():
-    """Obtiene el usuario actual desde la sesión."""
-    if 'user_id' in session:
+def normalizar_nombre(texto):
+    """Forma de búsqueda de un nombre: minúsculas, sin acentos ni espacios repetidos.
+
+    Se guarda en usuarios.nombre_normalizado para ordenar los listados y
+    buscar por prefijo con un índice.
+    """
+    descompuesto = unicodedata.normalize('NFKD', texto or '')
+    sin_acentos = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return ' '.join(sin_acentos.lower().split())
+
+
+# Caché de documentos de usuario compartida entre peticiones (por proceso).
+# Cada entrada es {user_id: (expira_en, documento)} y se desaloja en orden LRU.
+_usuarios_cache = OrderedDict()
+_usuarios_cache_lock = threading.Lock()
+
+
+def _cargar_usuario(user_id):
+    """Obtiene el documento del usuario, usando la caché TTL/LRU si está habilitada."""
+    ttl = app.config['USER_CACHE_TTL']
+    capacidad = app.config['USER_CACHE_SIZE']
+    usar_cache = ttl > 0 and capacidad > 0
+
+    if usar_cache:
+        with _usuarios_cache_lock:
+            entrada = _usuarios_cache.get(user_id)
+            if entrada and entrada[0] > time.monotonic():
+                _usuarios_cache.move_to_end(user_id)
+                # Copia superficial para que las rutas no alteren la caché
+                return dict(entrada[1])
+            _usuarios_cache.pop(user_id, None)
+
+    user = mongo.db.usuarios.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        return None
+    user['avatar_url'] = get_avatar_url(user['email'])
+
+    if usar_cache:
+        with _usuarios_cache_lock:
+            _usuarios_cache[user_id] = (time.monotonic() + ttl, user)
+            _usuarios_cache.move_to_end(user_id)
+            while len(_usuarios_cache) > capacidad:
+                _usuarios_cache.popitem(last=False)
+        return dict(user)
+    return user
+
+
+def invalidar_usuario(user_id):
+    """Descarta el usuario de la caché y del memo de la petición actual.
+
+    Debe llamarse después de cualquier escritura sobre el documento del usuario.
+    Los demás procesos (workers de gunicorn) lo verán actualizado al expirar el TTL.
+    """
+    user_id = str(user_id)
+    with _usuarios_cache_lock:
+        _usuarios_cache.pop(user_id, None)
+    memo = g.get('_usuario_memo')
+    if memo is not None and memo[0] == user_id:
+        g.pop('_usuario_memo')
+
+
+# --- Sesión firmada ---
+
+# La cookie de sesión (firmada con SECRET_KEY) lleva en session['usuario'] una
+# foto del usuario: id, rol, nombre, semilla del avatar, grupo y las versiones
+# de autenticación con que se tomó. La foto basta para saber quién es y qué
+# rol tiene, sin consultar usuarios.
+# Cada cambio que afecta fotos incrementa el contador global y deja en
+# sesiones_cambios {_id: versión, usuarios: [ids] (None: todos), fecha}. Cada
+# proceso lee esos cambios a lo más cada AUTH_VERSION_TTL segundos; una sesión
+# con una versión anterior solo relee su usuario si el cambio la incluye (si
+# su auth_version también cambió, por contraseña, rol o eliminación, la
+# sesión se cierra). Las demás solo adelantan su versión, sin consultar Mongo.
+# Los cambios se conservan AUTH_CAMBIOS_RETENCION segundos; las sesiones más
+# viejas que eso releen su usuario una vez.
+VERSION_AUTH = 'auth'
+_auth_cache = {'version': None, 'desde': 0, 'todos': 0, 'cambios': {},
+               'leida': None, 'expira': 0.0}
+_auth_lock = threading.Lock()
+
+
+def _estado_auth():
+    """Cambios de sesión conocidos por el proceso; se releen cada AUTH_VERSION_TTL segundos.
+
+    Devuelve {'version', 'desde', 'todos', 'cambios'}: la versión más reciente
+    conocida, la versión antes de la cual no se sabe qué cambió, la última
+    que afectó a todos y {user_id: última versión que lo afectó}.
+    """
+    with _auth_lock:
+        if _auth_cache['expira'] > time.monotonic():
+            return _auth_cache
+        leida = _auth_cache['leida']
+    ahora = datetime.now()
+    # Se vuelve a leer el último minuto por si dos cambios se insertaron en desorden
+    filtro = {"fecha": {"$gte": leida - timedelta(minutes=1)}} if leida else {}
+    nuevos = list(mongo.db.sesiones_cambios.find(filtro))
+    global_doc = mongo.db.versiones.find_one({"_id": VERSION_AUTH}) if leida is None else None
+    retencion = timedelta(seconds=app.config['AUTH_CAMBIOS_RETENCION'])
+    with _auth_lock:
+        estado = _auth_cache
+        if estado['leida'] is None:
+            # Lo anterior al cambio más viejo que se conserva es desconocido
+            estado['desde'] = min(c['_id'] for c in nuevos) - 1 if nuevos \
+                else (global_doc['version'] if global_doc else 0)
+            estado['version'] = estado['desde']
+        for cambio in nuevos:
+            estado['version'] = max(estado['version'], cambio['_id'])
+            if cambio['usuarios'] is None:
+                estado['todos'] = max(estado['todos'], cambio['_id'])
+            for uid in cambio['usuarios'] or []:
+                anterior = estado['cambios'].get(uid)
+                if not anterior or anterior[0] < cambio['_id']:
+                    estado['cambios'][uid] = (cambio['_id'], cambio['fecha'])
+        # Olvidar los cambios que ya no se conservan en Mongo
+        for uid, (version, fecha) in list(estado['cambios'].items()):
+            if fecha < ahora - retencion:
+                del estado['cambios'][uid]
+                estado['desde'] = max(estado['desde'], version)
+        estado.update(leida=ahora, expira=time.monotonic() + app.config['AUTH_VERSION_TTL'])
+        return estado
+
+
+def version_auth_global():
+    """Versión de autenticación más reciente que conoce el proceso."""
+    return _estado_auth()['version']
+
+
+def _foto_vigente(foto, estado):
+    """True si ningún cambio posterior a la foto afecta a su usuario."""
+    vg = foto['vg']
+    cambio = estado['cambios'].get(foto['id'])
+    return vg >= estado['desde'] and vg >= estado['todos'] and (not cambio or cambio[0] <= vg)
+
+
+def refrescar_sesiones(user_ids=None):
+    """Hace que las sesiones de `user_ids` (None: todas) renueven su foto del usuario.
+
+    Los demás procesos lo notan al expirar su AUTH_VERSION_TTL.
+    """
+    version = mongo.db.versiones.find_one_and_update(
+        {"_id": VERSION_AUTH}, {"$inc": {"version": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)['version']
+    mongo.db.sesiones_cambios.insert_one({
+        "_id": version,
+        "usuarios": None if user_ids is None else [str(uid) for uid in user_ids],
+        "fecha": datetime.now()})
+    with _auth_lock:
+        _auth_cache['expira'] = 0.0
+
+
+def revocar_sesiones(user_id):
+    """Cierra las sesiones abiertas del usuario (cambio de contraseña o rol, eliminación)."""
+    mongo.db.usuarios.update_one({"_id": ObjectId(user_id)}, {"$inc": {"auth_version": 1}})
+    refrescar_sesiones([user_id])
+
+
+def guardar_sesion(user, version_global=None):
+    """Inicia o renueva la sesión firmada con la foto del usuario."""
+    ultima = user.get('ultima_actividad')
+    session['user_id'] = str(user['_id'])
+    session['usuario'] = {
+        'id': str(user['_id']),
+        'rol': user['rol'],
+        'nombre': user.get('nombre_completo', ''),
+        'avatar': semilla_avatar(user['email']),
+        'grupo_id': user.get('grupo_id'),
+        # Marca de tiempo (la sesión no conserva fechas locales sin zona)
+        'actividad': ultima.timestamp() if ultima else None,
+        'v': user.get('auth_version', 0),
+        'vg': version_auth_global() if version_global is None else version_global,
+    }
+
+
+def usuario_sesion():
+    """Usuario actual según la foto de la sesión, normalmente sin consultar Mongo.
+
+    Devuelve un dict con _id, rol, nombre_completo, avatar_url, grupo_id y
+    ultima_actividad, o None si no hay sesión o fue revocada. Las rutas que
+    necesitan el documento completo usan `get_current_user`.
+    """
+    if 'user_id' not in session:
+        return None
+    memo = g.get('_sesion_memo')
+    if memo is not None:
+        return memo
+
+    foto = session.get('usuario')
+    estado = _estado_auth()
+    version = estado['version']
+    if foto and foto['id'] == session['user_id'] and foto['vg'] < version \
+            and _foto_vigente(foto, estado):
+        # Los cambios nuevos no son de este usuario: basta con adelantar la versión
+        foto = session['usuario'] = {**foto, 'vg': version}
+    if not foto or foto['id'] != session['user_id'] or foto['vg'] < version:
         user = mongo.db.usuarios.find_one(
-            {"_id": ObjectId(session['user_id'])})
-        if user:
-            user['avatar_url'] = get_avatar_url(user['email'])
-            return user
-    return None
+            {"_id": ObjectId(session['user_id'])},
+            {"rol": 1, "nombre_completo": 1, "email": 1, "grupo_id": 1,
+             "ultima_actividad": 1, "auth_version": 1})
+        # Sesiones anteriores a la foto solo tienen user_id: se adoptan
+        if not user or (foto and foto['id'] == session['user_id']
+                        and user.get('auth_version', 0) != foto['v']):
+            session.clear()
+            return None
+        guardar_sesion(user, version)
+        foto = session['usuario']
+
+    g._sesion_memo = {
+        '_id': ObjectId(foto['id']),
+        'rol': foto['rol'],
+        'nombre_completo': foto['nombre'],
+        'avatar_url': avatar_de_semilla(foto['avatar']),
+        'grupo_id': foto['grupo_id'],
+        'ultima_actividad': datetime.fromtimestamp(foto['actividad']) if foto['actividad'] else None,
+    }
+    return g._sesion_memo
+
+
+def get_current_user():
+    """Obtiene el documento completo del usuario actual desde la sesión.
+
+    Primero valida la sesión con `usuario_sesion` (una sesión revocada no
+    llega a leer el documento). El resultado se memoriza en `g` durante la
+    petición, de modo que la ruta y sus auxiliares comparten una sola búsqueda.
+    """
+    if usuario_sesion() is None:
+        return None
+    user_id = session['user_id']
+    memo = g.get('_usuario_memo')
+    if memo is not None and memo[0] == user_id:
+        return memo[1]
+    user = _cargar_usuario(user_id)
+    g._usuario_memo = (user_id, user)
+    return user
+
+
+# Hilos compartidos para las consultas independientes de una misma vista.
+# PyMongo es seguro entre hilos y cada hilo toma su propia conexión del pool.
+_consultas_pool = ThreadPoolExecutor(max_workers=Config.CONSULTAS_WORKERS,
+                                     thread_name_prefix='consultas')
+
+
+def _medir_consulta(nombre, consulta):
+    inicio = time.perf_counter()
+    try:
+        return consulta()
+    finally:
+        app.logger.debug(
+            f"[{request.endpoint}] consulta {nombre}: {(time.perf_counter() - inicio) * 1000:.1f} ms")
+
+
+def en_paralelo(**consultas):
+    """Ejecuta consultas independientes en paralelo y devuelve {nombre: resultado}.
+
+    Cada consulta es una función sin argumentos que debe devolver datos ya
+    materializados (p. ej. `list(cursor)`), porque un cursor se leería fuera
+    del hilo. Se ejecutan con una copia del contexto de la petición, así que
+    `g`, `request` y `session` siguen disponibles. El tiempo de cada una y el
+    total se registran en el log (nivel DEBUG). Si alguna falla, la excepción
+    se propaga al llamador.
+    """
+    inicio = time.perf_counter()
+    futuros = {nombre: _consultas_pool.submit(copy_context().run, _medir_consulta, nombre, consulta)
+               for nombre, consulta in consultas.items()}
+    resultados = {nombre: futuro.result() for nombre, futuro in futuros.items()}
+    app.logger.debug(
+        f"[{request.endpoint}] {len(consultas)} consultas en paralelo: "
+        f"{(time.perf_counter() - inicio) * 1000:.1f} ms")
+    return resultados
+
+# --- Catálogo de hábitos ---
+
+# Copia en memoria del catálogo de hábitos base activos y de los hábitos
+# personales por usuario. Cada copia guarda la versión con la que se leyó; las
+# versiones viven en la colección `versiones` y se incrementan en cada cambio,
+# así los demás workers detectan el cambio con una lectura por _id.
+_catalogo_cache = {'version': None, 'habitos': []}
+_habitos_personales_cache = OrderedDict()
+_catalogo_lock = threading.Lock()
+
+CATALOGO_BASE = 'catalogo_habitos'
+
+
+def _clave_personales(usuario_id):
+    return f"habitos_personales:{usuario_id}"
+
+
+def _versiones_catalogo(*claves):
+    """Devuelve {clave: version}, leyendo de Mongo solo una vez por petición."""
+    memo = g.setdefault('_versiones_catalogo', {})
+    faltantes = [c for c in claves if c not in memo]
+    if faltantes:
+        for doc in mongo.db.versiones.find({"_id": {"$in": faltantes}}):
+            memo[doc['_id']] = doc['version']
+        for clave in faltantes:
+            memo.setdefault(clave, 0)
+    return memo
+
+
+def obtener_habitos_base(usuario_id=None):
+    """Devuelve los hábitos base activos desde la caché versionada.
+
+    Si se pasa `usuario_id`, la versión de sus hábitos personales se lee en la
+    misma consulta para que `obtener_habitos_personales` no vuelva a Mongo.
+    """
+    claves = [CATALOGO_BASE] + ([_clave_personales(usuario_id)] if usuario_id else [])
+    version = _versiones_catalogo(*claves)[CATALOGO_BASE]
+    with _catalogo_lock:
+        if _catalogo_cache['version'] == version:
+            return list(_catalogo_cache['habitos'])
+    habitos = list(mongo.db.habitos.find({"activo": True, "tipo": "base"}))
+    with _catalogo_lock:
+        _catalogo_cache.update(version=version, habitos=habitos)
+    return list(habitos)
+
+
+def obtener_habitos_personales(usuario_id):
+    """Devuelve los hábitos personales activos del usuario desde la caché versionada."""
+    usuario_id = str(usuario_id)
+    clave = _clave_personales(usuario_id)
+    version = _versiones_catalogo(clave)[clave]
+    with _catalogo_lock:
+        entrada = _habitos_personales_cache.get(usuario_id)
+        if entrada and entrada[0] == version:
+            _habitos_personales_cache.move_to_end(usuario_id)
+            return list(entrada[1])
+    habitos = list(mongo.db.habitos.find({
+        "usuario_id": usuario_id,
+        "tipo": "personal",
+        "activo": True
+    }))
+    with _catalogo_lock:
+        _habitos_personales_cache[usuario_id] = (version, habitos)
+        _habitos_personales_cache.move_to_end(usuario_id)
+        while len(_habitos_personales_cache) > app.config['USER_CACHE_SIZE']:
+            _habitos_personales_cache.popitem(last=False)
+    return list(habitos)
+
+
+def invalidar_catalogo(usuario_id=None):
+    """Incrementa la versión del catálogo base o de los hábitos personales del usuario.
+
+    Un cambio en el catálogo base invalida también todas las respuestas del
+    tutor en caché (cambia el cumplimiento esperado).
+    """
+    clave = _clave_personales(usuario_id) if usuario_id else CATALOGO_BASE
+    mongo.db.versiones.update_one(
+        {"_id": clave}, {"$inc": {"version": 1}}, upsert=True)
+    g.get('_versiones_catalogo', {}).pop(clave, None)
+    if not usuario_id:
+        invalidar_respuestas()
+
+# --- Caché de respuestas del tutor ---
+
+# Versión que invalida todas las respuestas (grupos, membresías, catálogo base,
+# tutores). Cada grupo tiene además su propia versión para los registros de
+# sus estudiantes. Los contadores están en la colección versiones, compartida
+# por todos los workers, con el prefijo 'respuestas:'.
+VERSION_GLOBAL = 'global'
+
+
+def _clave_version_grupo(grupo_id):
+    return f'grupo:{grupo_id}'
+
+
+def _versiones_respuestas(claves):
+    """Versiones actuales de las claves, en el mismo orden (una consulta)."""
+    ids = [f'respuestas:{clave}' for clave in claves]
+    actuales = {v['_id']: v.get('version', 0)
+                for v in mongo.db.versiones.find({"_id": {"$in": ids}})}
+    return [actuales.get(i, 0) for i in ids]
+
+
+def _incrementar_version_respuestas(clave):
+    mongo.db.versiones.update_one(
+        {"_id": f'respuestas:{clave}'}, {"$inc": {"version": 1}}, upsert=True)
+
+
+def invalidar_respuestas():
+    """Invalida todas las respuestas en caché."""
+    if respuestas_cache is not None:
+        _incrementar_version_respuestas(VERSION_GLOBAL)
+
+
+def invalidar_respuestas_grupo(grupo_id):
+    """Invalida las respuestas que dependen de un grupo (sin grupo no hace nada)."""
+    if respuestas_cache is not None and grupo_id:
+        _incrementar_version_respuestas(_clave_version_grupo(grupo_id))
+
+
+def cache_tutor(vista):
+    """Cachea la respuesta de una vista para el tutor que la pide.
+
+    La llave es el tutor, el día y la URL completa. Junto con la respuesta se
+    guardan los grupos del tutor y las versiones (global y por grupo) vigentes
+    al generarla; un acierto solo las compara con las actuales, con una
+    consulta a versiones por _id. Los demás roles y las peticiones con mensajes flash
+    pendientes pasan directo a la vista.
+    """
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        user = usuario_sesion()
+        if respuestas_cache is None or not user or user['rol'] != 'tutor' \
+                or session.get('_flashes'):
+            return vista(*args, **kwargs)
+
+        tutor_id = str(user['_id'])
+        clave = f"{request.endpoint}:{tutor_id}:{date.today().isoformat()}:{request.full_path}"
+        entrada = respuestas_cache.obtener(clave)
+        if entrada is not None:
+            claves_version, versiones, cuerpo, mimetype = entrada
+            if _versiones_respuestas(claves_version) == versiones:
+                respuesta = app.response_class(cuerpo, mimetype=mimetype)
+                respuesta.headers['X-Cache'] = 'HIT'
+                return respuesta
+
+        # Las versiones se leen antes de generar la respuesta: si una escritura
+        # ocurre mientras tanto, la entrada nace ya invalidada.
+        grupos = mongo.db.grupos.find({"tutor_id": tutor_id}, {"_id": 1})
+        claves_version = [VERSION_GLOBAL] + [_clave_version_grupo(gr['_id']) for gr in grupos]
+        versiones = _versiones_respuestas(claves_version)
+
+        respuesta = make_response(vista(*args, **kwargs))
+        if respuesta.status_code == 200 and not respuesta.is_streamed \
+                and not session.get('_flashes'):
+            respuestas_cache.guardar(
+                clave, (claves_version, versiones, respuesta.get_data(), respuesta.mimetype),
+                app.config['CACHE_RESPUESTAS_TTL'])
+            respuesta.headers['X-Cache'] = 'MISS'
+        return respuesta
+    return envoltura
+
+# --- Resumen diario de cumplimiento ---
+
+# resumen_diario tiene un documento por (usuario_id, fecha) con los conteos de
+# sus registros: total, estados, categorias.<categoria>.<estado>, tipos.<tipo>
+# y base.<habito_id> (uno por hábito base, para que las estadísticas de grupo
+# cuenten solo los hábitos base activos aunque se desactive alguno).
+ESTADOS_REGISTRO = ['cumplido', 'incumplido', 'no_aplica']
+
+
+def _incrementos_resumen(habito, estado_anterior, estado_nuevo):
+    """Calcula el $inc que lleva un registro de `estado_anterior` a `estado_nuevo`.
+
+    `estado_anterior` es None cuando el registro es nuevo. Si el estado no
+    cambia devuelve un dict vacío.
+    """
+    if estado_anterior == estado_nuevo:
+        return {}
+    categoria = habito.get('categoria', 'Otro')
+    incrementos = {
+        f"estados.{estado_nuevo}": 1,
+        f"categorias.{categoria}.{estado_nuevo}": 1
+    }
+    if estado_anterior is None:
+        incrementos['total'] = 1
+        incrementos[f"tipos.{habito.get('tipo', 'base')}"] = 1
+        if habito.get('tipo', 'base') == 'base' and habito.get('_id'):
+            incrementos[f"base.{habito['_id']}"] = 1
+    else:
+        incrementos[f"estados.{estado_anterior}"] = -1
+        incrementos[f"categorias.{categoria}.{estado_anterior}"] = -1
+    return incrementos
+
+
+def actualizar_resumen_diario(usuario_id, fecha, incrementos):
+    """Aplica de forma atómica los incrementos al resumen de (usuario_id, fecha)."""
+    if not incrementos:
+        return
+    mongo.db.resumen_diario.update_one(
+        {"usuario_id": usuario_id, "fecha": fecha},
+        {"$inc": incrementos},
+        upsert=True
+    )
+
+
+def reconstruir_resumen_diario(usuario_id=None, lote=1000):
+    """Regenera resumen_diario a partir de los registros crudos.
+
+    Recorre los registros ordenados por (usuario_id, fecha), el orden en que
+    los entrega `leer_registros`, así que solo mantiene en memoria el día en
+    curso. Durante la migración de tipos ese orden no agrupa los días (cada
+    formato sale por separado), así que no se puede ejecutar hasta que
+    termine. Devuelve el número de resúmenes escritos.
+    """
+    if not almacen_mensual() and fase_tipos() == 'migrando':
+        raise RuntimeError("La migración de tipos está en curso; termina `flask migrar-tipos` primero.")
+    filtro = {"usuario_id": usuario_id} if usuario_id else {}
+    habitos = {str(h['_id']): h for h in mongo.db.habitos.find(
+        {}, {"categoria": 1, "tipo": 1})}
+
+    mongo.db.resumen_diario.delete_many(filtro)
+
+    escritos = 0
+    operaciones = []
+    actual = None
+    llave = None
+    for registro in leer_registros([usuario_id] if usuario_id else None):
+        nueva_llave = (registro['usuario_id'], registro['fecha'])
+        if nueva_llave != llave:
+            if actual:
+                operaciones.append(ReplaceOne(
+                    {"usuario_id": llave[0], "fecha": llave[1]}, actual, upsert=True))
+            llave = nueva_llave
+            actual = {"usuario_id": llave[0], "fecha": llave[1], "total": 0,
+                      "estados": {}, "categorias": {}, "tipos": {}, "base": {}}
+        habito = habitos.get(registro['habito_id'], {})
+        for campo, valor in _incrementos_resumen(habito, None, registro['estado']).items():
+            destino = actual
+            *ruta, hoja = campo.split('.')
+            for parte in ruta:
+                destino = destino.setdefault(parte, {})
+            destino[hoja] = destino.get(hoja, 0) + valor
+        if len(operaciones) >= lote:
+            mongo.db.resumen_diario.bulk_write(operaciones, ordered=False)
+            escritos += len(operaciones)
+            operaciones = []
+    if actual:
+        operaciones.append(ReplaceOne(
+            {"usuario_id": llave[0], "fecha": llave[1]}, actual, upsert=True))
+    if operaciones:
+        mongo.db.resumen_diario.bulk_write(operaciones, ordered=False)
+        escritos += len(operaciones)
+    return escritos
+
+
+@app.cli.command('reconstruir-resumen')
+@click.option('--usuario', default=None, help='Reconstruir solo el resumen de este usuario.')
+def reconstruir_resumen_command(usuario):
+    """Regenera la colección resumen_diario desde los registros crudos."""
+    try:
+        escritos = reconstruir_resumen_diario(usuario)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    invalidar_respuestas()
+    vencer_reportes(todos=True)
+    click.echo(f"{escritos} resúmenes diarios reconstruidos.")
+
+
+# --- Rachas ---
+
+# Una racha es la serie de días seguidos con el hábito cumplido; 'no_aplica'
+# no la corta ni la alarga, e 'incumplido' o un día sin registro la rompen.
+# La colección rachas guarda un documento por (usuario_id, habito_id) con:
+# - base_actual, base_fecha, base_maxima: la racha y el máximo hasta el
+#   último día anterior a `fecha`;
+# - fecha, estado: el último día registrado.
+# Así un cambio del registro de hoy solo sustituye `estado` y la racha se
+# recalcula en O(1) desde la base, sin leer el historial.
+INTENTOS_RACHA = 5
+
+
+def _dia_anterior(fecha):
+    return (date.fromisoformat(fecha) - timedelta(days=1)).isoformat()
+
+
+def _racha_en_fecha(racha):
+    """(actual, máxima) al cierre del último día registrado en `racha`."""
+    vigente = racha.get('base_actual', 0) \
+        if racha.get('base_fecha') == _dia_anterior(racha['fecha']) else 0
+    if racha['estado'] == 'cumplido':
+        actual = vigente + 1
+    elif racha['estado'] == 'no_aplica':
+        actual = vigente
+    else:
+        actual = 0
+    return actual, max(racha.get('base_maxima', 0), actual)
+
+
+def _avanzar_racha(racha, fecha, estado):
+    """Estado de la racha tras registrar `estado` el día `fecha` ('AAAA-MM-DD').
+
+    `racha` es el documento actual ({} si no hay). Si `fecha` es el mismo día
+    ya registrado solo cambia el estado; si es un día posterior, ese día pasa a
+    la base. Devuelve None si `fecha` es anterior al último día registrado
+    (eso requiere `recalcular_rachas`).
+    """
+    nueva = {k: racha[k] for k in ('base_actual', 'base_fecha', 'base_maxima') if k in racha}
+    if racha.get('fecha') and racha['fecha'] != fecha:
+        if fecha < racha['fecha']:
+            return None
+        actual, maxima = _racha_en_fecha(racha)
+        nueva.update(base_actual=actual, base_fecha=racha['fecha'], base_maxima=maxima)
+    nueva.update(fecha=fecha, estado=estado)
+    return nueva
+
+
+def racha_vigente(racha, hoy=None):
+    """{'actual', 'maxima'} de una racha vista el día `hoy`.
+
+    Si el último registro es de antes de ayer, la racha actual ya se rompió.
+    """
+    if not racha or not racha.get('fecha'):
+        return {'actual': 0, 'maxima': 0}
+    hoy = (hoy or date.today()).isoformat()
+    actual, maxima = _racha_en_fecha(racha)
+    if racha['fecha'] not in (hoy, _dia_anterior(hoy)):
+        actual = 0
+    return {'actual': actual, 'maxima': maxima}
+
+
+def actualizar_rachas(usuario_id, fecha, estados):
+    """Aplica {habito_id: estado} del día `fecha` a las rachas del usuario.
+
+    Lee los documentos de los hábitos con una consulta y los escribe con un
+    solo bulk_write, cada uno condicionado a su versión `v` (ver
+    `_escritura_condicionada`); si otra petición cambió alguno entre la
+    lectura y la escritura, solo esos hábitos se vuelven a intentar. Devuelve
+    {habito_id: {'actual', 'maxima'}}.
+    """
+    resultado = {}
+    pendientes = dict(estados)
+    for _ in range(INTENTOS_RACHA):
+        if not pendientes:
+            break
+        actuales = {r['habito_id']: r for r in mongo.db.rachas.find(
+            {"usuario_id": usuario_id, "habito_id": {"$in": list(pendientes)}})}
+        escritas, operaciones = [], []
+        for habito_id, estado in list(pendientes.items()):
+            racha = actuales.get(habito_id, {})
+            nueva = _avanzar_racha(racha, fecha, estado)
+            if nueva is None:
+                app.logger.warning(
+                    f"Registro de {fecha} anterior a la racha de {usuario_id}/{habito_id}; "
+                    "ejecuta `flask recalcular-rachas`.")
+                del pendientes[habito_id]
+                continue
+            if racha:
+                operaciones.append(UpdateOne(
+                    {"_id": racha['_id'], "v": racha.get('v', 0)},
+                    {"$set": {**nueva, "v": racha.get('v', 0) + 1}}, upsert=True))
+            else:
+                operaciones.append(InsertOne(
+                    {"usuario_id": usuario_id, "habito_id": habito_id, "v": 1, **nueva}))
+            escritas.append((habito_id, nueva))
+        conflictos, errores = _escritura_condicionada(mongo.db.rachas, operaciones)
+        for indice, (habito_id, nueva) in enumerate(escritas):
+            if indice in conflictos:
+                continue  # Otra petición la cambió; se vuelve a leer
+            del pendientes[habito_id]
+            if indice in errores:
+                app.logger.error(f"Error al actualizar la racha de {usuario_id}/{habito_id}: "
+                                 f"{errores[indice]}")
+            else:
+                resultado[habito_id] = racha_vigente(nueva, date.fromisoformat(fecha))
+    for habito_id in pendientes:
+        app.logger.error(f"No se pudo actualizar la racha de {usuario_id}/{habito_id}")
+    return resultado
+
+
+def rachas_usuario(usuario_id):
+    """{habito_id: {'actual', 'maxima'}} de todos los hábitos del usuario (una consulta)."""
+    return {r['habito_id']: racha_vigente(r)
+            for r in mongo.db.rachas.find({"usuario_id": usuario_id})}
+
+
+def recalcular_rachas(usuario_id=None, lote=1000):
+    """Reconstruye la colección rachas desde los registros.
+
+    Lee los registros de un estudiante a la vez (salen agrupados por
+    usuario_id) y aplica `_avanzar_racha` día por día en orden cronológico.
+    Devuelve el número de rachas escritas.
+    """
+    if not almacen_mensual() and fase_tipos() == 'migrando':
+        raise RuntimeError("La migración de tipos está en curso; termina `flask migrar-tipos` primero.")
+    filtro = {"usuario_id": usuario_id} if usuario_id else {}
+    mongo.db.rachas.delete_many(filtro)
+
+    escritas = 0
+    operaciones = []
+
+    def cerrar_usuario(uid, dias_por_habito):
+        for habito_id, dias in dias_por_habito.items():
+            racha = {}
+            for fecha in sorted(dias):
+                racha = _avanzar_racha(racha, fecha, dias[fecha])
+            operaciones.append(ReplaceOne(
+                {"usuario_id": uid, "habito_id": habito_id},
+                {"usuario_id": uid, "habito_id": habito_id, "v": 1, **racha},
+                upsert=True))
+
+    actual, dias_por_habito = None, {}
+    for registro in leer_registros([usuario_id] if usuario_id else None):
+        if registro['usuario_id'] != actual:
+            if actual:
+                cerrar_usuario(actual, dias_por_habito)
+            actual, dias_por_habito = registro['usuario_id'], {}
+        dias_por_habito.setdefault(registro['habito_id'], {})[registro['fecha']] = registro['estado']
+        if len(operaciones) >= lote:
+            mongo.db.rachas.bulk_write(operaciones, ordered=False)
+            escritas += len(operaciones)
+            operaciones = []
+    if actual:
+        cerrar_usuario(actual, dias_por_habito)
+    if operaciones:
+        mongo.db.rachas.bulk_write(operaciones, ordered=False)
+        escritas += len(operaciones)
+    return escritas
+
+
+@app.cli.command('recalcular-rachas')
+@click.option('--usuario', default=None, help='Recalcular solo las rachas de este usuario.')
+def recalcular_rachas_command(usuario):
+    """Reconstruye las rachas de hábitos desde los registros (backfill)."""
+    try:
+        escritas = recalcular_rachas(usuario)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    invalidar_respuestas()
+    click.echo(f"{escritas} rachas recalculadas.")
+
+
+# --- Actividad de estudiantes ---
+
+# usuarios.ultima_actividad guarda la fecha y hora del último registro del
+# estudiante. Se escribe con $max a lo más una vez por ACTIVIDAD_RESOLUCION,
+# así que registrar varios hábitos seguidos no agrega escrituras, y con el
+# índice (grupo_id, ultima_actividad, _id) encontrar a los inactivos de un
+# grupo es un rango del índice en lugar de revisar sus registros.
+# usuarios.cumplimiento guarda el porcentaje de cumplimiento de hábitos base
+# de los últimos CUMPLIMIENTO_DIAS días; lo escribe `calcular_reportes` junto
+# con los reportes del grupo y se consulta con el índice
+# (grupo_id, cumplimiento, _id).
+ACTIVIDAD_RESOLUCION = timedelta(hours=1)
+CUMPLIMIENTO_DIAS = 7
+
+
+def registrar_actividad(user):
+    """Actualiza ultima_actividad del estudiante si cambió más que la resolución."""
+    ahora = datetime.now()
+    ultima = user.get('ultima_actividad')
+    if ultima and ahora - ultima < ACTIVIDAD_RESOLUCION:
+        return
+    mongo.db.usuarios.update_one({"_id": user['_id']}, {"$max": {"ultima_actividad": ahora}})
+    invalidar_usuario(user['_id'])
+    foto = session.get('usuario')
+    if foto and foto['id'] == str(user['_id']):
+        session['usuario'] = {**foto, 'actividad': ahora.timestamp()}
+
+
+def _inicio_del_dia(fecha):
+    return datetime.combine(fecha, datetime.min.time())
+
+
+def calcular_ultima_actividad(lote=1000):
+    """Llena ultima_actividad desde resumen_diario (backfill).
+
+    Toma el día más reciente de cada estudiante en resumen_diario y lo aplica
+    con $max, así que no retrocede valores escritos por registros más nuevos.
+    Devuelve el número de estudiantes actualizados.
+    """
+    ultimos = mongo.db.resumen_diario.aggregate([
+        {"$group": {"_id": "$usuario_id", "fecha": {"$max": "$fecha"}}}
+    ], allowDiskUse=True)
+    actualizados = 0
+    operaciones = []
+    for u in ultimos:
+        if not ObjectId.is_valid(u['_id']):
+            continue
+        operaciones.append(UpdateOne(
+            {"_id": ObjectId(u['_id'])},
+            {"$max": {"ultima_actividad": _inicio_del_dia(date.fromisoformat(u['fecha']))}}))
+        if len(operaciones) >= lote:
+            actualizados += mongo.db.usuarios.bulk_write(operaciones, ordered=False).modified_count
+            operaciones = []
+    if operaciones:
+        actualizados += mongo.db.usuarios.bulk_write(operaciones, ordered=False).modified_count
+    return actualizados
+
+
+@app.cli.command('calcular-ultima-actividad')
+def calcular_ultima_actividad_command():
+    """Llena usuarios.ultima_actividad desde el resumen diario (backfill)."""
+    actualizados = calcular_ultima_actividad()
+    with _usuarios_cache_lock:
+        _usuarios_cache.clear()
+    invalidar_respuestas()
+    click.echo(f"{actualizados} estudiantes actualizados.")
+
+
+def _estudiantes_bajo(grupo_ids, campo, tope, despues, limite):
+    """Estudiantes de los grupos con `campo` menor a `tope` o sin valor.
+
+    Es un rango del índice (grupo_id, campo, _id): ordena por (campo, _id),
+    con los que no tienen valor primero, y pagina por llave con `despues`, el
+    _id del último estudiante de la página anterior. Devuelve
+    (estudiantes, hay_siguiente).
+    """
+    bajo = {"$or": [{campo: {"$lt": tope}}, {campo: None}]}
+    filtro = {"grupo_id": {"$in": grupo_ids}, **bajo}
+
+    ref = None
+    if despues and ObjectId.is_valid(despues):
+        ref = mongo.db.usuarios.find_one({"_id": ObjectId(despues)}, {campo: 1})
+    if ref:
+        valor = ref.get(campo)
+        if valor is None:
+            siguiente = {"$or": [{campo: None, "_id": {"$gt": ref['_id']}},
+                                 {campo: {"$lt": tope}}]}
+        else:
+            siguiente = {"$or": [{campo: valor, "_id": {"$gt": ref['_id']}},
+                                 {campo: {"$gt": valor, "$lt": tope}}]}
+        filtro = {"grupo_id": {"$in": grupo_ids}, "$and": [bajo, siguiente]}
+
+    estudiantes = list(mongo.db.usuarios.find(
+        filtro, {"nombre_completo": 1, "numero_control": 1, "grupo_id": 1,
+                 "ultima_actividad": 1, "cumplimiento": 1})
+        .sort([(campo, ASCENDING), ("_id", ASCENDING)])
+        .limit(limite + 1))
+    return estudiantes[:limite], len(estudiantes) > limite
+
+
+def estudiantes_inactivos(grupo_ids, dias, despues=None, limite=50):
+    """Estudiantes de los grupos sin actividad en los últimos `dias` días.
+
+    Los que nunca han registrado salen primero. Devuelve (estudiantes, hay_siguiente).
+    """
+    corte = _inicio_del_dia(date.today() - timedelta(days=dias))
+    return _estudiantes_bajo(grupo_ids, 'ultima_actividad', corte, despues, limite)
+
+
+def estudiantes_bajo_cumplimiento(grupo_ids, umbral, despues=None, limite=50):
+    """Estudiantes de los grupos con cumplimiento menor a `umbral` %.
+
+    Lee usuarios.cumplimiento, el porcentaje de los últimos CUMPLIMIENTO_DIAS
+    días que guarda `calcular_reportes`; los que aún no lo tienen salen
+    primero. Devuelve (estudiantes, hay_siguiente).
+    """
+    return _estudiantes_bajo(grupo_ids, 'cumplimiento', umbral, despues, limite)
+
+
+# --- Reportes precalculados ---
+
+# El cumplimiento por grupo (30 días y última semana) y el ranking del
+# dashboard del tutor solo necesitan estar al día con unos minutos de
+# diferencia, así que se calculan fuera de la petición y se guardan en la
+# colección reportes:
+# - 'grupo:<grupo_id>': la salida de `estadisticas_grupos` para el grupo;
+# - 'tutor:<tutor_id>': promedio de la semana, top 3 y la lista de sus grupos.
+# Cada documento lleva `calculado` (la marca de agua). Las vistas leen estos
+# documentos y muestran la marca de agua; solo calculan en la petición si el
+# reporte del tutor no existe. Si está vencido (un cambio en sus grupos o
+# membresías, ver `vencer_reportes`) o es más viejo que REPORTES_MAX_EDAD, se
+# sirve tal cual y se recalcula en un hilo aparte. Los demás cambios (catálogo
+# base, registros) se reflejan en la siguiente corrida del programador o al
+# cumplirse REPORTES_MAX_EDAD.
+PROGRAMADOR_REPORTES = 'programador'
+# Tutores por recalcular en fondo; un solo hilo por proceso los atiende
+_reportes_pendientes = set()
+_reportes_hilo = {'activo': False}
+_reportes_lock = threading.Lock()
+
+
+def calcular_reportes(tutor_id=None):
+    """Calcula y guarda los reportes de un tutor o de todos.
+
+    Cada tutor cuesta las dos consultas de `estadisticas_grupos` y dos
+    bulk_write (reportes y usuarios.cumplimiento). En una corrida completa se
+    borran al final los reportes que no se reescribieron (grupos eliminados o
+    tutores sin grupos). Devuelve {tutor_id: documento del tutor}.
+    """
+    inicio = datetime.now()
+    filtro = {"tutor_id": tutor_id} if tutor_id else {"tutor_id": {"$nin": [None, ""]}}
+    grupos_por_tutor = {tutor_id: []} if tutor_id else {}
+    for grupo in mongo.db.grupos.find(filtro, {"nombre": 1, "tutor_id": 1}):
+        grupos_por_tutor.setdefault(grupo['tutor_id'], []).append(grupo)
+
+    num_habitos_base = len(obtener_habitos_base())
+    reportes = {}
+    for tid, grupos in grupos_por_tutor.items():
+        stats_por_grupo = estadisticas_grupos(grupos, dias_semana=CUMPLIMIENTO_DIAS)
+        total_estudiantes = sum(s['num_estudiantes'] for s in stats_por_grupo)
+        esperados = total_estudiantes * (num_habitos_base or 1) * CUMPLIMIENTO_DIAS
+        ranking = []
+        if num_habitos_base:
+            ranking = sorted(
+                ([s['grupo_id'], {'nombre': s['nombre_grupo'], 'promedio': s['promedio_semana']}]
+                 for s in stats_por_grupo),
+                key=lambda item: item[1]['promedio'], reverse=True)[:3]
+        reporte = {
+            "_id": f"tutor:{tid}", "tipo": "tutor", "tutor_id": tid, "calculado": inicio,
+            "grupos": [s['grupo_id'] for s in stats_por_grupo],
+            "promedio_cumplimiento_grupal": round(
+                sum(s['registros_semana'] for s in stats_por_grupo) / esperados * 100, 2)
+            if esperados else 0.0,
+            "grupos_ranking": ranking,
+        }
+        operaciones = [ReplaceOne({"_id": reporte['_id']}, reporte, upsert=True)]
+        for s in stats_por_grupo:
+            operaciones.append(ReplaceOne(
+                {"_id": f"grupo:{s['grupo_id']}"},
+                {"_id": f"grupo:{s['grupo_id']}", "tipo": "grupo", "tutor_id": tid,
+                 "calculado": inicio, **s},
+                upsert=True))
+        mongo.db.reportes.bulk_write(operaciones, ordered=False)
+        # Cumplimiento por estudiante; solo se escriben los que cambiaron
+        cumplimientos = [UpdateOne(
+            {"_id": ObjectId(e['id']), "cumplimiento": {"$ne": e['promedio_semana']}},
+            {"$set": {"cumplimiento": e['promedio_semana']}})
+            for s in stats_por_grupo for e in s['estudiantes_data']]
+        if cumplimientos:
+            mongo.db.usuarios.bulk_write(cumplimientos, ordered=False)
+        reportes[tid] = reporte
+
+    if not tutor_id:
+        mongo.db.reportes.delete_many(
+            {"tipo": {"$in": ["tutor", "grupo"]}, "calculado": {"$lt": inicio}})
+        mongo.db.reportes.update_one(
+            {"_id": PROGRAMADOR_REPORTES},
+            {"$set": {"ultima_corrida": inicio,
+                      "duracion": (datetime.now() - inicio).total_seconds()}},
+            upsert=True)
+    return reportes
+
+
+def vencer_reportes(grupo_id=None, tutor_id=None, todos=False):
+    """Marca como vencidos los reportes del tutor y de los tutores que tienen el grupo.
+
+    Sin grupo ni tutor no hace nada; `todos` vence los de todos los tutores
+    (para los comandos que cambian los datos de todos los grupos).
+    """
+    condiciones = []
+    if tutor_id:
+        condiciones.append({"_id": f"tutor:{tutor_id}"})
+    if grupo_id:
+        condiciones.append({"tipo": "tutor", "grupos": grupo_id})
+    if todos:
+        condiciones = [{"tipo": "tutor"}]
+    if condiciones:
+        mongo.db.reportes.update_many({"$or": condiciones}, {"$set": {"vencido": True}})
+
+
+def refrescar_reportes_en_fondo(tutor_id):
+    """Encola el tutor para recalcular sus reportes en el hilo de fondo.
+
+    Un solo hilo por proceso recalcula los tutores pendientes uno por uno y
+    termina cuando no queda ninguno; un tutor ya pendiente no se repite.
+    """
+    with _reportes_lock:
+        _reportes_pendientes.add(tutor_id)
+        if _reportes_hilo['activo']:
+            return
+        _reportes_hilo['activo'] = True
+    threading.Thread(target=_atender_reportes_pendientes, name='reportes', daemon=True).start()
+
+
+def _atender_reportes_pendientes():
+    while True:
+        with _reportes_lock:
+            if not _reportes_pendientes:
+                _reportes_hilo['activo'] = False
+                return
+            tutor_id = _reportes_pendientes.pop()
+        try:
+            with app.app_context():
+                calcular_reportes(tutor_id)
+        except Exception as e:
+            app.logger.error(f"Error al recalcular reportes del tutor {tutor_id}: {e}")
+
+
+def reporte_tutor(tutor_id):
+    """Documento del reporte del tutor.
+
+    Solo lo calcula en la petición si no existe; si está vencido o es más
+    viejo que REPORTES_MAX_EDAD lo devuelve igual y pide un recálculo en
+    segundo plano.
+    """
+    reporte = mongo.db.reportes.find_one({"_id": f"tutor:{tutor_id}"})
+    if not reporte:
+        return calcular_reportes(tutor_id)[tutor_id]
+    max_edad = timedelta(seconds=app.config['REPORTES_MAX_EDAD'])
+    if reporte.get('vencido') or datetime.now() - reporte['calculado'] > max_edad:
+        refrescar_reportes_en_fondo(tutor_id)
+    return reporte
+
+
+def reportes_grupos(reporte):
+    """Reportes de los grupos de un reporte de tutor, en el mismo orden."""
+    if not reporte['grupos']:
+        return []
+    por_id = {r['grupo_id']: r for r in mongo.db.reportes.find(
+        {"_id": {"$in": [f"grupo:{gid}" for gid in reporte['grupos']]}})}
+    return [por_id[gid] for gid in reporte['grupos'] if gid in por_id]
+
+
+def _tomar_turno_reportes(intervalo):
+    """True si este proceso ganó la corrida de este intervalo.
+
+    El turno es un documento con la hora hasta la que está tomado; solo un
+    proceso (de la CLI o de un worker web) puede tomarlo mientras no expire,
+    así que varios programadores en marcha no repiten el cálculo.
+    """
+    ahora = datetime.now()
+    try:
+        mongo.db.reportes.update_one(
+            {"_id": PROGRAMADOR_REPORTES,
+             "$or": [{"turno_hasta": {"$lt": ahora}}, {"turno_hasta": None}]},
+            {"$set": {"turno_hasta": ahora + timedelta(seconds=intervalo)}},
+            upsert=True)
+    except DuplicateKeyError:
+        return False  # Otro proceso tiene el turno
+    return True
+
+
+def ejecutar_programador_reportes(intervalo=None, detener=None):
+    """Recalcula todos los reportes cada `intervalo` segundos hasta que se active `detener`."""
+    intervalo = intervalo or app.config['REPORTES_INTERVALO']
+    detener = detener or threading.Event()
+    while not detener.is_set():
+        try:
+            if _tomar_turno_reportes(intervalo):
+                inicio = time.monotonic()
+                tutores = len(calcular_reportes())
+                app.logger.info(f"Reportes de {tutores} tutores calculados en "
+                                f"{time.monotonic() - inicio:.1f} s")
+        except Exception as e:
+            app.logger.error(f"Error al calcular reportes: {e}")
+        detener.wait(intervalo)
+
+
+def iniciar_programador_reportes():
+    """Arranca el programador en un hilo del proceso web (REPORTES_EN_PROCESO)."""
+    def correr():
+        with app.app_context():
+            ejecutar_programador_reportes()
+    threading.Thread(target=correr, name='reportes', daemon=True).start()
+
+
+@app.cli.command('calcular-reportes')
+@click.option('--tutor', default=None, help='Calcular solo los reportes de este tutor.')
+def calcular_reportes_command(tutor):
+    """Calcula una vez los reportes de cumplimiento de los tutores."""
+    reportes = calcular_reportes(tutor)
+    click.echo(f"Reportes de {len(reportes)} tutores calculados.")
+
+
+@app.cli.command('programador-reportes')
+@click.option('--intervalo', default=None, type=int,
+              help='Segundos entre corridas (por omisión REPORTES_INTERVALO).')
+def programador_reportes_command(intervalo):
+    """Worker que recalcula los reportes periódicamente (Ctrl+C para salir)."""
+    click.echo("Programador de reportes en marcha.")
+    try:
+        ejecutar_programador_reportes(intervalo)
+    except KeyboardInterrupt:
+        pass
+
+
+# --- Tipos nativos en registros_habitos ---
+
+# Los registros se guardaban con usuario_id y habito_id como cadenas y fecha
+# como 'AAAA-MM-DD'. `flask migrar-tipos` los convierte a ObjectId y a fecha
+# de BSON (medianoche UTC) en lotes, guardando su avance en la colección
+# migraciones. La fase de la migración decide cómo se lee y se escribe:
+# - 'cadenas': sin migrar; todo como cadenas.
+# - 'migrando': se escribe con tipos nativos y se leen ambos formatos.
+# - 'nativos': migración terminada; todo con tipos nativos.
+# Fuera de este módulo los registros siempre se manejan como cadenas.
+# Solo se migra registros_habitos: usuarios.grupo_id, resumen_diario y rachas
+# siguen guardando los ids como cadenas.
+MIGRACION_TIPOS = 'tipos_nativos'
+_fase_tipos = {'fase': None, 'leida': 0.0}
+_fase_tipos_lock = threading.Lock()
+
+
+def fase_tipos():
+    """Fase de la migración de tipos; se relee de Mongo cada TIPOS_FASE_TTL segundos."""
+    ahora = time.monotonic()
+    with _fase_tipos_lock:
+        if _fase_tipos['fase'] and ahora - _fase_tipos['leida'] < app.config['TIPOS_FASE_TTL']:
+            return _fase_tipos['fase']
+    estado = mongo.db.migraciones.find_one({"_id": MIGRACION_TIPOS}, {"fase": 1})
+    fase = estado['fase'] if estado else 'cadenas'
+    with _fase_tipos_lock:
+        _fase_tipos.update(fase=fase, leida=ahora)
+    return fase
+
+
+def _fecha_nativa(fecha):
+    """'AAAA-MM-DD' (o date) como datetime a medianoche, el tipo fecha de BSON."""
+    if isinstance(fecha, str):
+        fecha = date.fromisoformat(fecha)
+    return datetime(fecha.year, fecha.month, fecha.day)
+
+
+def _registro_en_cadenas(registro):
+    """Devuelve el registro con usuario_id, habito_id y fecha como cadenas."""
+    for campo in ('usuario_id', 'habito_id'):
+        if isinstance(registro.get(campo), ObjectId):
+            registro[campo] = str(registro[campo])
+    if isinstance(registro.get('fecha'), datetime):
+        registro['fecha'] = registro['fecha'].date().isoformat()
+    return registro
+
+
+def _documento_registro(usuario_id, habito_id, fecha, estado, nota):
+    """Documento de registros_habitos con los tipos de la fase actual."""
+    if fase_tipos() != 'cadenas':
+        usuario_id, habito_id, fecha = ObjectId(usuario_id), ObjectId(habito_id), _fecha_nativa(fecha)
+    return {"usuario_id": usuario_id, "habito_id": habito_id, "fecha": fecha,
+            "estado": estado, "nota": nota}
+
+
+def _filtro_registros(usuario_ids=None, desde=None, hasta=None, habito_ids=None):
+    """Filtro de registros_habitos por estudiantes, hábitos y rango de fechas.
+
+    Recibe cadenas (fechas 'AAAA-MM-DD'). Mientras dura la migración es un
+    $or con una rama por formato; cada rama usa los mismos índices.
+    """
+    def rama(nativo):
+        filtro = {}
+        for campo, valores in (("usuario_id", usuario_ids), ("habito_id", habito_ids)):
+            if valores is not None:
+                valores = [ObjectId(v) for v in valores] if nativo else list(valores)
+                filtro[campo] = valores[0] if len(valores) == 1 else {"$in": valores}
+        rango = {operador: _fecha_nativa(valor) if nativo else valor
+                 for operador, valor in (("$gte", desde), ("$lte", hasta)) if valor}
+        if rango:
+            filtro["fecha"] = rango
+        return filtro
+
+    fase = fase_tipos()
+    if fase == 'migrando':
+        return {"$or": [rama(False), rama(True)]}
+    return rama(fase == 'nativos')
+
+
+def migrar_tipos(lote=1000, espera=None, maximo=None):
+    """Convierte usuario_id, habito_id y fecha de registros_habitos a tipos nativos.
+
+    Recorre la colección por _id en lotes y guarda el último _id procesado en
+    migraciones, así que si se interrumpe continúa donde se quedó. Antes del
+    primer lote marca la fase 'migrando' y espera `espera` segundos (por
+    omisión TIPOS_FASE_TTL) para que todos los procesos empiecen a escribir con
+    tipos nativos y a leer ambos formatos. Si un registro ya tiene su versión
+    nativa (escrita durante la migración), se borra la versión en cadenas.
+    `maximo` limita los documentos procesados en esta corrida. Devuelve el
+    estado guardado en migraciones.
+    """
+    migraciones = mongo.db.migraciones
+    estado = migraciones.find_one({"_id": MIGRACION_TIPOS}) or {}
+    if estado.get('fase') == 'nativos':
+        return estado
+    if estado.get('fase') != 'migrando':
+        migraciones.update_one(
+            {"_id": MIGRACION_TIPOS},
+            {"$set": {"fase": "migrando", "inicio": datetime.now(),
+                      "procesados": 0, "convertidos": 0, "duplicados": 0}},
+            upsert=True)
+        with _fase_tipos_lock:
+            _fase_tipos['fase'] = None
+        time.sleep(app.config['TIPOS_FASE_TTL'] if espera is None else espera)
+        estado = migraciones.find_one({"_id": MIGRACION_TIPOS})
+
+    ultimo_id = estado.get('ultimo_id')
+    procesados = 0
+    while True:
+        cursor = mongo.db.registros_habitos.find(
+            {"_id": {"$gt": ultimo_id}} if ultimo_id else {},
+            {"usuario_id": 1, "habito_id": 1, "fecha": 1}
+        ).sort("_id", ASCENDING).limit(lote)
+        documentos = list(cursor)
+        if not documentos:
+            break
+        operaciones, ids = [], []
+        for documento in documentos:
+            cambios = {}
+            for campo in ('usuario_id', 'habito_id'):
+                valor = documento.get(campo)
+                if isinstance(valor, str) and ObjectId.is_valid(valor):
+                    cambios[campo] = ObjectId(valor)
+            if isinstance(documento.get('fecha'), str):
+                try:
+                    cambios['fecha'] = _fecha_nativa(documento['fecha'])
+                except ValueError:
+                    app.logger.error(f"Registro {documento['_id']} con fecha inválida: {documento['fecha']}")
+            if cambios:
+                operaciones.append(UpdateOne({"_id": documento['_id']}, {"$set": cambios}))
+                ids.append(documento['_id'])
+        duplicados = []
+        if operaciones:
+            try:
+                mongo.db.registros_habitos.bulk_write(operaciones, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    if error.get('code') != 11000:
+                        raise
+                    duplicados.append(ids[error['index']])
+            if duplicados:
+                mongo.db.registros_habitos.delete_many({"_id": {"$in": duplicados}})
+        ultimo_id = documentos[-1]['_id']
+        procesados += len(documentos)
+        migraciones.update_one({"_id": MIGRACION_TIPOS}, {
+            "$set": {"ultimo_id": ultimo_id, "actualizado": datetime.now()},
+            "$inc": {"procesados": len(documentos),
+                     "convertidos": len(operaciones) - len(duplicados),
+                     "duplicados": len(duplicados)}
+        })
+        if maximo is not None and procesados >= maximo:
+            # La siguiente corrida continúa desde ultimo_id
+            return migraciones.find_one({"_id": MIGRACION_TIPOS})
+
+    migraciones.update_one({"_id": MIGRACION_TIPOS},
+                           {"$set": {"fase": "nativos", "fin": datetime.now()}})
+    with _fase_tipos_lock:
+        _fase_tipos['fase'] = None
+    return migraciones.find_one({"_id": MIGRACION_TIPOS})
+
+
+@app.cli.command('migrar-tipos')
+@click.option('--lote', default=1000, show_default=True, help='Documentos por lote.')
+@click.option('--maximo', type=int, default=None,
+              help='Procesar como mucho estos documentos y detenerse (se puede continuar después).')
+def migrar_tipos_command(lote, maximo):
+    """Migra registros_habitos a ObjectId y fechas nativas (reanudable)."""
+    estado = migrar_tipos(lote=lote, maximo=maximo)
+    click.echo(f"Fase: {estado['fase']}. {estado.get('procesados', 0)} registros procesados, "
+               f"{estado.get('convertidos', 0)} convertidos, "
+               f"{estado.get('duplicados', 0)} duplicados eliminados.")
+    if estado.get('duplicados'):
+        click.echo("Hubo duplicados: ejecuta `flask reconstruir-resumen` para corregir resumen_diario.")
+
+
+# --- Almacenamiento de registros ---
+
+# Con ALMACEN_REGISTROS = 'mensual' los registros de un estudiante en un mes
+# viven en un solo documento de registros_mensuales:
+#   {_id: "<usuario_id>:<AAAA-MM>", usuario_id, mes: "AAAA-MM",
+#    dias: {"DD": {"<habito_id>": estado}}, notas: {"DD": {"<habito_id>": nota}}}
+# Las notas vacías no se guardan. Un mes de 18 hábitos son ~540 entradas en un
+# documento y una entrada de índice, en lugar de 540 documentos con tres
+# índices cada uno.
+
+
+def almacen_mensual():
+    return app.config['ALMACEN_REGISTROS'] == 'mensual'
+
+
+def _id_mensual(usuario_id, fecha):
+    """(_id del documento mensual, día 'DD') de una fecha 'AAAA-MM-DD'."""
+    return f"{usuario_id}:{fecha[:7]}", fecha[8:]
+
+
+def _guardar_mensual(usuario_id, fecha, registros):
+    """Escribe {habito_id: (estado, nota)} en el documento del mes con un solo update.
+
+    Cada registro es un $set sobre su ruta dias.DD.<habito_id>, así que dos
+    escrituras del mismo día sobre hábitos distintos no se pisan. Devuelve
+    los estados anteriores {habito_id: estado} de los hábitos escritos.
+    """
+    _id, dia = _id_mensual(usuario_id, fecha)
+    asignar, quitar = {}, {}
+    for habito_id, (estado, nota) in registros.items():
+        asignar[f"dias.{dia}.{habito_id}"] = estado
+        if nota:
+            asignar[f"notas.{dia}.{habito_id}"] = nota
+        else:
+            quitar[f"notas.{dia}.{habito_id}"] = ""
+    cambios = {"$set": asignar,
+               "$setOnInsert": {"usuario_id": usuario_id, "mes": fecha[:7]}}
+    if quitar:
+        cambios["$unset"] = quitar
+    antes = mongo.db.registros_mensuales.find_one_and_update(
+        {"_id": _id}, cambios,
+        projection={f"dias.{dia}": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    del_dia = ((antes or {}).get('dias') or {}).get(dia, {})
+    return {habito_id: del_dia[habito_id] for habito_id in registros if habito_id in del_dia}
+
+
+# Veces que se vuelve a leer y escribir un registro que otra petición cambió
+INTENTOS_REGISTRO = 5
+
+
+def _escritura_condicionada(coleccion, operaciones):
+    """Ejecuta `operaciones` en un bulk_write sin orden; devuelve (conflictos, errores).
+
+    Las operaciones son upserts filtrados por el valor que se leyó (el _id y su
+    estado o versión, o la ausencia del documento). Si el documento cambió, el
+    upsert intenta insertarlo y choca con el _id o con el índice único; esos
+    índices salen en `conflictos` para volver a intentarlos. `errores` es
+    {índice: mensaje} de los demás fallos.
+    """
+    conflictos, errores = set(), {}
+    if not operaciones:
+        return conflictos, errores
+    try:
+        coleccion.bulk_write(operaciones, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            if error.get('code') == 11000:
+                conflictos.add(error['index'])
+            else:
+                errores[error['index']] = error.get('errmsg', '')
+    except OperationFailure as e:
+        errores = {indice: str(e) for indice in range(len(operaciones))}
+    return conflictos, errores
+
+
+def _reemplazar_registro(usuario_id, habito_id, fecha, estado, nota):
+    """Upsert atómico de un registro; devuelve el estado que tenía (None si es nuevo).
+
+    El estado anterior sale de la misma operación que escribe, así que el
+    cambio que se aplica a resumen_diario no se cuenta dos veces aunque otra
+    petición escriba el mismo registro al mismo tiempo.
+    """
+    anterior = mongo.db.registros_habitos.find_one_and_replace(
+        _filtro_registros([usuario_id], fecha, fecha, [habito_id]),
+        _documento_registro(usuario_id, habito_id, fecha, estado, nota),
+        projection={"estado": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    return anterior['estado'] if anterior else None
+
+
+def guardar_registro(usuario_id, habito_id, fecha, estado, nota=''):
+    """Guarda (upsert) un registro y devuelve su estado anterior, o None si es nuevo."""
+    if almacen_mensual():
+        return _guardar_mensual(usuario_id, fecha, {habito_id: (estado, nota)}).get(habito_id)
+    return _reemplazar_registro(usuario_id, habito_id, fecha, estado, nota)
+
+
+def guardar_registros(usuario_id, fecha, registros):
+    """Guarda varios registros de un mismo día: {habito_id: (estado, nota)}.
+
+    Devuelve (anteriores, fallidos): los estados previos {habito_id: estado} y
+    los errores {habito_id: mensaje} de los que no se pudieron guardar. En modo
+    mensual la escritura es un solo update atómico: se guardan todos o ninguno;
+    en modo documentos, un find y un bulk_write, más uno de cada uno por
+    reintento.
+    """
+    if almacen_mensual():
+        try:
+            return _guardar_mensual(usuario_id, fecha, registros), {}
+        except OperationFailure as e:
+            return {}, {habito_id: str(e) for habito_id in registros}
+
+    # Una lectura de los estados previos y un bulk_write de upserts
+    # condicionados a ellos: si otra petición cambia un registro entre la
+    # lectura y la escritura, su upsert choca y solo ese se vuelve a leer y a
+    # escribir, así que ningún cambio se cuenta dos veces en resumen_diario.
+    anteriores, fallidos = {}, {}
+    pendientes = dict(registros)
+    for _ in range(INTENTOS_REGISTRO):
+        if not pendientes:
+            break
+        try:
+            actuales = {str(r['habito_id']): r for r in mongo.db.registros_habitos.find(
+                _filtro_registros([usuario_id], fecha, fecha, list(pendientes)),
+                {"habito_id": 1, "estado": 1})}
+        except OperationFailure as e:
+            fallidos.update({habito_id: str(e) for habito_id in pendientes})
+            break
+        habito_ids, operaciones = [], []
+        for habito_id, (estado, nota) in pendientes.items():
+            documento = _documento_registro(usuario_id, habito_id, fecha, estado, nota)
+            actual = actuales.get(habito_id)
+            if actual:
+                filtro = {"_id": actual['_id'], "estado": actual['estado']}
+            else:
+                filtro = {**_filtro_registros([usuario_id], fecha, fecha, [habito_id]),
+                          "estado": {"$exists": False}}
+            habito_ids.append(habito_id)
+            operaciones.append(UpdateOne(filtro, {"$set": documento}, upsert=True))
+        conflictos, errores = _escritura_condicionada(mongo.db.registros_habitos, operaciones)
+        for indice, habito_id in enumerate(habito_ids):
+            if indice in conflictos:
+                continue  # Se vuelve a leer y a escribir
+            del pendientes[habito_id]
+            if indice in errores:
+                fallidos[habito_id] = errores[indice]
+            elif habito_id in actuales:
+                anteriores[habito_id] = actuales[habito_id]['estado']
+    for habito_id in pendientes:
+        fallidos[habito_id] = "El registro cambió mientras se guardaba"
+    return anteriores, fallidos
+
+
+def _leer_documentos(usuario_ids=None, desde=None, hasta=None, batch_size=None, con_id=False):
+    """Registros de registros_habitos con los campos como cadenas (ver `leer_registros`).
+
+    Mientras dura la migración de tipos cada formato sale por separado, así
+    que un mismo día puede aparecer en dos tramos.
+    """
+    cursor = mongo.db.registros_habitos.find(
+        _filtro_registros(usuario_ids, desde, hasta),
+        {"_id": 1 if con_id else 0, "usuario_id": 1, "habito_id": 1, "fecha": 1,
+         "estado": 1, "nota": 1},
+        sort=[("usuario_id", ASCENDING), ("fecha", DESCENDING)])
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    with cursor:
+        for registro in cursor:
+            yield _registro_en_cadenas(registro)
+
+
+def leer_registros(usuario_ids=None, desde=None, hasta=None, batch_size=None):
+    """Genera los registros de `usuario_ids` (None: todos) entre dos fechas inclusive.
+
+    Cada registro es un dict con usuario_id, habito_id, fecha, estado y nota,
+    sin importar el almacenamiento. Salen ordenados por usuario_id y fecha
+    descendente, el orden de los índices usuario_fecha y usuario_mes, así que
+    Mongo no ordena en memoria. En modo mensual un mes es un solo documento.
+    """
+    desde = desde.isoformat() if desde else None
+    hasta = hasta.isoformat() if hasta else None
+    if not almacen_mensual():
+        yield from _leer_documentos(usuario_ids, desde, hasta, batch_size)
+        return
+
+    filtro = {}
+    if usuario_ids is not None:
+        filtro["usuario_id"] = usuario_ids[0] if len(usuario_ids) == 1 else {"$in": list(usuario_ids)}
+    if desde or hasta:
+        filtro["mes"] = {k: v[:7] for k, v in (("$gte", desde), ("$lte", hasta)) if v}
+    cursor = mongo.db.registros_mensuales.find(
+        filtro, {"usuario_id": 1, "mes": 1, "dias": 1, "notas": 1},
+        sort=[("usuario_id", ASCENDING), ("mes", DESCENDING)])
+    if batch_size:
+        # Cada documento trae un mes de registros
+        cursor = cursor.batch_size(max(1, batch_size // 500))
+    with cursor:
+        for documento in cursor:
+            notas = documento.get('notas') or {}
+            for dia in sorted(documento.get('dias') or {}, reverse=True):
+                fecha = f"{documento['mes']}-{dia}"
+                if (desde and fecha < desde) or (hasta and fecha > hasta):
+                    continue
+                notas_dia = notas.get(dia) or {}
+                for habito_id, estado in documento['dias'][dia].items():
+                    yield {"usuario_id": documento['usuario_id'], "habito_id": habito_id,
+                           "fecha": fecha, "estado": estado,
+                           "nota": notas_dia.get(habito_id, '')}
+
+
+def resumenes_de_registros(registros):
+    """Agrupa registros por día: [{fecha, total, estados}] en orden ascendente.
+
+    Da lo mismo que resumen_diario para las vistas de un estudiante, así que
+    en modo mensual se calcula del mismo documento que trae los registros.
+    """
+    dias = {}
+    for registro in registros:
+        dia = dias.setdefault(registro['fecha'], {"fecha": registro['fecha'], "total": 0,
+                                                  "estados": {}})
+        dia['total'] += 1
+        dia['estados'][registro['estado']] = dia['estados'].get(registro['estado'], 0) + 1
+    return [dias[fecha] for fecha in sorted(dias)]
+
+
+def _tamano_coleccion(nombre):
+    """(datos, índices) en bytes de una colección, o None si no se puede consultar."""
+    try:
+        estadisticas = mongo.db.command('collStats', nombre)
+    except (OperationFailure, NotImplementedError):
+        return None
+    return estadisticas.get('storageSize', 0), estadisticas.get('totalIndexSize', 0)
+
+
+def compactar_registros(usuario_id=None, borrar=False, lote=5000):
+    """Copia registros_habitos a registros_mensuales, un documento por estudiante y mes.
+
+    Se puede ejecutar varias veces y con la aplicación en marcha: si un
+    registro ya existe en el documento mensual (porque se escribió después
+    de activar el modo mensual) se conserva ese valor. Escribe cada `lote`
+    registros; un mes puede quedar repartido en dos lotes porque cada lote
+    solo agrega rutas al documento. Con `borrar` elimina de registros_habitos
+    los registros ya copiados. Devuelve (registros copiados, escrituras de
+    documentos mensuales).
+    """
+    copiados = escritos = 0
+    meses = {}  # {_id: {"usuario_id", "mes", "dias", "notas"}} del lote en curso
+    ids_copiados = []
+
+    def escribir_lote():
+        nonlocal escritos
+        existentes = {d['_id']: d.get('dias') or {} for d in mongo.db.registros_mensuales.find(
+            {"_id": {"$in": list(meses)}}, {"dias": 1})}
+        operaciones = []
+        for _id, mes in meses.items():
+            ya_escritos = existentes.get(_id, {})
+            asignar = {}
+            for dia, habitos in mes['dias'].items():
+                for habito_id, estado in habitos.items():
+                    if habito_id in ya_escritos.get(dia, {}):
+                        continue
+                    asignar[f"dias.{dia}.{habito_id}"] = estado
+                    nota = mes['notas'].get(dia, {}).get(habito_id)
+                    if nota:
+                        asignar[f"notas.{dia}.{habito_id}"] = nota
+            if asignar:
+                operaciones.append(UpdateOne(
+                    {"_id": _id},
+                    {"$set": asignar,
+                     "$setOnInsert": {"usuario_id": mes['usuario_id'], "mes": mes['mes']}},
+                    upsert=True))
+        if operaciones:
+            mongo.db.registros_mensuales.bulk_write(operaciones, ordered=False)
+            escritos += len(operaciones)
+        if borrar:
+            mongo.db.registros_habitos.delete_many({"_id": {"$in": ids_copiados}})
+        meses.clear()
+        ids_copiados.clear()
+
+    for registro in _leer_documentos([usuario_id] if usuario_id else None, con_id=True):
+        _id, dia = _id_mensual(registro['usuario_id'], registro['fecha'])
+        mes = meses.setdefault(_id, {"usuario_id": registro['usuario_id'],
+                                     "mes": registro['fecha'][:7], "dias": {}, "notas": {}})
+        mes['dias'].setdefault(dia, {})[registro['habito_id']] = registro['estado']
+        if registro.get('nota'):
+            mes['notas'].setdefault(dia, {})[registro['habito_id']] = registro['nota']
+        ids_copiados.append(registro['_id'])
+        copiados += 1
+        if len(ids_copiados) >= lote:
+            escribir_lote()
+    if meses:
+        escribir_lote()
+    return copiados, escritos
+
+
+@app.cli.command('compactar-registros')
+@click.option('--usuario', default=None, help='Compactar solo los registros de este usuario.')
+@click.option('--borrar', is_flag=True,
+              help='Eliminar de registros_habitos los registros ya copiados.')
+def compactar_registros_command(usuario, borrar):
+    """Migra registros_habitos al almacenamiento mensual (registros_mensuales).
+
+    Para cambiar de modo: ejecutar este comando, poner ALMACEN_REGISTROS=mensual,
+    reiniciar y ejecutarlo otra vez con --borrar para copiar lo que se haya
+    escrito entre la primera corrida y el reinicio.
+    """
+    copiados, escritos = compactar_registros(usuario, borrar)
+    invalidar_respuestas()
+    click.echo(f"{copiados} registros copiados a {escritos} documentos mensuales.")
+    for nombre in ('registros_habitos', 'registros_mensuales'):
+        tamano = _tamano_coleccion(nombre)
+        if tamano:
+            click.echo(f"{nombre}: {tamano[0] / 1e6:.1f} MB de datos, "
+                       f"{tamano[1] / 1e6:.1f} MB de índices")
+
+
+# --- Membresía de grupos ---
+
+def migrar_membresias():
+    """Pasa la membresía de grupos.estudiante_ids a usuarios.grupo_id.
+
+    Cada estudiante pertenece a un solo grupo; si aparece en varias listas se
+    conserva el primer grupo y se registra una advertencia. Es idempotente: al
+    terminar quita estudiante_ids de los grupos ya migrados, y los estudiantes
+    que ya tienen grupo_id no se sobrescriben. Devuelve el número de
+    estudiantes actualizados.
+    """
+    actualizados = 0
+    for grupo in mongo.db.grupos.find({"estudiante_ids": {"$exists": True}},
+                                      {"nombre": 1, "estudiante_ids": 1}):
+        grupo_id = str(grupo['_id'])
+        ids = [ObjectId(sid) for sid in grupo.get('estudiante_ids') or []]
+        if ids:
+            result = mongo.db.usuarios.update_many(
+                {"_id": {"$in": ids}, "rol": "estudiante", "grupo_id": None},
+                {"$set": {"grupo_id": grupo_id}}
+            )
+            actualizados += result.modified_count
+            en_otro = mongo.db.usuarios.count_documents(
+                {"_id": {"$in": ids}, "grupo_id": {"$nin": [None, grupo_id]}})
+            if en_otro:
+                app.logger.warning(
+                    f"{en_otro} estudiantes del grupo {grupo.get('nombre')} ya tenían otro grupo; se conservó el anterior.")
+        mongo.db.grupos.update_one({"_id": grupo['_id']}, {"$unset": {"estudiante_ids": ""}})
+    return actualizados
+
+
+@app.cli.command('migrar-membresias')
+def migrar_membresias_command():
+    """Mueve la membresía de los grupos al campo grupo_id de cada estudiante."""
+    actualizados = migrar_membresias()
+    refrescar_sesiones()
+    invalidar_respuestas()
+    vencer_reportes(todos=True)
+    click.echo(f"{actualizados} estudiantes asignados a su grupo.")
 
 # --- Rutas ---
 
@@ -47,6 +1769,10 @@ def index():
     return redirect(url_for('login'))
 
 
+# Respuesta (con 503) cuando la cola de hashes de contraseñas está llena
+MENSAJE_SERVICIO_OCUPADO = 'El servicio está muy ocupado. Intenta de nuevo en unos segundos.'
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -56,9 +1782,27 @@ def login():
         # Buscar usuario por email
         user = mongo.db.usuarios.find_one({"email": email})
 
-        if user and check_password_hash(user['password'], password):
-            # Iniciar sesión usando Flask session [[17]]
-            session['user_id'] = str(user['_id'])
+        try:
+            valido = bool(user) and passwords.verificar_password(
+                user['password'], password or '')
+        except passwords.ServicioOcupado:
+            app.logger.warning(
+                f"Inicio de sesión rechazado: cola de hashes llena ({passwords.metricas()})")
+            flash(MENSAJE_SERVICIO_OCUPADO, 'warning')
+            return render_template('login.html'), 503
+
+        if valido:
+            # Regenerar el hash si se creó con otro método o costo
+            if passwords.necesita_rehash(user['password']):
+                try:
+                    mongo.db.usuarios.update_one(
+                        {"_id": user['_id']},
+                        {"$set": {"password": passwords.generar_hash(password)}})
+                    invalidar_usuario(user['_id'])
+                except passwords.ServicioOcupado:
+                    pass  # Se reintentará en el próximo inicio de sesión
+            # Iniciar sesión usando Flask session [[17]] (foto firmada del usuario)
+            guardar_sesion(user)
             flash('Inicio de sesión exitoso.', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -70,6 +1814,7 @@ def login():
 @app.route('/logout')
 def logout():
     session.pop('user_id', None)
+    session.pop('usuario', None)
     flash('Has cerrado sesión.', 'info')
     return redirect(url_for('login'))
 
@@ -84,6 +1829,7 @@ def profile():
         # Actualizar datos del perfil (excepto email y rol)
         update_data = {
             "nombre_completo": request.form.get('nombre_completo'),
+            "nombre_normalizado": normalizar_nombre(request.form.get('nombre_completo')),
             # Agrega aquí otros campos editables como teléfono, etc.
         }
 
@@ -92,13 +1838,199 @@ def profile():
 
         mongo.db.usuarios.update_one(
             {"_id": ObjectId(user['_id'])}, {"$set": update_data})
+        invalidar_usuario(user['_id'])
+        session['usuario'] = {**session['usuario'], 'nombre': update_data['nombre_completo']}
+        # El nombre aparece en las vistas del tutor
+        if user['rol'] == 'estudiante':
+            invalidar_respuestas_grupo(user.get('grupo_id'))
+            vencer_reportes(grupo_id=user.get('grupo_id'))
+        else:
+            invalidar_respuestas()
         flash('Perfil actualizado correctamente.', 'success')
         return redirect(url_for('profile'))
 
     return render_template('profile.html', user=user)
 
 
+def _lookup_usuario(campo_id, proyeccion, como):
+    """Etapa $lookup que resuelve un id de usuario guardado como string."""
+    return {"$lookup": {
+        "from": "usuarios",
+        "let": {"uid": {"$toObjectId": campo_id}},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$_id", "$$uid"]}}},
+            {"$project": proyeccion}
+        ],
+        "as": como
+    }}
+
+
+def _lookup_ultimos_registros(limite):
+    """Etapas $lookup con los `limite` registros más recientes de cada miembro.
+
+    En modo mensual toma el último día con registros del documento más
+    reciente del estudiante y lo convierte a registros sueltos
+    ({usuario_id, fecha, habito_id, estado}).
+    """
+    if not almacen_mensual():
+        def lookup(variable, como):
+            return {"$lookup": {
+                "from": "registros_habitos",
+                "let": {"uid": variable},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$usuario_id", "$$uid"]}}},
+                    {"$sort": {"fecha": -1}},
+                    {"$limit": limite},
+                    # La fecha como cadena, también si ya se migró a tipo fecha
+                    {"$set": {"fecha": {"$cond": [
+                        {"$eq": [{"$type": "$fecha"}, "date"]},
+                        {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha"}},
+                        "$fecha"]}}}
+                ],
+                "as": como
+            }}
+
+        fase = fase_tipos()
+        if fase == 'cadenas':
+            return [lookup("$miembros.uid", "registro")]
+        if fase == 'nativos':
+            return [lookup("$miembros._id", "registro")]
+        # Durante la migración, un $lookup por formato (cada uno usa el índice)
+        return [lookup("$miembros.uid", "registro"),
+                lookup("$miembros._id", "registro_nativo"),
+                {"$set": {"registro": {"$concatArrays": ["$registro", "$registro_nativo"]}}}]
+    pipeline = [
+        {"$match": {"$expr": {"$eq": ["$usuario_id", "$$uid"]}}},
+        {"$sort": {"mes": -1}},
+        {"$limit": 1},
+        {"$project": {"usuario_id": 1, "mes": 1, "dia": {"$objectToArray": "$dias"}}},
+        {"$unwind": "$dia"},
+        {"$sort": {"dia.k": -1}},
+        {"$limit": 1},
+        {"$project": {"usuario_id": 1, "fecha": {"$concat": ["$mes", "-", "$dia.k"]},
+                      "habito": {"$objectToArray": "$dia.v"}}},
+        {"$unwind": "$habito"},
+        {"$limit": limite},
+        {"$project": {"_id": 0, "usuario_id": 1, "fecha": 1,
+                      "habito_id": "$habito.k", "estado": "$habito.v"}}
+    ]
+    return [{"$lookup": {"from": "registros_mensuales", "let": {"uid": "$miembros.uid"},
+                         "pipeline": pipeline, "as": "registro"}}]
+
+
+def resumen_tutor(tutor_id_str):
+    """Calcula el resumen del dashboard del tutor en una sola agregación.
+
+    Parte de los grupos del tutor, trae sus miembros por el índice de
+    usuarios.grupo_id y, con un $facet, obtiene en un solo viaje a
+    Mongo: los grupos, sus estudiantes, los 5 registros más recientes (con
+    nombres) y hasta 5 estudiantes sin actividad en los últimos 3 días (por
+    usuarios.ultima_actividad). El promedio de 7 días y el ranking de grupos
+    salen del reporte precalculado del tutor (ver `reporte_tutor`).
+
+    Devuelve (grupos, estudiantes, stats_resumen).
+    """
+    hoy = date.today()
+    hace_3_dias = _inicio_del_dia(hoy - timedelta(days=3))
+
+    por_estudiante = {"$unwind": "$miembros"}
+
+    pipeline = [
+        {"$match": {"tutor_id": tutor_id_str}},
+        # Miembros del grupo (uid es el _id como cadena, igual que en los registros)
+        {"$lookup": {
+            "from": "usuarios",
+            "let": {"gid": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$grupo_id", "$$gid"]}}},
+                {"$project": {"uid": {"$toString": "$_id"}, "nombre_completo": 1,
+                              "numero_control": 1, "email": 1, "ultima_actividad": 1}}
+            ],
+            "as": "miembros"
+        }},
+        {"$facet": {
+            "grupos": [
+                {"$project": {"nombre": 1, "ciclo_escolar": 1,
+                              "num_estudiantes": {"$size": "$miembros"}}}
+            ],
+            "ultimos_registros": [
+                por_estudiante,
+                *_lookup_ultimos_registros(5),
+                {"$unwind": "$registro"},
+                {"$replaceRoot": {"newRoot": "$registro"}},
+                {"$sort": {"fecha": -1}},
+                {"$limit": 5},
+                _lookup_usuario("$usuario_id",
+                                {"nombre_completo": 1, "numero_control": 1}, "estudiante"),
+                {"$lookup": {
+                    "from": "habitos",
+                    "let": {"hid": {"$toObjectId": "$habito_id"}},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$_id", "$$hid"]}}},
+                        {"$project": {"nombre": 1}}
+                    ],
+                    "as": "habito"
+                }}
+            ],
+            "sin_actividad": [
+                por_estudiante,
+                {"$match": {"$or": [{"miembros.ultima_actividad": {"$lt": hace_3_dias}},
+                                    {"miembros.ultima_actividad": None}]}},
+                # Limitar a 5 para no abrumar
+                {"$limit": 5},
+                {"$replaceRoot": {"newRoot": "$miembros"}}
+            ],
+            "estudiantes": [
+                por_estudiante,
+                {"$replaceRoot": {"newRoot": "$miembros"}},
+                {"$project": {"nombre_completo": 1, "numero_control": 1}}
+            ]
+        }}
+    ]
+
+    resultado = next(mongo.db.grupos.aggregate(pipeline), {})
+    grupos = resultado.get('grupos', [])
+    estudiantes = resultado.get('estudiantes', [])
+    reporte = reporte_tutor(tutor_id_str)
+
+    total_estudiantes = sum(g['num_estudiantes'] for g in grupos)
+    stats_resumen = {
+        'total_grupos': len(grupos),
+        'total_estudiantes': total_estudiantes,
+        'promedio_cumplimiento_grupal': 0.0,
+        'grupos_ranking': [],  # Top 3 grupos por cumplimiento
+        'ultimos_registros': [],  # Últimos 5 registros de estudiantes
+        'estudiantes_sin_actividad': [],  # Estudiantes sin registro en los últimos 3 días
+        'reporte_calculado': reporte['calculado']
+    }
+    if not grupos or not total_estudiantes:
+        return grupos, estudiantes, stats_resumen
+
+    # a y b. Promedio de cumplimiento grupal (últimos 7 días) y ranking de
+    # grupos (top 3), desde el reporte precalculado
+    stats_resumen['promedio_cumplimiento_grupal'] = reporte['promedio_cumplimiento_grupal']
+    stats_resumen['grupos_ranking'] = reporte['grupos_ranking']
+
+    # c. Últimos registros (5 más recientes, ya ordenados por fecha desc)
+    for registro in resultado.get('ultimos_registros', []):
+        est_info = registro['estudiante'][0] if registro['estudiante'] else None
+        hab_info = registro['habito'][0] if registro['habito'] else None
+        stats_resumen['ultimos_registros'].append({
+            'estudiante_nombre': est_info['nombre_completo'] if est_info else 'Desconocido',
+            'estudiante_numero_control': est_info.get('numero_control', 'N/A') if est_info else 'N/A',
+            'habito_nombre': hab_info['nombre'] if hab_info else 'Desconocido',
+            'fecha': registro['fecha'],
+            'estado': registro['estado']
+        })
+
+    # d. Estudiantes sin actividad en los últimos 3 días
+    stats_resumen['estudiantes_sin_actividad'] = resultado.get('sin_actividad', [])
+
+    return grupos, estudiantes, stats_resumen
+
+
 @app.route('/dashboard')
+@cache_tutor
 def dashboard():
     user = get_current_user()
     if not user:
@@ -107,166 +2039,15 @@ def dashboard():
     # Lógica para mostrar contenido específico por rol
     if user['rol'] == 'administrador':
         # Contar tutores, grupos, estudiantes
-        stats = {
-            "tutores": mongo.db.usuarios.count_documents({"rol": "tutor"}),
-            "grupos": mongo.db.grupos.estimated_document_count(),
-            "estudiantes": mongo.db.usuarios.count_documents({"rol": "estudiante"})
-        }
+        stats = en_paralelo(
+            tutores=lambda: mongo.db.usuarios.count_documents({"rol": "tutor"}),
+            grupos=lambda: mongo.db.grupos.estimated_document_count(),
+            estudiantes=lambda: mongo.db.usuarios.count_documents({"rol": "estudiante"})
+        )
         return render_template('dashboard.html', user=user, stats=stats, dashboard_type='admin')
 
     elif user['rol'] == 'tutor':
-        from datetime import date, timedelta
-
-        tutor_id_str = str(user['_id'])
-
-        # 1. Obtener grupos asignados al tutor
-        grupos = list(mongo.db.grupos.find({"tutor_id": tutor_id_str}))
-        grupo_ids = [str(g['_id']) for g in grupos]
-
-        # 2. Obtener IDs de estudiantes en esos grupos
-        student_ids = []
-        for grupo in grupos:
-            student_ids.extend(grupo.get('estudiante_ids', []))
-
-        # 3. Contar totales
-        total_grupos = len(grupos)
-        total_estudiantes = len(student_ids)
-
-        # 4. Obtener datos básicos de estudiantes
-        estudiantes = list(mongo.db.usuarios.find(
-            {"_id": {"$in": [ObjectId(sid) for sid in student_ids]}},
-            {"nombre_completo": 1, "numero_control": 1}
-        ))
-
-        # 5. Obtener estadísticas resumidas para el dashboard
-        stats_resumen = {
-            'total_grupos': total_grupos,
-            'total_estudiantes': total_estudiantes,
-            'promedio_cumplimiento_grupal': 0.0,
-            'grupos_ranking': [],  # Top 3 grupos por cumplimiento
-            'ultimos_registros': [],  # Últimos 5 registros de estudiantes
-            'estudiantes_sin_actividad': []  # Estudiantes sin registro en los últimos 3 días
-        }
-
-        if grupo_ids and student_ids:
-            # a. Promedio de cumplimiento grupal (simplificado: últimos 7 días)
-            hace_7_dias = date.today() - timedelta(days=7)
-
-            # Obtener hábitos base activos para el cálculo
-            habitos_base_ids = [str(h['_id']) for h in mongo.db.habitos.find(
-                {"activo": True, "tipo": "base"}, {"_id": 1})]
-            total_habitos_base = len(
-                habitos_base_ids) if habitos_base_ids else 1
-
-            # Registros de los últimos 7 días de los estudiantes del tutor
-            registros_7_dias = list(mongo.db.registros_habitos.find({
-                "usuario_id": {"$in": student_ids},
-                "habito_id": {"$in": habitos_base_ids},
-                "fecha": {"$gte": hace_7_dias.isoformat()}
-            }))
-
-            # Calcular promedio grupal
-            total_registros_esperados = total_estudiantes * total_habitos_base * 7
-            total_registros_reales = len(registros_7_dias)
-            if total_registros_esperados > 0:
-                stats_resumen['promedio_cumplimiento_grupal'] = round(
-                    (total_registros_reales / total_registros_esperados) * 100, 2)
-            else:
-                stats_resumen['promedio_cumplimiento_grupal'] = 0.0
-
-            # b. Ranking de grupos (simplificado)
-            if habitos_base_ids:
-                cumplimiento_por_grupo = {}
-                for grupo in grupos:
-                    g_id = str(grupo['_id'])
-                    estudiantes_grupo = grupo.get('estudiante_ids', [])
-                    if not estudiantes_grupo:
-                        cumplimiento_por_grupo[g_id] = {
-                            'nombre': grupo['nombre'], 'promedio': 0.0}
-                        continue
-
-                    registros_grupo = [
-                        r for r in registros_7_dias if r['usuario_id'] in estudiantes_grupo]
-                    total_esperado_grupo = len(
-                        estudiantes_grupo) * total_habitos_base * 7
-                    total_real_grupo = len(registros_grupo)
-                    if total_esperado_grupo > 0:
-                        promedio_grupo = (total_real_grupo /
-                                          total_esperado_grupo) * 100
-                    else:
-                        promedio_grupo = 0.0
-                    cumplimiento_por_grupo[g_id] = {
-                        'nombre': grupo['nombre'], 'promedio': round(promedio_grupo, 2)}
-
-                # Ordenar y tomar top 3
-                grupos_ordenados = sorted(cumplimiento_por_grupo.items(
-                ), key=lambda item: item[1]['promedio'], reverse=True)
-                stats_resumen['grupos_ranking'] = grupos_ordenados[:3]
-
-            # c. Últimos registros (5 más recientes)
-            # Obtener los últimos 5 registros ordenados por fecha (desc) y luego invertir para mostrarlos en orden
-            ultimos_5_registros_cursor = mongo.db.registros_habitos.find(
-                {"usuario_id": {"$in": student_ids}}
-            ).sort("fecha", -1).limit(5)  # -1 para orden descendente
-
-            ultimos_5_registros = list(ultimos_5_registros_cursor)
-            # Obtener info de estudiantes y hábitos para mostrar nombres
-            ultimos_estudiante_ids = list(
-                set(r['usuario_id'] for r in ultimos_5_registros))
-            ultimos_habito_ids = list(set(r['habito_id']
-                                      for r in ultimos_5_registros))
-
-            ultimos_estudiantes_dict = {str(e['_id']): e for e in mongo.db.usuarios.find(
-                {"_id": {"$in": [ObjectId(sid)
-                                 for sid in ultimos_estudiante_ids]}},
-                {"nombre_completo": 1, "numero_control": 1}
-            )}
-            ultimos_habitos_dict = {str(h['_id']): h for h in mongo.db.habitos.find(
-                {"_id": {"$in": [ObjectId(hid)
-                                 for hid in ultimos_habito_ids]}},
-                {"nombre": 1}
-            )}
-
-            for registro in ultimos_5_registros:
-                est_info = ultimos_estudiantes_dict.get(registro['usuario_id'])
-                hab_info = ultimos_habitos_dict.get(registro['habito_id'])
-                stats_resumen['ultimos_registros'].append({
-                    'estudiante_nombre': est_info['nombre_completo'] if est_info else 'Desconocido',
-                    'estudiante_numero_control': est_info['numero_control'] if est_info else 'N/A',
-                    'habito_nombre': hab_info['nombre'] if hab_info else 'Desconocido',
-                    'fecha': registro['fecha'],
-                    'estado': registro['estado']
-                })
-            # Ordenar por fecha descendente (más reciente primero en la lista)
-            stats_resumen['ultimos_registros'].sort(
-                key=lambda x: x['fecha'], reverse=True)
-
-            # d. Estudiantes sin actividad en los últimos 3 días
-            hace_3_dias = date.today() - timedelta(days=3)
-            # Encontrar estudiantes que tienen registros en los últimos 3 días
-            estudiantes_activos_reciente = set()
-            registros_3_dias = mongo.db.registros_habitos.find({
-                "usuario_id": {"$in": student_ids},
-                "fecha": {"$gte": hace_3_dias.isoformat()}
-            })
-            for r in registros_3_dias:
-                estudiantes_activos_reciente.add(r['usuario_id'])
-
-            # Estudiantes totales - estudiantes activos reciente = estudiantes inactivos
-            estudiantes_sin_actividad_ids = [
-                sid for sid in student_ids if sid not in estudiantes_activos_reciente]
-
-            # Obtener datos de los estudiantes inactivos
-            if estudiantes_sin_actividad_ids:
-                estudiantes_sin_actividad_cursor = mongo.db.usuarios.find(
-                    {"_id": {"$in": [ObjectId(sid)
-                                     for sid in estudiantes_sin_actividad_ids]}},
-                    {"nombre_completo": 1, "numero_control": 1,
-                        "email": 1}  # Puedes incluir más info
-                )
-                # Limitar a 5 para no abrumar
-                stats_resumen['estudiantes_sin_actividad'] = list(
-                    estudiantes_sin_actividad_cursor)[:5]
+        grupos, estudiantes, stats_resumen = resumen_tutor(str(user['_id']))
 
         # Pasar todos los datos a la plantilla
         return render_template(
@@ -280,21 +2061,13 @@ def dashboard():
 
     elif user['rol'] == 'estudiante':
         # Obtener hábitos activos base y personales
-        habitos_base = list(mongo.db.habitos.find(
-            {"activo": True, "tipo": "base"}))
-        habitos_personales = list(mongo.db.habitos.find({
-            "usuario_id": str(user['_id']),
-            "tipo": "personal",
-            "activo": True
-        }))
+        habitos_base = obtener_habitos_base(user['_id'])
+        habitos_personales = obtener_habitos_personales(user['_id'])
 
         # --- NUEVO: Obtener registros del estudiante para hoy ---
         from datetime import date
-        hoy = date.today().isoformat()
-        registros_hoy_cursor = mongo.db.registros_habitos.find({
-            "usuario_id": str(user['_id']),
-            "fecha": hoy
-        })
+        hoy = date.today()
+        registros_hoy_cursor = leer_registros([str(user['_id'])], hoy, hoy)
 
         # Convertir los registros a un diccionario para fácil acceso {habito_id: registro}
         registros_hoy_dict = {}
@@ -308,6 +2081,7 @@ def dashboard():
                                habitos_base=habitos_base,
                                habitos_personales=habitos_personales,
                                registros_hoy=registros_hoy_dict,  # Nuevo argumento
+                               rachas=rachas_usuario(str(user['_id'])),
                                dashboard_type='estudiante')
 
     else:
@@ -317,189 +2091,240 @@ def dashboard():
 
 @app.route('/calendar')
 def calendar_view():
-    """Muestra la vista de calendario para el estudiante."""
+    """Muestra la vista de calendario para el estudiante.
+
+    Entrega el mes pedido (?mes=AAAA-MM, por omisión el actual) ya resumido;
+    la navegación entre meses se hace en el navegador con /api/calendar.
+    """
     user = get_current_user()
     if not user or user['rol'] != 'estudiante':
         flash('Acceso denegado.', 'error')
         return redirect(url_for('login'))
 
-    # Obtener el mes y año actuales
+    # Obtener el mes y año (actuales si no se pide otro)
     today = date.today()
-    year = today.year
-    month = today.month
-
-    # 1. Obtener el primer y último día del mes
-    # CORRECCION: Usar el módulo calendar correctamente
-    first_day = date(year, month, 1)
-    # Usar calendar.monthrange (del MODULO calendar) para obtener el último día
-    last_day_num = calendar.monthrange(
-        year, month)[1]  # <--- Aquí estaba el error
-    last_day = date(year, month, last_day_num)
-
-    # 2. Obtener registros del estudiante para todo el mes
-    registros_mes_cursor = mongo.db.registros_habitos.find({
-        "usuario_id": str(user['_id']),
-        "fecha": {
-            "$gte": first_day.isoformat(),
-            "$lte": last_day.isoformat()
-        }
-    })
-
-    # 3. Procesar registros
-    registros_por_dia = {}
-    fechas_con_registros = set()
-
-    # Obtener hábitos activos
-    habitos_activos_base_ids = [str(h['_id']) for h in mongo.db.habitos.find(
-        {"activo": True, "tipo": "base"}, {"_id": 1})]
-    habitos_activos_personal_ids = [str(h['_id']) for h in mongo.db.habitos.find({
-        "usuario_id": str(user['_id']),
-        "tipo": "personal",
-        "activo": True
-    }, {"_id": 1})]
-    total_habitos_activos = len(
-        habitos_activos_base_ids) + len(habitos_activos_personal_ids)
-
-    # Manejar caso de división por cero si no hay hábitos activos
-    if total_habitos_activos == 0:
-        total_habitos_activos = 1  # Evitar división por cero, el progreso será 0% o 100%
-
-    for registro in registros_mes_cursor:
-        fecha_str = registro['fecha']
-        if fecha_str not in registros_por_dia:
-            registros_por_dia[fecha_str] = []
-        registros_por_dia[fecha_str].append(registro)
-        fechas_con_registros.add(fecha_str)
-
-    # 4. Generar datos del calendario usando el MODULO calendar
-    cal_matrix = calendar.monthcalendar(year, month)  # <--- También aquí
-
-    # Información para la plantilla
-    mes_nombre = first_day.strftime('%B').capitalize()
-    mes_nombre_es = {
-        'January': 'Enero', 'February': 'Febrero', 'March': 'Marzo',
-        'April': 'Abril', 'May': 'Mayo', 'June': 'Junio',
-        'July': 'Julio', 'August': 'Agosto', 'September': 'Septiembre',
-        'October': 'Octubre', 'November': 'Noviembre', 'December': 'Diciembre'
-    }.get(mes_nombre, mes_nombre)
-
-    dias_semana_es = ['Lu', 'Ma', 'Mi', 'Ju', 'Vi', 'Sa', 'Do']
+    try:
+        first_day = datetime.strptime(request.args.get('mes', ''), '%Y-%m').date()
+    except ValueError:
+        first_day = today.replace(day=1)
+    last_day = first_day.replace(
+        day=calendar.monthrange(first_day.year, first_day.month)[1])
+
+    calendario = {
+        'anio': first_day.year,
+        'mes': first_day.month,
+        'hoy': today.isoformat(),
+        'estados': ['total'] + ESTADOS_REGISTRO,
+        'total_habitos_activos': total_habitos_activos(user['_id']),
+        'dias': resumen_calendario(str(user['_id']), first_day, last_day)
+    }
 
     return render_template(
         'student_calendar.html',
         user=user,
-        year=year,
-        month=month,
-        mes_nombre_es=mes_nombre_es,
-        dias_semana_es=dias_semana_es,
-        calendar_matrix=cal_matrix,
-        registros_por_dia=registros_por_dia,
-        fechas_con_registros=fechas_con_registros,
-        total_habitos_activos=total_habitos_activos,
-        today=today
+        calendario=calendario,
+        dias_semana_es=['Lu', 'Ma', 'Mi', 'Ju', 'Vi', 'Sa', 'Do']
     )
 
 
-@app.route('/stats')
-def stats():
-    """Muestra estadísticas generales para el tutor (por grupo)."""
-    user = get_current_user()
-    if not user or user['rol'] != 'tutor':
-        flash('Acceso denegado.', 'error')
-        return redirect(url_for('login'))
+# Rango máximo que acepta /api/calendar (un año)
+CALENDARIO_MAX_DIAS = 366
 
-    # Obtener grupos asignados al tutor
-    grupos = list(mongo.db.grupos.find({"tutor_id": str(user['_id'])}))
 
-    # Para cada grupo, calcular estadísticas
-    stats_por_grupo = []
-    for grupo in grupos:
-        grupo_id = str(grupo['_id'])
-        nombre_grupo = grupo['nombre']
-
-        # Obtener IDs de estudiantes del grupo
-        student_ids_str = grupo.get('estudiante_ids', [])
-        if not student_ids_str:
-            # Si no hay estudiantes, estadísticas vacías
-            stats_por_grupo.append({
-                'grupo_id': grupo_id,
-                'nombre_grupo': nombre_grupo,
-                'num_estudiantes': 0,
-                'promedio_cumplimiento': 0.0,
-                'estudiantes_data': []  # Para detalles si se expande
-            })
-            continue
+def total_habitos_activos(usuario_id):
+    """Número de hábitos activos (base + personales) del estudiante, mínimo 1."""
+    total = len(obtener_habitos_base(usuario_id)) + \
+        len(obtener_habitos_personales(usuario_id))
+    # Evitar división por cero al calcular el progreso
+    return total or 1
 
-        student_ids_oid = [ObjectId(sid) for sid in student_ids_str]
 
-        # Obtener datos de estudiantes
-        estudiantes_grupo = list(mongo.db.usuarios.find(
-            {"_id": {"$in": student_ids_oid}},
-            {"nombre_completo": 1, "numero_control": 1}
-        ))
+def resumen_calendario(usuario_id, desde, hasta):
+    """Resumen compacto por día de un rango de fechas del estudiante.
 
-        # Obtener hábitos activos base (los personales son muy individuales para stats grupales)
-        habitos_activos_base_ids = [str(h['_id']) for h in mongo.db.habitos.find(
-            {"activo": True, "tipo": "base"}, {"_id": 1})]
-        total_habitos_base = len(habitos_activos_base_ids)
+    Lee resumen_diario con un solo rango sobre el índice (usuario_id, fecha),
+    así que un año cuesta como mucho 366 documentos pequeños; en modo mensual,
+    12 documentos de registros_mensuales. Devuelve
+    {fecha: [total, cumplido, incumplido, no_aplica]} solo para los días con
+    registros.
+    """
+    dias = {}
+    if almacen_mensual():
+        # Un documento por mes trae todos los registros del rango
+        resumenes = resumenes_de_registros(leer_registros([usuario_id], desde, hasta))
+    else:
+        resumenes = mongo.db.resumen_diario.find({
+            "usuario_id": usuario_id,
+            "fecha": {"$gte": desde.isoformat(), "$lte": hasta.isoformat()}
+        }, {"_id": 0, "fecha": 1, "total": 1, "estados": 1})
+    for resumen in resumenes:
+        if resumen.get('total', 0) > 0:
+            estados = resumen.get('estados', {})
+            dias[resumen['fecha']] = [resumen['total']] + \
+                [estados.get(estado, 0) for estado in ESTADOS_REGISTRO]
+    return dias
+
+
+@app.route('/api/calendar')
+def api_calendar():
+    """Resumen por día del estudiante entre ?from= y ?to= (AAAA-MM-DD, inclusive)."""
+    user = usuario_sesion()
+    if not user or user['rol'] != 'estudiante':
+        return jsonify({"error": "Acceso denegado"}), 403
 
-        if total_habitos_base == 0:
-            total_habitos_base = 1  # Evitar división por cero
+    try:
+        desde = date.fromisoformat(request.args.get('from', ''))
+        hasta = date.fromisoformat(request.args.get('to', ''))
+    except ValueError:
+        return jsonify({"error": "Fechas inválidas, use el formato AAAA-MM-DD"}), 400
+    if hasta < desde or (hasta - desde).days >= CALENDARIO_MAX_DIAS:
+        return jsonify({"error": f"El rango debe ser de 1 a {CALENDARIO_MAX_DIAS} días"}), 400
+
+    return jsonify({
+        "desde": desde.isoformat(),
+        "hasta": hasta.isoformat(),
+        "estados": ['total'] + ESTADOS_REGISTRO,
+        "total_habitos_activos": total_habitos_activos(user['_id']),
+        "dias": resumen_calendario(str(user['_id']), desde, hasta)
+    })
 
-        # Obtener registros de los últimos 30 días para estos estudiantes y hábitos base
-        hace_30_dias = date.today() - timedelta(days=30)
-        registros_recientes = list(mongo.db.registros_habitos.find({
-            "usuario_id": {"$in": student_ids_str},
-            "habito_id": {"$in": habitos_activos_base_ids},
-            "fecha": {"$gte": hace_30_dias.isoformat()}
-        }))
-
-        # Calcular estadísticas
-        # 1. Promedio de cumplimiento del grupo
-        total_registros_esperados = len(
-            student_ids_str) * total_habitos_base * 30  # Aproximación
-        total_registros_reales = len(registros_recientes)
 
+def estadisticas_grupos(grupos, dias=30, dias_semana=7):
+    """Calcula el cumplimiento por grupo y por estudiante en una sola pasada.
+
+    Hace dos consultas sin importar cuántos grupos o estudiantes haya (el
+    catálogo de hábitos base sale de la caché): los estudiantes de todos los
+    grupos (por el índice de grupo_id) y un $group por usuario_id sobre
+    resumen_diario que suma sus registros de hábitos base activos del
+    periodo de `dias` días y, con un $cond, los de los últimos `dias_semana`
+    días. El resto se resuelve con diccionarios, en tiempo lineal.
+    """
+    # Hábitos activos base (los personales son muy individuales para stats grupales)
+    habitos_base = obtener_habitos_base()
+    total_habitos_base = len(habitos_base) or 1  # Evitar división por cero
+    # Registros del día de los hábitos base que siguen activos
+    registros_base = {"$add": [{"$ifNull": [f"$base.{h['_id']}", 0]} for h in habitos_base]}
+
+    # Estudiantes de todos los grupos, repartidos por grupo
+    estudiantes_por_grupo = {str(grupo['_id']): [] for grupo in grupos}
+    todos_ids = []
+    if estudiantes_por_grupo:
+        for estudiante in mongo.db.usuarios.find(
+                {"grupo_id": {"$in": list(estudiantes_por_grupo)}},
+                {"nombre_completo": 1, "numero_control": 1, "grupo_id": 1}):
+            estudiantes_por_grupo[estudiante['grupo_id']].append(estudiante)
+            todos_ids.append(str(estudiante['_id']))
+
+    registros_por_estudiante = {}
+    registros_semana = {}
+    if todos_ids:
+        # Registros de hábitos base del periodo por estudiante, desde el resumen diario
+        desde = date.today() - timedelta(days=dias)
+        desde_semana = date.today() - timedelta(days=dias_semana)
+        for r in mongo.db.resumen_diario.aggregate([
+            {"$match": {
+                "usuario_id": {"$in": todos_ids},
+                "fecha": {"$gte": min(desde, desde_semana).isoformat()}
+            }},
+            {"$group": {
+                "_id": "$usuario_id",
+                "total": {"$sum": {"$cond": [
+                    {"$gte": ["$fecha", desde.isoformat()]}, registros_base, 0]}},
+                "semana": {"$sum": {"$cond": [
+                    {"$gte": ["$fecha", desde_semana.isoformat()]}, registros_base, 0]}}
+            }}
+        ]):
+            registros_por_estudiante[r['_id']] = r['total']
+            registros_semana[r['_id']] = r['semana']
+
+    registros_esperados_est = total_habitos_base * dias  # Aproximación
+    stats_por_grupo = []
+    for grupo in grupos:
+        grupo_id = str(grupo['_id'])
+        estudiantes_grupo = estudiantes_por_grupo[grupo_id]
+
+        # 1. Promedio de cumplimiento del grupo (del periodo y de la última semana)
+        total_registros_esperados = len(estudiantes_grupo) * registros_esperados_est
+        total_registros_reales = sum(
+            registros_por_estudiante.get(str(e['_id']), 0) for e in estudiantes_grupo)
         if total_registros_esperados > 0:
             promedio_cumplimiento = (
                 total_registros_reales / total_registros_esperados) * 100
         else:
             promedio_cumplimiento = 0.0
+        total_semana = sum(registros_semana.get(str(e['_id']), 0) for e in estudiantes_grupo)
+        esperados_semana = len(estudiantes_grupo) * total_habitos_base * dias_semana
+        promedio_semana = (total_semana / esperados_semana) * 100 if esperados_semana else 0.0
 
         # 2. Datos por estudiante (para futuras visualizaciones)
         estudiantes_data = []
         for estudiante in estudiantes_grupo:
             est_id = str(estudiante['_id'])
-            # Contar registros de este estudiante en el periodo
-            registros_estudiante = [
-                r for r in registros_recientes if r['usuario_id'] == est_id]
-            # Calcular su propio promedio
-            registros_esperados_est = total_habitos_base * 30
-            if registros_esperados_est > 0:
-                promedio_estudiante = (
-                    len(registros_estudiante) / registros_esperados_est) * 100
-            else:
-                promedio_estudiante = 0.0
-
+            promedio_estudiante = (
+                registros_por_estudiante.get(est_id, 0) / registros_esperados_est) * 100
             estudiantes_data.append({
                 'id': est_id,
                 'nombre': estudiante['nombre_completo'],
                 'numero_control': estudiante['numero_control'],
-                'promedio': round(promedio_estudiante, 2)
+                'promedio': round(promedio_estudiante, 2),
+                'promedio_semana': round(registros_semana.get(est_id, 0) / (
+                    total_habitos_base * dias_semana) * 100, 2)
             })
 
         stats_por_grupo.append({
             'grupo_id': grupo_id,
-            'nombre_grupo': nombre_grupo,
+            'nombre_grupo': grupo['nombre'],
             'num_estudiantes': len(estudiantes_grupo),
             'promedio_cumplimiento': round(promedio_cumplimiento, 2),
-            'estudiantes_data': estudiantes_data
+            'registros_semana': total_semana,
+            'promedio_semana': round(promedio_semana, 2),
+            'estudiantes_data': estudiantes_data  # Para detalles si se expande
         })
 
-    return render_template('tutor_stats.html', user=user, stats_por_grupo=stats_por_grupo)
+    return stats_por_grupo
+
+
+@app.route('/stats')
+@cache_tutor
+def stats():
+    """Muestra estadísticas generales para el tutor (por grupo)."""
+    user = get_current_user()
+    if not user or user['rol'] != 'tutor':
+        flash('Acceso denegado.', 'error')
+        return redirect(url_for('login'))
+
+    # Estadísticas de los grupos asignados al tutor, desde los reportes precalculados
+    reporte = reporte_tutor(str(user['_id']))
+    stats_por_grupo = reportes_grupos(reporte)
+
+    return render_template('tutor_stats.html', user=user, stats_por_grupo=stats_por_grupo,
+                           reporte_calculado=reporte['calculado'])
+
+
+@app.route('/tutor/reportes/actualizar', methods=['POST'])
+def actualizar_reportes():
+    """Recalcula en el momento los reportes del tutor y vuelve a la vista anterior."""
+    user = get_current_user()
+    if not user or user['rol'] != 'tutor':
+        flash('Acceso denegado.', 'error')
+        return redirect(url_for('login'))
+    try:
+        tutor_id = str(user['_id'])
+        # Las vistas cacheadas del tutor deben mostrar los reportes nuevos
+        for grupo_id in calcular_reportes(tutor_id)[tutor_id]['grupos']:
+            invalidar_respuestas_grupo(grupo_id)
+        flash('Estadísticas actualizadas.', 'success')
+    except Exception as e:
+        app.logger.error(f"Error al actualizar reportes del tutor {user['_id']}: {e}")
+        flash('No se pudieron actualizar las estadísticas.', 'error')
+    destino = request.form.get('siguiente')
+    if destino not in ('dashboard', 'stats'):
+        destino = 'dashboard'
+    return redirect(url_for(destino))
 
 
 @app.route('/stats/user/<user_id>')
+@cache_tutor
 def stats_user(user_id):
     """Muestra estadísticas detalladas de un estudiante específico."""
     tutor = get_current_user()
@@ -508,24 +2333,24 @@ def stats_user(user_id):
         return redirect(url_for('login'))
 
     try:
-        # Verificar que el estudiante pertenece a un grupo del tutor
-        # 1. Obtener grupos del tutor
-        grupos_tutor_ids = [g['_id'] for g in mongo.db.grupos.find(
-            {"tutor_id": str(tutor['_id'])}, {"_id": 1})]
-        # 2. Verificar si el estudiante está en alguno de esos grupos
-        estudiante_obj = mongo.db.usuarios.find_one({
-            "_id": ObjectId(user_id),
-            "rol": "estudiante"
-        })
+        # Verificar que el estudiante pertenece a un grupo del tutor: el
+        # estudiante y los grupos del tutor se leen a la vez
+        estudiante_oid = ObjectId(user_id)
+        datos = en_paralelo(
+            estudiante=lambda: mongo.db.usuarios.find_one({
+                "_id": estudiante_oid,
+                "rol": "estudiante"
+            }),
+            grupos_tutor=lambda: {str(gr['_id']) for gr in mongo.db.grupos.find(
+                {"tutor_id": str(tutor['_id'])}, {"_id": 1})}
+        )
+        estudiante_obj = datos['estudiante']
         if not estudiante_obj:
             flash('Estudiante no encontrado.', 'error')
             return redirect(url_for('stats'))  # O al dashboard
 
-        # Verificar pertenencia a grupo
-        pertenece_al_tutor = mongo.db.grupos.find_one({
-            "_id": {"$in": grupos_tutor_ids},
-            "estudiante_ids": user_id
-        })
+        # Verificar pertenencia a grupo: el grupo del estudiante debe ser del tutor
+        pertenece_al_tutor = estudiante_obj.get('grupo_id') in datos['grupos_tutor']
         if not pertenece_al_tutor:
             flash(
                 'No tienes permiso para ver las estadísticas de este estudiante.', 'error')
@@ -534,52 +2359,51 @@ def stats_user(user_id):
         # --- Recopilar datos del estudiante ---
         estudiante = estudiante_obj
 
-        # 1. Obtener hábitos activos base y personales del estudiante
-        habitos_base = list(mongo.db.habitos.find(
-            {"activo": True, "tipo": "base"}))
-        habitos_personales = list(mongo.db.habitos.find({
-            "usuario_id": user_id,
-            "tipo": "personal",
-            "activo": True
-        }))
-
-        # 2. Obtener registros de los últimos 30 días
+        # 1. Hábitos activos (base y personales), resumen diario de los últimos
+        # 30 días y registros de los últimos 7, en paralelo
         hace_30_dias = date.today() - timedelta(days=30)
-        registros_30_dias = list(mongo.db.registros_habitos.find({
-            "usuario_id": user_id,
-            "fecha": {"$gte": hace_30_dias.isoformat()}
-        }).sort("fecha", 1))  # Ordenar por fecha
+        hace_7_dias = date.today() - timedelta(days=7)
+        consultas = {
+            # Juntos, para compartir la lectura de versiones del catálogo
+            'habitos': lambda: (obtener_habitos_base(user_id),
+                                obtener_habitos_personales(user_id)),
+            'rachas': lambda: rachas_usuario(user_id)
+        }
+        if almacen_mensual():
+            # Los documentos de los meses traen los registros y, agrupándolos,
+            # los resúmenes por día: una sola lectura de uno o dos documentos
+            consultas['registros'] = lambda: list(leer_registros([user_id], hace_30_dias))
+        else:
+            consultas['resumenes'] = lambda: list(mongo.db.resumen_diario.find({
+                "usuario_id": user_id,
+                "fecha": {"$gte": hace_30_dias.isoformat()}
+            }).sort("fecha", 1))  # Ordenar por fecha
+            consultas['registros'] = lambda: list(leer_registros([user_id], hace_7_dias))
+        datos = en_paralelo(**consultas)
+        habitos_base, habitos_personales = datos['habitos']
+        if almacen_mensual():
+            resumenes_30_dias = resumenes_de_registros(datos['registros'])
+            registros_7_dias = [r for r in datos['registros']
+                                if r['fecha'] >= hace_7_dias.isoformat()]
+        else:
+            resumenes_30_dias = datos['resumenes']
+            registros_7_dias = datos['registros']
 
         # 3. Procesar datos para la vista
         # a. Conteo por estado en los últimos 30 días
         conteo_estados = {'cumplido': 0, 'incumplido': 0, 'no_aplica': 0}
-        for registro in registros_30_dias:
-            estado = registro.get('estado')
-            if estado in conteo_estados:
-                conteo_estados[estado] += 1
+        for resumen in resumenes_30_dias:
+            for estado, cantidad in resumen.get('estados', {}).items():
+                if estado in conteo_estados:
+                    conteo_estados[estado] += cantidad
 
         # b. Progreso por día (para gráfico)
-        # Crear un diccionario {fecha: conteo_cumplidos}
-        registros_por_fecha = {}
-        for registro in registros_30_dias:
-            fecha = registro['fecha']
-            if fecha not in registros_por_fecha:
-                registros_por_fecha[fecha] = {'cumplido': 0, 'total': 0}
-            registros_por_fecha[fecha]['total'] += 1
-            if registro['estado'] == 'cumplido':
-                registros_por_fecha[fecha]['cumplido'] += 1
-
-        # Convertir a listas ordenadas para el gráfico
-        fechas_chart = sorted(registros_por_fecha.keys())
-        cumplidos_chart = [registros_por_fecha[f]['cumplido']
-                           for f in fechas_chart]
-        totales_chart = [registros_por_fecha[f]['total'] for f in fechas_chart]
+        fechas_chart = [r['fecha'] for r in resumenes_30_dias]
+        cumplidos_chart = [r.get('estados', {}).get('cumplido', 0)
+                           for r in resumenes_30_dias]
+        totales_chart = [r.get('total', 0) for r in resumenes_30_dias]
 
         # c. Progreso por hábito (últimos 7 días como ejemplo)
-        hace_7_dias = date.today() - timedelta(days=7)
-        registros_7_dias = [
-            r for r in registros_30_dias if r['fecha'] >= hace_7_dias.isoformat()]
-
         progreso_por_habito = {}
         # Inicializar con todos los hábitos activos
         for habito in habitos_base + habitos_personales:
@@ -588,7 +2412,8 @@ def stats_user(user_id):
                 'categoria': habito['categoria'],
                 'tipo': habito['tipo'],
                 'cumplido': 0,
-                'total': 0
+                'total': 0,
+                'racha': datos['rachas'].get(str(habito['_id']), {'actual': 0, 'maxima': 0})
             }
         # Contar registros
         for registro in registros_7_dias:
@@ -622,6 +2447,57 @@ def stats_user(user_id):
         progreso_por_habito=progreso_por_habito
     )
 
+
+CRITERIOS_RIESGO = ('inactividad', 'cumplimiento')
+
+
+@app.route('/tutor/en-riesgo')
+@cache_tutor
+def estudiantes_en_riesgo():
+    """Lista paginada de estudiantes en riesgo de todos los grupos del tutor.
+
+    `criterio=inactividad` muestra a quienes no registran hábitos desde hace
+    `dias` días; `criterio=cumplimiento`, a quienes tienen un cumplimiento
+    menor a `umbral` % en los últimos CUMPLIMIENTO_DIAS días, según el último
+    cálculo de los reportes.
+    """
+    user = get_current_user()
+    if not user or user['rol'] != 'tutor':
+        flash('Acceso denegado.', 'error')
+        return redirect(url_for('login'))
+
+    criterio = request.args.get('criterio', 'inactividad')
+    if criterio not in CRITERIOS_RIESGO:
+        criterio = 'inactividad'
+    dias = min(max(request.args.get('dias', 7, type=int), 1), 365)
+    umbral = min(max(request.args.get('umbral', 50, type=int), 0), 100)
+    despues = request.args.get('despues')
+    tamano = app.config['RIESGO_PAGINA_TAMANO']
+
+    grupos = {str(gr['_id']): gr['nombre'] for gr in
+              mongo.db.grupos.find({"tutor_id": str(user['_id'])}, {"nombre": 1})}
+    estudiantes, hay_siguiente, reporte_calculado = [], False, None
+    try:
+        if grupos and criterio == 'inactividad':
+            estudiantes, hay_siguiente = estudiantes_inactivos(
+                list(grupos), dias, despues, tamano)
+        elif grupos:
+            reporte_calculado = reporte_tutor(str(user['_id']))['calculado']
+            estudiantes, hay_siguiente = estudiantes_bajo_cumplimiento(
+                list(grupos), umbral, despues, tamano)
+    except Exception as e:
+        app.logger.error(f"Error al buscar estudiantes en riesgo: {e}")
+        flash('Ocurrió un error al buscar estudiantes en riesgo.', 'error')
+
+    for estudiante in estudiantes:
+        estudiante['grupo'] = grupos.get(estudiante.get('grupo_id'), '')
+
+    return render_template('tutor_en_riesgo.html', user=user, estudiantes=estudiantes,
+                           hay_siguiente=hay_siguiente, hay_anterior=bool(despues),
+                           criterio=criterio, dias=dias, umbral=umbral,
+                           cumplimiento_dias=CUMPLIMIENTO_DIAS,
+                           reporte_calculado=reporte_calculado)
+
 # -- Rutas para gestión de hábitos (ADMIN)
 
 
@@ -631,7 +2507,7 @@ def admin_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = get_current_user()
+        user = usuario_sesion()
         if not user:
             flash('Debes iniciar sesión.', 'error')
             return redirect(url_for('login'))
@@ -668,6 +2544,7 @@ def admin_toggle_habito(habit_id):
             {"_id": ObjectId(habit_id)},
             {"$set": {"activo": nuevo_estado}}
         )
+        invalidar_catalogo()
 
         estado_str = "activado" if nuevo_estado else "desactivado"
         flash(
@@ -710,6 +2587,7 @@ def admin_nuevo_habito():
         try:
             result = mongo.db.habitos.insert_one(nuevo_habito)
             if result.inserted_id:
+                invalidar_catalogo()
                 flash(f'Hábito "{nombre}" creado exitosamente.', 'success')
                 return redirect(url_for('admin_habitos'))
             else:
@@ -722,16 +2600,109 @@ def admin_nuevo_habito():
     # Si es GET, mostrar el formulario vacío
     return render_template('admin_nuevo_habito.html')
 
+# --- Listados paginados de usuarios (ADMIN)
+
+
+def filtro_busqueda_usuarios(q):
+    """Filtro de búsqueda por prefijo de nombre, email o número de control.
+
+    Cada rama es una expresión regular anclada al inicio, así que Mongo la
+    resuelve como un rango sobre el índice del campo correspondiente.
+    """
+    q = (q or '').strip()
+    if not q:
+        return {}
+    return {"$or": [
+        {"nombre_normalizado": {"$regex": "^" + re.escape(normalizar_nombre(q))}},
+        {"email": {"$regex": "^" + re.escape(q.lower())}},
+        # $type hace que la consulta pueda usar el índice parcial de numero_control
+        {"numero_control": {"$regex": "^" + re.escape(q.upper()), "$type": "string"}}
+    ]}
+
+
+def paginar_usuarios(filtro, proyeccion=None, despues=None, antes=None):
+    """Devuelve una página de usuarios ordenada por (nombre_normalizado, _id).
+
+    Usa paginación por llave (keyset): `despues` o `antes` es el _id del último
+    o del primer usuario de la página que se estaba viendo, y la consulta
+    continúa desde su posición en el índice en lugar de usar skip, así que
+    cada página cuesta lo mismo sin importar cuántas haya antes.
+
+    Devuelve (usuarios, hay_anterior, hay_siguiente).
+    """
+    tamano = app.config['ADMIN_PAGINA_TAMANO']
+    cursor_id = despues or antes
+    ref = None
+    if cursor_id:
+        try:
+            ref = mongo.db.usuarios.find_one({"_id": ObjectId(cursor_id)},
+                                             {"nombre_normalizado": 1})
+        except Exception:
+            ref = None
+
+    consulta = dict(filtro)
+    direccion = ASCENDING
+    if ref:
+        nombre = ref.get('nombre_normalizado', '')
+        op = "$gt" if despues else "$lt"
+        consulta = {"$and": [filtro, {"$or": [
+            {"nombre_normalizado": {op: nombre}},
+            {"nombre_normalizado": nombre, "_id": {op: ref['_id']}}
+        ]}]}
+        if antes:
+            direccion = DESCENDING
+
+    usuarios = list(mongo.db.usuarios.find(consulta, proyeccion)
+                    .sort([("nombre_normalizado", direccion), ("_id", direccion)])
+                    .limit(tamano + 1))
+    hay_mas = len(usuarios) > tamano
+    usuarios = usuarios[:tamano]
+    if ref and antes:
+        usuarios.reverse()
+        return usuarios, hay_mas, True
+    return usuarios, bool(ref), hay_mas
+
+
+def normalizar_nombres(lote=1000):
+    """Calcula nombre_normalizado para los usuarios que no lo tienen.
+
+    Devuelve el número de usuarios actualizados.
+    """
+    actualizados = 0
+    pendientes = mongo.db.usuarios.find({"nombre_normalizado": {"$exists": False}},
+                                        {"nombre_completo": 1})
+    while True:
+        bloque = list(islice(pendientes, lote))
+        if not bloque:
+            break
+        result = mongo.db.usuarios.bulk_write([
+            UpdateOne({"_id": u['_id']},
+                      {"$set": {"nombre_normalizado": normalizar_nombre(u.get('nombre_completo'))}})
+            for u in bloque
+        ], ordered=False)
+        actualizados += result.modified_count
+    return actualizados
+
+
+@app.cli.command('normalizar-nombres')
+def normalizar_nombres_command():
+    """Rellena usuarios.nombre_normalizado (orden y búsqueda de los listados)."""
+    actualizados = normalizar_nombres()
+    click.echo(f"{actualizados} usuarios actualizados.")
+
 # --- Rutas para gestión de tutores (ADMIN)
 
 
 @app.route('/admin/tutores')
 @admin_required
 def admin_gestionar_tutores():
-    """Muestra la lista de tutores."""
-    # Obtener todos los usuarios con rol 'tutor'
-    tutores = list(mongo.db.usuarios.find({"rol": "tutor"}))
-    return render_template('admin_tutores.html', tutores=tutores)
+    """Muestra la lista de tutores, paginada y con búsqueda (?q=)."""
+    q = request.args.get('q', '').strip()
+    filtro = {"rol": "tutor", **filtro_busqueda_usuarios(q)}
+    tutores, hay_anterior, hay_siguiente = paginar_usuarios(
+        filtro, despues=request.args.get('despues'), antes=request.args.get('antes'))
+    return render_template('admin_tutores.html', tutores=tutores, q=q,
+                           hay_anterior=hay_anterior, hay_siguiente=hay_siguiente)
 
 
 @app.route('/admin/tutores/nuevo', methods=['GET', 'POST'])
@@ -780,10 +2751,11 @@ def admin_nuevo_tutor():
 
         # Si todo es válido, crear el tutor
         try:
-            hashed_password = generate_password_hash(password)
+            hashed_password = passwords.generar_hash(password)
 
             nuevo_tutor = {
                 "nombre_completo": nombre_completo,
+                "nombre_normalizado": normalizar_nombre(nombre_completo),
                 "email": email,
                 "password": hashed_password,
                 "rol": "tutor",
@@ -800,6 +2772,14 @@ def admin_nuevo_tutor():
             else:
                 raise Exception("No se pudo insertar el documento.")
 
+        except passwords.ServicioOcupado:
+            flash(MENSAJE_SERVICIO_OCUPADO, 'warning')
+            return render_template('admin_nuevo_tutor.html',
+                                   nombre_completo=nombre_completo,
+                                   email=email,
+                                   rfc=rfc,
+                                   area_adscripcion=area_adscripcion,
+                                   acreditacion=acreditacion), 503
         except Exception as e:
             app.logger.error(f"Error al crear tutor: {e}")
             flash('Ocurrió un error al crear el tutor.', 'error')
@@ -859,6 +2839,7 @@ def admin_editar_tutor(tutor_id):
         try:
             update_data = {
                 "nombre_completo": nombre_completo,
+                "nombre_normalizado": normalizar_nombre(nombre_completo),
                 "email": email,
                 "rfc": rfc,
                 "area_adscripcion": area_adscripcion,
@@ -872,12 +2853,15 @@ def admin_editar_tutor(tutor_id):
             #     if len(nueva_password) < 6:
             #          flash('La nueva contraseña debe tener al menos 6 caracteres.', 'error')
             #          return render_template('admin_editar_tutor.html', tutor=tutor)
-            #     update_data['password'] = generate_password_hash(nueva_password)
+            #     update_data['password'] = passwords.generar_hash(nueva_password)
 
             result = mongo.db.usuarios.update_one(
                 {"_id": ObjectId(tutor_id)},
                 {"$set": update_data}
             )
+            invalidar_usuario(tutor_id)
+            refrescar_sesiones([tutor_id])  # Nombre y email (avatar) van en la sesión
+            invalidar_respuestas()
             if result.matched_count > 0:
                 flash(
                     f'Tutor "{nombre_completo}" actualizado exitosamente.', 'success')
@@ -918,6 +2902,9 @@ def admin_eliminar_tutor(tutor_id):
 
         # Proceder con la eliminación (¡Esto es irreversible!)
         result = mongo.db.usuarios.delete_one({"_id": ObjectId(tutor_id)})
+        invalidar_usuario(tutor_id)
+        revocar_sesiones(tutor_id)
+        invalidar_respuestas()
         if result.deleted_count > 0:
             flash(
                 f'Tutor "{tutor["nombre_completo"]}" eliminado exitosamente.', 'success')
@@ -932,30 +2919,55 @@ def admin_eliminar_tutor(tutor_id):
 # --- Rutas para gestión de grupos (ADMIN)
 
 
+# Campos por los que se puede ordenar la lista de grupos
+ORDEN_GRUPOS = {
+    'nombre': 'nombre',
+    'tutor': 'tutor_nombre',
+    'estudiantes': 'num_estudiantes'
+}
+
+
 @app.route('/admin/grupos')
 @admin_required
 def admin_gestionar_grupos():
-    """Muestra la lista de grupos."""
+    """Muestra la lista de grupos.
+
+    Se construye con una sola agregación ($lookup del tutor y conteo de
+    miembros por usuarios.grupo_id), así que el número
+    de consultas no depende de cuántos grupos existan. Acepta ?orden=nombre,
+    tutor o estudiantes y ?dir=asc o desc.
+    """
+    orden = request.args.get('orden', 'nombre')
+    if orden not in ORDEN_GRUPOS:
+        orden = 'nombre'
+    direccion = DESCENDING if request.args.get('dir') == 'desc' else ASCENDING
     try:
-        # Obtener todos los grupos
-        grupos_cursor = mongo.db.grupos.find()
-        grupos = []
-        for grupo in grupos_cursor:
-            # Obtener información del tutor
-            tutor = mongo.db.usuarios.find_one({"_id": ObjectId(grupo['tutor_id'])}, {
-                                               "nombre_completo": 1}) if grupo.get('tutor_id') else None
-            grupo['tutor_nombre'] = tutor['nombre_completo'] if tutor else 'No asignado'
-
+        grupos = list(mongo.db.grupos.aggregate([
             # Contar estudiantes
-            grupo['num_estudiantes'] = len(grupo.get('estudiante_ids', []))
-
-            grupos.append(grupo)
-
-        return render_template('admin_grupos.html', grupos=grupos)
+            {"$lookup": {
+                "from": "usuarios",
+                "let": {"gid": {"$toString": "$_id"}},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$grupo_id", "$$gid"]}}},
+                    {"$project": {"_id": 1}}
+                ],
+                "as": "miembros"
+            }},
+            {"$addFields": {"num_estudiantes": {"$size": "$miembros"}}},
+            # Obtener información del tutor
+            _lookup_usuario("$tutor_id", {"nombre_completo": 1}, "tutor"),
+            {"$addFields": {"tutor_nombre": {"$ifNull": [
+                {"$arrayElemAt": ["$tutor.nombre_completo", 0]}, "No asignado"]}}},
+            {"$project": {"tutor": 0, "miembros": 0}},
+            {"$sort": {ORDEN_GRUPOS[orden]: direccion, "_id": ASCENDING}}
+        ]))
+
+        return render_template('admin_grupos.html', grupos=grupos,
+                               orden=orden, direccion='desc' if direccion == DESCENDING else 'asc')
     except Exception as e:
         app.logger.error(f"Error al obtener grupos: {e}")
         flash('Ocurrió un error al cargar la lista de grupos.', 'error')
-        return render_template('admin_grupos.html', grupos=[])
+        return render_template('admin_grupos.html', grupos=[], orden='nombre', direccion='asc')
 
 
 @app.route('/admin/grupos/nuevo', methods=['GET', 'POST'])
@@ -980,8 +2992,7 @@ def admin_nuevo_grupo():
         nuevo_grupo = {
             "nombre": nombre,
             "ciclo_escolar": ciclo_escolar,
-            "tutor_id": None,  # Se asigna después
-            "estudiante_ids": []  # Lista vacía inicialmente
+            "tutor_id": None  # Se asigna después; los estudiantes guardan su grupo_id
         }
 
         try:
@@ -1037,6 +3048,8 @@ def admin_editar_grupo(grupo_id):
                 {"_id": ObjectId(grupo_id)},
                 {"$set": update_data}
             )
+            invalidar_respuestas()
+            vencer_reportes(grupo_id=grupo_id)
             if result.matched_count > 0:
                 flash(f'Grupo "{nombre}" actualizado exitosamente.', 'success')
                 return redirect(url_for('admin_gestionar_grupos'))
@@ -1062,8 +3075,14 @@ def admin_eliminar_grupo(grupo_id):
             flash('Grupo no encontrado.', 'error')
             return redirect(url_for('admin_gestionar_grupos'))
 
-        # Proceder con la eliminación
+        # Liberar a sus estudiantes y proceder con la eliminación
+        miembros = [u['_id'] for u in mongo.db.usuarios.find({"grupo_id": grupo_id}, {"_id": 1})]
+        mongo.db.usuarios.update_many({"grupo_id": grupo_id}, {"$unset": {"grupo_id": ""}})
         result = mongo.db.grupos.delete_one({"_id": ObjectId(grupo_id)})
+        if miembros:
+            refrescar_sesiones(miembros)  # El grupo va en la sesión de sus estudiantes
+        invalidar_respuestas()
+        vencer_reportes(grupo_id=grupo_id)
         if result.deleted_count > 0:
             flash(
                 f'Grupo "{grupo["nombre"]}" eliminado exitosamente.', 'success')
@@ -1099,6 +3118,8 @@ def admin_asignar_tutor(grupo_id):
                     {"_id": ObjectId(grupo_id)},
                     {"$set": {"tutor_id": None}}
                 )
+                invalidar_respuestas()
+                vencer_reportes(grupo_id=grupo_id)
                 flash('Tutor desasignado del grupo correctamente.', 'success')
                 return redirect(url_for('admin_gestionar_grupos'))
             except Exception as e:
@@ -1124,6 +3145,8 @@ def admin_asignar_tutor(grupo_id):
                 {"_id": ObjectId(grupo_id)},
                 {"$set": {"tutor_id": tutor_id}}
             )
+            invalidar_respuestas()
+            vencer_reportes(grupo_id=grupo_id, tutor_id=tutor_id)
             flash(
                 f'Tutor {tutor_obj["nombre_completo"]} asignado al grupo {grupo["nombre"]} correctamente.', 'success')
             return redirect(url_for('admin_gestionar_grupos'))
@@ -1145,7 +3168,11 @@ def admin_asignar_tutor(grupo_id):
 @app.route('/admin/grupos/gestionar_estudiantes/<grupo_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_gestionar_estudiantes(grupo_id):
-    """Agrega o elimina estudiantes de un grupo."""
+    """Agrega o elimina estudiantes de un grupo.
+
+    Los estudiantes sin grupo se muestran paginados como en
+    `paginar_usuarios`, con búsqueda por prefijo (?q=).
+    """
     try:
         grupo = mongo.db.grupos.find_one({"_id": ObjectId(grupo_id)})
         if not grupo:
@@ -1165,7 +3192,6 @@ def admin_gestionar_estudiantes(grupo_id):
 
         try:
             estudiante_oid = ObjectId(estudiante_id)
-            grupo_oid = ObjectId(grupo_id)
         except Exception:
             flash('ID de estudiante o grupo inválido.', 'error')
             return redirect(url_for('admin_gestionar_estudiantes', grupo_id=grupo_id))
@@ -1178,39 +3204,47 @@ def admin_gestionar_estudiantes(grupo_id):
                 flash('Estudiante no encontrado o no es válido.', 'error')
                 return redirect(url_for('admin_gestionar_estudiantes', grupo_id=grupo_id))
 
-            # Verificar que no esté ya en el grupo
-            if estudiante_id in grupo.get('estudiante_ids', []):
+            # Verificar que no esté ya en este u otro grupo
+            if estudiante.get('grupo_id') == grupo_id:
                 flash(
                     f'El estudiante {estudiante["nombre_completo"]} ya está en este grupo.', 'warning')
                 return redirect(url_for('admin_gestionar_estudiantes', grupo_id=grupo_id))
 
-            # Agregar al estudiante
+            # Agregar al estudiante (solo si sigue sin grupo, por si otro admin se adelantó)
             try:
-                mongo.db.grupos.update_one(
-                    {"_id": grupo_oid},
-                    # $addToSet evita duplicados
-                    {"$addToSet": {"estudiante_ids": estudiante_id}}
+                result = mongo.db.usuarios.update_one(
+                    {"_id": estudiante_oid, "grupo_id": None},
+                    {"$set": {"grupo_id": grupo_id}}
                 )
-                flash(
-                    f'Estudiante {estudiante["nombre_completo"]} agregado al grupo.', 'success')
+                invalidar_usuario(estudiante_id)
+                refrescar_sesiones([estudiante_id])  # El grupo va en la sesión del estudiante
+                invalidar_respuestas()
+                vencer_reportes(grupo_id=grupo_id)
+                if result.matched_count:
+                    flash(
+                        f'Estudiante {estudiante["nombre_completo"]} agregado al grupo.', 'success')
+                else:
+                    flash(
+                        f'El estudiante {estudiante["nombre_completo"]} ya pertenece a otro grupo.', 'warning')
             except Exception as e:
                 app.logger.error(f"Error al agregar estudiante: {e}")
                 flash('Ocurrió un error al agregar el estudiante.', 'error')
 
         elif action == 'eliminar':
-            # Verificar que el estudiante esté en el grupo
-            if estudiante_id not in grupo.get('estudiante_ids', []):
-                flash('El estudiante no está en este grupo.', 'warning')
-                return redirect(url_for('admin_gestionar_estudiantes', grupo_id=grupo_id))
-
-            # Eliminar del estudiante
+            # Eliminar del grupo (el filtro verifica que el estudiante esté en él)
             try:
-                mongo.db.grupos.update_one(
-                    {"_id": grupo_oid},
-                    # $pull elimina el elemento
-                    {"$pull": {"estudiante_ids": estudiante_id}}
+                result = mongo.db.usuarios.update_one(
+                    {"_id": estudiante_oid, "grupo_id": grupo_id},
+                    {"$unset": {"grupo_id": ""}}
                 )
-                flash('Estudiante eliminado del grupo.', 'success')
+                invalidar_usuario(estudiante_id)
+                refrescar_sesiones([estudiante_id])  # El grupo va en la sesión del estudiante
+                invalidar_respuestas()
+                vencer_reportes(grupo_id=grupo_id)
+                if result.matched_count:
+                    flash('Estudiante eliminado del grupo.', 'success')
+                else:
+                    flash('El estudiante no está en este grupo.', 'warning')
             except Exception as e:
                 app.logger.error(f"Error al eliminar estudiante: {e}")
                 flash('Ocurrió un error al eliminar el estudiante.', 'error')
@@ -1219,53 +3253,69 @@ def admin_gestionar_estudiantes(grupo_id):
         return redirect(url_for('admin_gestionar_estudiantes', grupo_id=grupo_id))
 
     # Si es GET, mostrar el formulario
-    # Obtener lista de estudiantes en el grupo
-    estudiante_ids = [ObjectId(sid) for sid in grupo.get('estudiante_ids', [])]
-    estudiantes_en_grupo = []
-    if estudiante_ids:
-        estudiantes_en_grupo = list(mongo.db.usuarios.find(
-            {"_id": {"$in": estudiante_ids}},
+    q = request.args.get('q', '').strip()
+    listas = en_paralelo(
+        # Estudiantes en el grupo
+        en_grupo=lambda: list(mongo.db.usuarios.find(
+            {"grupo_id": grupo_id},
             {"nombre_completo": 1, "numero_control": 1}
-        ))
-
-    # Obtener IDs de estudiantes que ya están en algún grupo
-    grupos = list(mongo.db.grupos.find({}, {"estudiante_ids": 1}))
-    estudiantes_asignados = set()
-    for g in grupos:
-        estudiantes_asignados.update(g.get('estudiante_ids', []))
-
-    # Obtener lista de estudiantes NO asignados a ningún grupo
-    estudiantes_disponibles = list(mongo.db.usuarios.find(
-        {
-            "rol": "estudiante",
-            "_id": {"$nin": [ObjectId(sid) for sid in estudiantes_asignados]}
-        },
-        {"nombre_completo": 1, "numero_control": 1}
-    ))
+        )),
+        # Una página de estudiantes NO asignados a ningún grupo
+        # (grupo_id: None también coincide con documentos sin el campo)
+        disponibles=lambda: paginar_usuarios(
+            {"rol": "estudiante", "grupo_id": None, **filtro_busqueda_usuarios(q)},
+            {"nombre_completo": 1, "numero_control": 1},
+            despues=request.args.get('despues'), antes=request.args.get('antes'))
+    )
+    disponibles, hay_anterior, hay_siguiente = listas['disponibles']
 
     return render_template('admin_gestionar_estudiantes.html',
                            grupo=grupo,
-                           estudiantes_en_grupo=estudiantes_en_grupo,
-                           estudiantes_disponibles=estudiantes_disponibles)
+                           estudiantes_en_grupo=listas['en_grupo'],
+                           estudiantes_disponibles=disponibles,
+                           q=q, hay_anterior=hay_anterior, hay_siguiente=hay_siguiente)
 
 # -- Rutas para gestión de estudiantes (ADMIN)
 
 
+# Campos por los que se puede filtrar la lista de estudiantes
+FILTROS_ESTUDIANTES = ['carrera', 'semestre', 'generacion']
+
+
 @app.route('/admin/estudiantes')
 @admin_required
 def admin_gestionar_estudiantes_generales():
-    """Muestra la lista de todos los estudiantes."""
+    """Muestra la lista de estudiantes, paginada y con búsqueda.
+
+    Acepta ?q= (prefijo de nombre, email o número de control) y filtros
+    exactos por carrera, semestre y generación, cada uno con su índice.
+    """
+    q = request.args.get('q', '').strip()
+    filtros = {campo: request.args.get(campo, '').strip()
+               for campo in FILTROS_ESTUDIANTES}
+    filtros = {campo: valor for campo, valor in filtros.items() if valor}
     try:
-        # Obtener todos los usuarios con rol 'estudiante'
-        estudiantes = list(mongo.db.usuarios.find({"rol": "estudiante"}))
-        # Añadir avatar_url a cada estudiante
+        filtro = {"rol": "estudiante", **filtros, **filtro_busqueda_usuarios(q)}
+        estudiantes, hay_anterior, hay_siguiente = paginar_usuarios(
+            filtro,
+            {"nombre_completo": 1, "email": 1, "numero_control": 1,
+             "carrera": 1, "semestre": 1, "generacion": 1},
+            despues=request.args.get('despues'), antes=request.args.get('antes'))
+        # Añadir avatar_url a cada estudiante (solo los de la página)
         for est in estudiantes:
             est['avatar_url'] = get_avatar_url(est['email'])
-        return render_template('admin_estudiantes.html', estudiantes=estudiantes)
+        # Valores para los filtros (distinct se resuelve recorriendo el índice)
+        opciones = {campo: sorted(v for v in mongo.db.usuarios.distinct(campo, {"rol": "estudiante"}) if v)
+                    for campo in FILTROS_ESTUDIANTES}
+        return render_template('admin_estudiantes.html', estudiantes=estudiantes,
+                               q=q, filtros=filtros, opciones=opciones,
+                               hay_anterior=hay_anterior, hay_siguiente=hay_siguiente)
     except Exception as e:
         app.logger.error(f"Error al obtener estudiantes: {e}")
         flash('Ocurrió un error al cargar la lista de estudiantes.', 'error')
-        return render_template('admin_estudiantes.html', estudiantes=[])
+        return render_template('admin_estudiantes.html', estudiantes=[], q=q, filtros=filtros,
+                               opciones={campo: [] for campo in FILTROS_ESTUDIANTES},
+                               hay_anterior=False, hay_siguiente=False)
 
 
 @app.route('/admin/estudiantes/nuevo', methods=['GET', 'POST'])
@@ -1326,10 +3376,11 @@ def admin_nuevo_estudiante():
                 'Se ha establecido el número de control como contraseña temporal.', 'info')
 
         try:
-            hashed_password = generate_password_hash(password)
+            hashed_password = passwords.generar_hash(password)
 
             nuevo_estudiante = {
                 "nombre_completo": nombre_completo,
+                "nombre_normalizado": normalizar_nombre(nombre_completo),
                 "email": email,
                 "password": hashed_password,
                 "rol": "estudiante",
@@ -1349,6 +3400,15 @@ def admin_nuevo_estudiante():
             else:
                 raise Exception("No se pudo insertar el documento.")
 
+        except passwords.ServicioOcupado:
+            flash(MENSAJE_SERVICIO_OCUPADO, 'warning')
+            return render_template('admin_nuevo_estudiante.html',
+                                   nombre_completo=nombre_completo,
+                                   email=email,
+                                   numero_control=numero_control,
+                                   carrera=carrera,
+                                   semestre=semestre,
+                                   generacion=generacion), 503
         except Exception as e:
             app.logger.error(f"Error al crear estudiante: {e}")
             flash('Ocurrió un error al crear el estudiante.', 'error')
@@ -1374,11 +3434,17 @@ def admin_cambiar_password(user_id):
     if request.method == 'POST':
         nueva_password = request.form.get('nueva_password')
         if nueva_password and len(nueva_password) >= 6:
-            hash_pw = generate_password_hash(nueva_password)
+            try:
+                hash_pw = passwords.generar_hash(nueva_password)
+            except passwords.ServicioOcupado:
+                flash(MENSAJE_SERVICIO_OCUPADO, 'warning')
+                return render_template('admin_cambiar_password.html', usuario=usuario), 503
             mongo.db.usuarios.update_one(
                 {"_id": ObjectId(user_id)},
                 {"$set": {"password": hash_pw}}
             )
+            invalidar_usuario(user_id)
+            revocar_sesiones(user_id)
             flash('Contraseña actualizada correctamente.', 'success')
             return redirect(url_for('admin_gestionar_estudiantes_generales'))
         else:
@@ -1386,17 +3452,348 @@ def admin_cambiar_password(user_id):
     return render_template('admin_cambiar_password.html', usuario=usuario)
 
 
+COLUMNAS_LOTE_ESTUDIANTES = ['nombre_completo', 'email', 'numero_control',
+                             'carrera', 'semestre', 'generacion']
+
+
+def _leer_filas_lote(archivo):
+    """Genera (numero_fila, dict) leyendo el archivo subido fila por fila."""
+    nombre = (archivo.filename or '').lower()
+    if nombre.endswith('.xlsx'):
+        if openpyxl is None:
+            raise ValueError("Para cargar archivos .xlsx instala el paquete openpyxl.")
+        libro = openpyxl.load_workbook(archivo.stream, read_only=True, data_only=True)
+        filas = libro.active.iter_rows(values_only=True)
+        encabezados = [str(c or '').strip().lower() for c in next(filas, [])]
+        for numero, valores in enumerate(filas, start=2):
+            yield numero, {k: '' if v is None else str(v) for k, v in zip(encabezados, valores)}
+    elif nombre.endswith('.csv'):
+        texto = io.TextIOWrapper(archivo.stream, encoding='utf-8-sig', newline='')
+        lector = csv.DictReader(texto)
+        lector.fieldnames = [c.strip().lower() for c in lector.fieldnames or []]
+        for numero, fila in enumerate(lector, start=2):
+            yield numero, {k: v or '' for k, v in fila.items() if k}
+    else:
+        raise ValueError("Formato no soportado. Usa un archivo .csv o .xlsx.")
+
+
+def _importar_bloque(bloque, generar_passwords, resumen, vistos):
+    """Valida e inserta un bloque de filas de estudiantes.
+
+    Los duplicados contra la base se buscan con una sola consulta $in por
+    bloque, los hashes se generan en el pool de procesos y la inserción es un
+    insert_many no ordenado.
+    """
+    candidatos = []
+    for numero, fila in bloque:
+        estudiante = {
+            "nombre_completo": fila.get('nombre_completo', '').strip(),
+            "email": fila.get('email', '').strip().lower(),
+            "numero_control": fila.get('numero_control', '').strip().upper(),
+            "carrera": fila.get('carrera', '').strip(),
+            "semestre": fila.get('semestre', '').strip(),
+            "generacion": fila.get('generacion', '').strip()
+        }
+        errores = []
+        if not estudiante['nombre_completo']:
+            errores.append("El nombre completo es obligatorio.")
+        if not estudiante['email'] or "@" not in estudiante['email'] or "." not in estudiante['email']:
+            errores.append("El email no es válido.")
+        elif estudiante['email'] in vistos['emails']:
+            errores.append("Email repetido en el archivo.")
+        if not estudiante['numero_control']:
+            errores.append("El número de control es obligatorio.")
+        elif estudiante['numero_control'] in vistos['numeros_control']:
+            errores.append("Número de control repetido en el archivo.")
+        if estudiante['semestre'] and not estudiante['semestre'].isdigit():
+            errores.append("El semestre debe ser un número.")
+
+        vistos['emails'].add(estudiante['email'])
+        vistos['numeros_control'].add(estudiante['numero_control'])
+        if errores:
+            resumen['errores'].append((numero, ' '.join(errores)))
+        else:
+            candidatos.append((numero, estudiante))
+
+    if candidatos:
+        existentes = mongo.db.usuarios.find({"$or": [
+            {"email": {"$in": [e['email'] for _, e in candidatos]}},
+            {"numero_control": {"$in": [e['numero_control'] for _, e in candidatos]},
+             "rol": "estudiante"}
+        ]}, {"email": 1, "numero_control": 1})
+        emails_existentes = set()
+        numeros_existentes = set()
+        for usuario in existentes:
+            emails_existentes.add(usuario.get('email'))
+            numeros_existentes.add(usuario.get('numero_control'))
+
+        validos = []
+        for numero, estudiante in candidatos:
+            if estudiante['email'] in emails_existentes:
+                resumen['errores'].append((numero, "Ya existe un usuario con ese email."))
+            elif estudiante['numero_control'] in numeros_existentes:
+                resumen['errores'].append(
+                    (numero, "Ya existe un estudiante con ese número de control."))
+            else:
+                validos.append((numero, estudiante))
+        candidatos = validos
+
+    if candidatos:
+        if generar_passwords:
+            claves = [secrets.token_urlsafe(9) for _ in candidatos]
+        else:
+            # Usar el número de control como contraseña inicial
+            claves = [e['numero_control'] for _, e in candidatos]
+        hashes = passwords.hash_passwords(claves)
+
+        documentos = []
+        for (numero, estudiante), hash_pw in zip(candidatos, hashes):
+            documentos.append(dict(estudiante, password=hash_pw, rol="estudiante",
+                                   nombre_normalizado=normalizar_nombre(estudiante['nombre_completo'])))
+
+        fallidos = set()
+        try:
+            mongo.db.usuarios.insert_many(documentos, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                fallidos.add(error['index'])
+                resumen['errores'].append(
+                    (candidatos[error['index']][0], "El usuario ya existe (email o número de control duplicado)."))
+
+        for indice, ((numero, estudiante), clave) in enumerate(zip(candidatos, claves)):
+            if indice in fallidos:
+                continue
+            resumen['creados'] += 1
+            if generar_passwords:
+                resumen['credenciales'].append(
+                    (estudiante['numero_control'], estudiante['email'], clave))
+
+    resumen['procesadas'] += len(bloque)
+
+
+def importar_estudiantes(filas, generar_passwords, resumen):
+    """Procesa las filas por lotes y genera un mensaje de progreso por lote."""
+    tamano = app.config['IMPORT_LOTE_TAMANO']
+    vistos = {'emails': set(), 'numeros_control': set()}
+    try:
+        while True:
+            bloque = list(islice(filas, tamano))
+            if not bloque:
+                break
+            _importar_bloque(bloque, generar_passwords, resumen, vistos)
+            mensaje = (f"{resumen['procesadas']} filas procesadas, "
+                       f"{resumen['creados']} estudiantes creados, "
+                       f"{len(resumen['errores'])} errores.")
+            app.logger.info(f"Carga por lotes: {mensaje}")
+            yield mensaje
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        app.logger.error(f"Error al leer el archivo de carga por lotes: {e}")
+        yield f"La lectura del archivo se interrumpió: {e}"
+
+
 @app.route('/admin/estudiantes/cargar_lote', methods=['GET', 'POST'])
 @admin_required
 def admin_cargar_lote_estudiantes():
-    """Placeholder para la funcionalidad de carga por lotes."""
+    """Carga estudiantes desde un archivo CSV/XLSX.
+
+    El archivo se lee fila por fila y la página de resultados se envía en
+    streaming, con una línea de progreso por cada lote procesado.
+    """
     if request.method == 'POST':
-        # Aquí iría la lógica para procesar un archivo CSV/XLSX
-        # Por ahora, solo mostramos un mensaje.
-        flash('Funcionalidad de carga por lotes aún no implementada. Esta es una demostración.', 'warning')
-        return redirect(url_for('admin_gestionar_estudiantes_generales'))
+        archivo = request.files.get('archivo')
+        if not archivo or not archivo.filename:
+            flash('Selecciona un archivo para cargar.', 'error')
+            return redirect(url_for('admin_cargar_lote_estudiantes'))
+
+        filas = _leer_filas_lote(archivo)
+        try:
+            # Leer la primera fila ahora para reportar formatos inválidos antes del streaming
+            primera = next(filas, None)
+        except (ValueError, KeyError, UnicodeDecodeError, csv.Error) as e:
+            flash(f'No se pudo leer el archivo: {e}', 'error')
+            return redirect(url_for('admin_cargar_lote_estudiantes'))
+        if primera is None:
+            flash('El archivo no contiene estudiantes.', 'warning')
+            return redirect(url_for('admin_cargar_lote_estudiantes'))
+
+        def todas_las_filas():
+            yield primera
+            yield from filas
+
+        generar_passwords = 'generar_contraseñas' in request.form
+        resumen = {'procesadas': 0, 'creados': 0, 'errores': [], 'credenciales': []}
+        progreso = importar_estudiantes(todas_las_filas(), generar_passwords, resumen)
+        return app.response_class(stream_with_context(stream_template(
+            'admin_resultado_lote_estudiantes.html',
+            progreso=progreso,
+            resumen=resumen,
+            generar_passwords=generar_passwords
+        )))
+
+    return render_template('admin_cargar_lote_estudiantes.html',
+                           columnas=COLUMNAS_LOTE_ESTUDIANTES,
+                           xlsx_disponible=openpyxl is not None)
+
+
+# --- Exportación de registros ---
+
+COLUMNAS_EXPORTACION = ['fecha', 'numero_control', 'estudiante', 'habito', 'estado', 'nota']
+FORMATOS_EXPORTACION = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson'}
+EXPORTAR_FILAS_POR_BLOQUE = 1000  # Filas que se acumulan antes de entregar un bloque
+
+
+def estudiantes_exportacion(grupo_id=None, tutor_id=None):
+    """Mapa {usuario_id: (numero_control, nombre)} de los estudiantes a exportar.
+
+    Con `grupo_id` solo los de ese grupo; con `tutor_id` los de todos sus
+    grupos; sin ninguno, todos los estudiantes de la institución.
+    """
+    filtro = {"rol": "estudiante"}
+    if grupo_id:
+        filtro["grupo_id"] = grupo_id
+    elif tutor_id:
+        grupos = [str(g['_id']) for g in mongo.db.grupos.find({"tutor_id": tutor_id}, {"_id": 1})]
+        filtro["grupo_id"] = {"$in": grupos}
+    return {
+        str(e['_id']): (e.get('numero_control') or '', e.get('nombre_completo', ''))
+        for e in mongo.db.usuarios.find(
+            filtro, {"numero_control": 1, "nombre_completo": 1}).batch_size(
+                app.config['EXPORTAR_BATCH_SIZE'])
+    }
+
+
+def filas_exportacion(desde, hasta, estudiantes=None):
+    """Genera las filas de registros_habitos entre `desde` y `hasta` (inclusive).
+
+    `estudiantes` es el mapa de `estudiantes_exportacion`, o None para toda la
+    institución. Los nombres de hábitos y estudiantes salen de mapas en memoria,
+    así que por cada registro no hay otra consulta. `leer_registros` sigue el
+    orden de un índice, así que Mongo no ordena en memoria, y el cursor se lee
+    por lotes sin acumular resultados.
+    """
+    filtro_habitos = {}
+    usuario_ids = None
+    if estudiantes is not None:
+        usuario_ids = list(estudiantes)
+        filtro_habitos = {"$or": [{"tipo": "base"}, {"usuario_id": {"$in": usuario_ids}}]}
+    else:
+        estudiantes = estudiantes_exportacion()
+    habitos = {str(h['_id']): h.get('nombre', '')
+               for h in mongo.db.habitos.find(filtro_habitos, {"nombre": 1})}
+
+    for registro in leer_registros(usuario_ids, desde, hasta,
+                                   batch_size=app.config['EXPORTAR_BATCH_SIZE']):
+        numero_control, nombre = estudiantes.get(registro['usuario_id'], ('', ''))
+        yield [registro['fecha'], numero_control, nombre,
+               habitos.get(registro['habito_id'], ''), registro.get('estado', ''),
+               registro.get('nota') or '']
+
+
+def serializar_exportacion(filas, formato):
+    """Convierte las filas a bloques de texto CSV o JSONL.
+
+    Entrega un bloque cada EXPORTAR_FILAS_POR_BLOQUE filas, así que la memoria
+    no depende del total exportado.
+    """
+    bufer = io.StringIO()
+    if formato == 'csv':
+        escritor = csv.writer(bufer)
+        escribir = escritor.writerow
+        escritor.writerow(COLUMNAS_EXPORTACION)
+    else:
+        def escribir(fila):
+            bufer.write(json.dumps(dict(zip(COLUMNAS_EXPORTACION, fila)), ensure_ascii=False))
+            bufer.write('\n')
+
+    for i, fila in enumerate(filas, 1):
+        escribir(fila)
+        if i % EXPORTAR_FILAS_POR_BLOQUE == 0:
+            yield bufer.getvalue()
+            bufer.seek(0)
+            bufer.truncate()
+    if bufer.tell():
+        yield bufer.getvalue()
+
+
+def _parametros_exportacion(args):
+    """Valida desde/hasta/formato; por omisión los últimos 30 días en CSV."""
+    try:
+        hasta = date.fromisoformat(args['hasta']) if args.get('hasta') else date.today()
+        desde = date.fromisoformat(args['desde']) if args.get('desde') else hasta - timedelta(days=29)
+    except ValueError:
+        raise ValueError("Fechas inválidas, use el formato AAAA-MM-DD.")
+    if hasta < desde:
+        raise ValueError("La fecha inicial debe ser anterior a la final.")
+    formato = args.get('formato') or 'csv'
+    if formato not in FORMATOS_EXPORTACION:
+        raise ValueError(f"Formato no soportado: {formato}. Usa csv o jsonl.")
+    return desde, hasta, formato
+
+
+@app.route('/exportar/registros')
+def exportar_registros():
+    """Descarga los registros de hábitos de ?grupo=, ?tutor= o de toda la institución.
+
+    El administrador puede exportar cualquier alcance; el tutor solo sus
+    grupos (uno con ?grupo= o todos sin parámetros).
+    """
+    user = get_current_user()
+    if not user or user['rol'] not in ('tutor', 'administrador'):
+        flash('Acceso denegado.', 'error')
+        return redirect(url_for('login'))
 
-    return render_template('admin_cargar_lote_estudiantes.html')
+    try:
+        desde, hasta, formato = _parametros_exportacion(request.args)
+    except ValueError as e:
+        flash(f'Exportación inválida: {e}', 'error')
+        return redirect(url_for('dashboard'))
+
+    grupo_id = request.args.get('grupo')
+    tutor_id = request.args.get('tutor')
+    if user['rol'] == 'tutor':
+        tutor_id = str(user['_id'])
+    if grupo_id:
+        grupo = mongo.db.grupos.find_one(
+            {"_id": ObjectId(grupo_id)} if ObjectId.is_valid(grupo_id) else {"_id": None},
+            {"tutor_id": 1, "nombre": 1})
+        if not grupo or (user['rol'] == 'tutor' and grupo.get('tutor_id') != tutor_id):
+            flash('Grupo no encontrado.', 'error')
+            return redirect(url_for('dashboard'))
+        alcance = f"grupo_{grupo_id}"
+    elif tutor_id:
+        alcance = f"tutor_{tutor_id}"
+    else:
+        alcance = "institucion"
+
+    estudiantes = None if alcance == "institucion" else \
+        estudiantes_exportacion(grupo_id=grupo_id, tutor_id=tutor_id)
+    filas = filas_exportacion(desde, hasta, estudiantes)
+    respuesta = app.response_class(
+        stream_with_context(serializar_exportacion(filas, formato)),
+        content_type=FORMATOS_EXPORTACION[formato])
+    respuesta.headers['Content-Disposition'] = \
+        f'attachment; filename="registros_{alcance}_{desde}_{hasta}.{formato}"'
+    return respuesta
+
+
+@app.cli.command('exportar-registros')
+@click.option('--grupo', help='_id del grupo a exportar.')
+@click.option('--tutor', help='_id del tutor: exporta todos sus grupos.')
+@click.option('--desde', help='Fecha inicial AAAA-MM-DD (por omisión, hace 30 días).')
+@click.option('--hasta', help='Fecha final AAAA-MM-DD (por omisión, hoy).')
+@click.option('--formato', type=click.Choice(list(FORMATOS_EXPORTACION)), default='csv')
+@click.option('--salida', type=click.File('w', encoding='utf-8'), default='-',
+              help='Archivo de salida (por omisión, la salida estándar).')
+def exportar_registros_command(grupo, tutor, desde, hasta, formato, salida):
+    """Exporta registros de hábitos en CSV o JSONL sin cargarlos en memoria."""
+    try:
+        desde, hasta, formato = _parametros_exportacion(
+            {'desde': desde, 'hasta': hasta, 'formato': formato})
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    estudiantes = estudiantes_exportacion(grupo, tutor) if grupo or tutor else None
+    for bloque in serializar_exportacion(filas_exportacion(desde, hasta, estudiantes), formato):
+        salida.write(bloque)
 
 
 # --- API Endpoints ---
@@ -1404,7 +3801,7 @@ def admin_cargar_lote_estudiantes():
 
 @app.route('/api/registrar', methods=['POST'])
 def api_registrar():
-    user = get_current_user()
+    user = usuario_sesion()
     if not user or user['rol'] != 'estudiante':
         return jsonify({"error": "Acceso denegado"}), 403
 
@@ -1413,7 +3810,7 @@ def api_registrar():
     status = data.get('status')  # 'cumplido', 'incumplido', 'no_aplica'
     nota = data.get('nota', '')  # Opcional
 
-    if status not in ['cumplido', 'incumplido', 'no_aplica']:
+    if status not in ESTADOS_REGISTRO:
         return jsonify({"error": "Estado inválido"}), 400
 
     # Asegurarse de que el hábito pertenece al usuario o es base
@@ -1426,32 +3823,108 @@ def api_registrar():
     if not habit:
         return jsonify({"error": "Hábito no encontrado"}), 404
 
-    # Registrar en la colección de registros
-    registro = {
-        "usuario_id": str(user['_id']),
-        "habito_id": habit_id,
-        "fecha": date.today().isoformat(),
-        "estado": status,
-        "nota": nota
-    }
-
-    # Upsert: Si ya existe un registro para ese usuario, hábito y fecha, lo actualiza. Si no, lo crea.
-    mongo.db.registros_habitos.replace_one(
-        {
-            "usuario_id": str(user['_id']),
-            "habito_id": habit_id,
-            "fecha": date.today().isoformat()
-        },
-        registro,
-        upsert=True
-    )
+    # Upsert: si ya existe un registro para ese usuario, hábito y fecha, lo actualiza.
+    # Se recupera el estado anterior para actualizar el resumen diario con el cambio.
+    usuario_id = str(user['_id'])
+    hoy = date.today().isoformat()
+    anterior = guardar_registro(usuario_id, habit_id, hoy, status, nota)
+    actualizar_resumen_diario(usuario_id, hoy, _incrementos_resumen(habit, anterior, status))
+    racha = actualizar_rachas(usuario_id, hoy, {habit_id: status}).get(habit_id)
+    registrar_actividad(user)
+    invalidar_respuestas_grupo(user.get('grupo_id'))
+
+    return jsonify({"message": "Registro actualizado", "racha": racha}), 200
+
+
+@app.route('/api/registrar-lote', methods=['POST'])
+def api_registrar_lote():
+    """Registra varios hábitos del día en una sola petición.
+
+    Recibe {"registros": [{"habit_id", "status", "nota"}, ...]}. La pertenencia
+    de los hábitos se valida con una sola consulta $in y los registros se
+    escriben con un solo bulk_write de upserts condicionados al estado que
+    tenían (en modo mensual, un solo update del documento del mes). Devuelve
+    el resultado por elemento.
+    """
+    user = usuario_sesion()
+    if not user or user['rol'] != 'estudiante':
+        return jsonify({"error": "Acceso denegado"}), 403
 
-    return jsonify({"message": "Registro actualizado"}), 200
+    data = request.get_json(silent=True) or {}
+    items = data.get('registros')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Datos inválidos"}), 400
+    if len(items) > app.config['REGISTRO_LOTE_MAX']:
+        return jsonify({"error": "Demasiados registros en el lote"}), 400
+
+    usuario_id = str(user['_id'])
+    hoy = date.today().isoformat()
+    resultados = []
+    pendientes = {}  # {habit_id: indice en resultados}
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        habit_id = str(item.get('habit_id', ''))
+        resultado = {"habit_id": habit_id, "ok": False}
+        resultados.append(resultado)
+        if item.get('status') not in ESTADOS_REGISTRO:
+            resultado['error'] = "Estado inválido"
+        elif not ObjectId.is_valid(habit_id):
+            resultado['error'] = "Hábito no encontrado"
+        elif habit_id in pendientes:
+            resultado['error'] = "Hábito duplicado en el lote"
+        else:
+            pendientes[habit_id] = len(resultados) - 1
+
+    # Asegurarse de que los hábitos pertenecen al usuario o son base (una sola consulta)
+    habitos = {}
+    if pendientes:
+        habitos = {str(h['_id']): h for h in mongo.db.habitos.find({
+            "_id": {"$in": [ObjectId(hid) for hid in pendientes]},
+            "$or": [{"usuario_id": usuario_id}, {"tipo": "base"}]
+        }, {"categoria": 1, "tipo": 1})}
+    for habit_id, indice in list(pendientes.items()):
+        if habit_id not in habitos:
+            resultados[indice]['error'] = "Hábito no encontrado"
+            del pendientes[habit_id]
+
+    if pendientes:
+        # Devuelve los estados previos de hoy, para actualizar el resumen diario
+        anteriores, fallidos = guardar_registros(usuario_id, hoy, {
+            habit_id: (items[indice]['status'], items[indice].get('nota', ''))
+            for habit_id, indice in pendientes.items()})
+
+        rachas = actualizar_rachas(usuario_id, hoy, {
+            habit_id: items[indice]['status'] for habit_id, indice in pendientes.items()
+            if habit_id not in fallidos})
+        incrementos = {}
+        for habit_id in pendientes:
+            resultado = resultados[pendientes[habit_id]]
+            if habit_id in fallidos:
+                app.logger.error(f"Error al registrar hábito {habit_id}: {fallidos[habit_id]}")
+                resultado['error'] = "Error al guardar"
+                continue
+            resultado['ok'] = True
+            resultado['racha'] = rachas.get(habit_id)
+            cambio = _incrementos_resumen(
+                habitos[habit_id], anteriores.get(habit_id), items[pendientes[habit_id]]['status'])
+            for campo, valor in cambio.items():
+                incrementos[campo] = incrementos.get(campo, 0) + valor
+        actualizar_resumen_diario(
+            usuario_id, hoy, {k: v for k, v in incrementos.items() if v})
+        if any(r['ok'] for r in resultados):
+            registrar_actividad(user)
+        invalidar_respuestas_grupo(user.get('grupo_id'))
+
+    guardados = sum(1 for r in resultados if r['ok'])
+    return jsonify({
+        "message": f"{guardados} de {len(resultados)} registros actualizados",
+        "resultados": resultados
+    }), 200
 
 
 @app.route('/api/toggle-habito', methods=['POST'])
 def api_toggle_habito():
-    user = get_current_user()
+    user = usuario_sesion()
     if not user:
         return jsonify({"error": "Acceso denegado"}), 403
 
@@ -1475,12 +3948,15 @@ def api_toggle_habito():
         nuevo_estado = not habit.get('activo', True)
         mongo.db.habitos.update_one({"_id": ObjectId(habit_id)}, {
                                     "$set": {"activo": nuevo_estado}})
+        invalidar_catalogo()
 
     elif habit.get('tipo') == 'personal' and habit.get('usuario_id') == str(user['_id']):
         # Toggle para hábito personal del usuario
         nuevo_estado = not habit.get('activo', True)
         mongo.db.habitos.update_one({"_id": ObjectId(habit_id)}, {
                                     "$set": {"activo": nuevo_estado}})
+        invalidar_catalogo(user['_id'])
+        invalidar_respuestas_grupo(user.get('grupo_id'))
     else:
         return jsonify({"error": "Permiso denegado para modificar este hábito."}), 403
 
@@ -1489,7 +3965,7 @@ def api_toggle_habito():
 
 @app.route('/api/add-personal', methods=['POST'])
 def api_add_personal():
-    user = get_current_user()
+    user = usuario_sesion()
     if not user or user['rol'] != 'estudiante':
         return jsonify({"error": "Acceso denegado"}), 403
 
@@ -1516,6 +3992,8 @@ def api_add_personal():
         "activo": True
     }
     result = mongo.db.habitos.insert_one(nuevo_habito)
+    invalidar_catalogo(user['_id'])
+    invalidar_respuestas_grupo(user.get('grupo_id'))
 
     return jsonify({"message": "Hábito personal creado", "id": str(result.inserted_id)}), 201
 
@@ -1536,7 +4014,7 @@ def inject_user():
 # Hacer que el usuario actual esté disponible en todas las plantillas
 @app.before_request
 def load_logged_in_user():
-    g.current_user = get_current_user()
+    g.current_user = usuario_sesion()
 
 
 @app.before_request
@@ -1545,6 +4023,10 @@ def initialize_app():
     if not _initialized:
         # --- Llamada a la función de inicialización ---
         create_initial_data()
+        if app.config['CREAR_INDICES_AL_INICIAR']:
+            crear_indices()
+        if app.config['REPORTES_EN_PROCESO']:
+            iniciar_programador_reportes()
         _initialized = True
 
 
@@ -1585,10 +4067,14 @@ def create_initial_data():
             "categoria": "Bienestar", "activo": True, "tipo": "base"},
     ]
 
+    nuevos = 0
     for habito in habitos_base:
         existing = mongo.db.habitos.find_one({"clave": habito["clave"]})
         if not existing:
             mongo.db.habitos.insert_one(habito)
+            nuevos += 1
+    if nuevos:
+        invalidar_catalogo()
 
     # Crear usuario administrador por defecto (si no existe)
     admin_email = "admin@tecnm.mx"
@@ -1596,14 +4082,202 @@ def create_initial_data():
     if not existing_admin:
         admin_data = {
             "nombre_completo": "Administrador del Sistema",
+            "nombre_normalizado": normalizar_nombre("Administrador del Sistema"),
             "email": admin_email,
-            # Cambia esta contraseña por defecto
-            "password": generate_password_hash("Admin123"),
+            # Cambia esta contraseña por defecto. Se calcula aquí mismo: es una
+            # sola vez al iniciar y no debe fallar si la cola de hashes está llena
+            "password": passwords.hash_password("Admin123"),
             "rol": "administrador"
         }
         mongo.db.usuarios.insert_one(admin_data)
         print("Usuario administrador creado por defecto. Email: admin@tecnm.mx, Contraseña: Admin123")
 
 
+# --- Índices ---
+
+# Declaración de los índices que necesita cada colección.
+# Cada entrada es (llaves, opciones) tal como las recibe `create_index`.
+INDICES = {
+    "usuarios": [
+        ([("email", ASCENDING)], {"name": "email_unico", "unique": True}),
+        ([("numero_control", ASCENDING)], {
+            "name": "numero_control_unico",
+            "unique": True,
+            "partialFilterExpression": {"numero_control": {"$type": "string"}},
+        }),
+        ([("rol", ASCENDING), ("nombre_completo", ASCENDING)],
+         {"name": "rol_nombre"}),
+        # Listados paginados: orden (nombre_normalizado, _id), búsqueda por
+        # prefijo de nombre y un índice por cada filtro de estudiantes
+        ([("rol", ASCENDING), ("nombre_normalizado", ASCENDING), ("_id", ASCENDING)],
+         {"name": "rol_nombre_normalizado"}),
+        ([("rol", ASCENDING), ("carrera", ASCENDING),
+          ("nombre_normalizado", ASCENDING), ("_id", ASCENDING)],
+         {"name": "rol_carrera_nombre"}),
+        ([("rol", ASCENDING), ("semestre", ASCENDING),
+          ("nombre_normalizado", ASCENDING), ("_id", ASCENDING)],
+         {"name": "rol_semestre_nombre"}),
+        ([("rol", ASCENDING), ("generacion", ASCENDING),
+          ("nombre_normalizado", ASCENDING), ("_id", ASCENDING)],
+         {"name": "rol_generacion_nombre"}),
+        # Membresía: estudiantes de un grupo y estudiantes sin grupo (grupo_id nulo)
+        ([("grupo_id", ASCENDING), ("rol", ASCENDING)], {"name": "grupo_rol"}),
+        # Estudiantes sin grupo, paginados en el orden de los listados
+        ([("rol", ASCENDING), ("grupo_id", ASCENDING),
+          ("nombre_normalizado", ASCENDING), ("_id", ASCENDING)],
+         {"name": "rol_grupo_nombre"}),
+        # Estudiantes inactivos de un grupo: rango sobre ultima_actividad
+        ([("grupo_id", ASCENDING), ("ultima_actividad", ASCENDING), ("_id", ASCENDING)],
+         {"name": "grupo_ultima_actividad"}),
+        # Estudiantes con cumplimiento bajo de un grupo: rango sobre cumplimiento
+        ([("grupo_id", ASCENDING), ("cumplimiento", ASCENDING), ("_id", ASCENDING)],
+         {"name": "grupo_cumplimiento"}),
+    ],
+    "grupos": [
+        ([("tutor_id", ASCENDING)], {"name": "tutor"}),
+        ([("nombre", ASCENDING)], {"name": "nombre"}),
+    ],
+    "habitos": [
+        ([("tipo", ASCENDING), ("activo", ASCENDING)], {"name": "tipo_activo"}),
+        ([("usuario_id", ASCENDING), ("tipo", ASCENDING), ("activo", ASCENDING)],
+         {"name": "usuario_tipo_activo"}),
+        ([("clave", ASCENDING)], {"name": "clave"}),
+    ],
+    "registros_habitos": [
+        # Llave del upsert de api_registrar: un registro por usuario, hábito y día
+        ([("usuario_id", ASCENDING), ("habito_id", ASCENDING), ("fecha", ASCENDING)],
+         {"name": "usuario_habito_fecha_unico", "unique": True}),
+        # Rangos de fechas por estudiante (dashboard, calendario, estadísticas)
+        ([("usuario_id", ASCENDING), ("fecha", DESCENDING)],
+         {"name": "usuario_fecha"}),
+    ],
+    "resumen_diario": [
+        ([("usuario_id", ASCENDING), ("fecha", DESCENDING)],
+         {"name": "usuario_fecha_unico", "unique": True}),
+    ],
+    "sesiones_cambios": [
+        # Se borran solos tras AUTH_CAMBIOS_RETENCION segundos
+        ([("fecha", ASCENDING)], {"name": "fecha_ttl",
+                                   "expireAfterSeconds": Config.AUTH_CAMBIOS_RETENCION}),
+    ],
+    "rachas": [
+        ([("usuario_id", ASCENDING), ("habito_id", ASCENDING)],
+         {"name": "usuario_habito_unico", "unique": True}),
+    ],
+    "registros_mensuales": [
+        # Almacenamiento mensual: meses de un estudiante, del más reciente al más antiguo
+        ([("usuario_id", ASCENDING), ("mes", DESCENDING)], {"name": "usuario_mes"}),
+    ],
+}
+
+
+def crear_indices():
+    """Crea los índices declarados en INDICES.
+
+    `create_index` es idempotente: si el índice ya existe con la misma
+    definición no hace nada. Devuelve una lista de (colección, índice, error)
+    con los índices que no se pudieron crear (p. ej. duplicados en un único).
+    """
+    fallidos = []
+    for coleccion, indices in INDICES.items():
+        for llaves, opciones in indices:
+            try:
+                mongo.db[coleccion].create_index(llaves, **opciones)
+            except OperationFailure as e:
+                app.logger.error(
+                    f"No se pudo crear el índice {coleccion}.{opciones['name']}: {e}")
+                fallidos.append((coleccion, opciones['name'], str(e)))
+    return fallidos
+
+
+def _consultas_representativas():
+    """Consultas que emiten las rutas, para verificar su plan con explain()."""
+    hoy = date.today()
+    uid = "000000000000000000000000"
+    return [
+        ("login", "usuarios", {"email": "admin@tecnm.mx"}, None),
+        ("tutores", "usuarios", {"rol": "tutor"}, None),
+        ("página de estudiantes", "usuarios", {"rol": "estudiante", "carrera": "X"},
+         [("nombre_normalizado", ASCENDING), ("_id", ASCENDING)]),
+        ("búsqueda de estudiantes", "usuarios",
+         {"rol": "estudiante", "nombre_normalizado": {"$regex": "^x"}}, None),
+        ("numero_control", "usuarios",
+         {"numero_control": "X", "rol": "estudiante"}, None),
+        ("grupos del tutor", "grupos", {"tutor_id": uid}, None),
+        ("estudiantes del grupo", "usuarios", {"grupo_id": uid}, None),
+        ("estudiantes sin grupo", "usuarios", {"rol": "estudiante", "grupo_id": None}, None),
+        ("hábitos base", "habitos", {"activo": True, "tipo": "base"}, None),
+        ("hábitos personales", "habitos",
+         {"usuario_id": uid, "tipo": "personal", "activo": True}, None),
+        ("registros de hoy", "registros_habitos",
+         {"usuario_id": uid, "fecha": hoy.isoformat()}, None),
+        ("registros del mes", "registros_habitos",
+         {"usuario_id": uid, "fecha": {"$gte": (hoy - timedelta(days=30)).isoformat()}},
+         [("fecha", ASCENDING)]),
+        ("registros de varios estudiantes", "registros_habitos",
+         {"usuario_id": {"$in": [uid]},
+          "fecha": {"$gte": (hoy - timedelta(days=7)).isoformat()}}, None),
+        ("upsert de registro", "registros_habitos",
+         {"usuario_id": uid, "habito_id": uid, "fecha": hoy.isoformat()}, None),
+        ("registros mensuales", "registros_mensuales",
+         {"usuario_id": uid, "mes": {"$gte": (hoy - timedelta(days=30)).isoformat()[:7]}},
+         [("usuario_id", ASCENDING), ("mes", DESCENDING)]),
+    ]
+
+
+def _etapas_del_plan(plan):
+    """Recorre un plan de explain() y devuelve los nombres de todas sus etapas."""
+    etapas = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            etapas.append(plan['stage'])
+        for valor in plan.values():
+            etapas.extend(_etapas_del_plan(valor))
+    elif isinstance(plan, list):
+        for valor in plan:
+            etapas.extend(_etapas_del_plan(valor))
+    return etapas
+
+
+def verificar_indices():
+    """Ejecuta explain() sobre las consultas representativas.
+
+    Devuelve una lista de dicts {consulta, coleccion, etapas, collscan}.
+    """
+    reporte = []
+    for nombre, coleccion, filtro, orden in _consultas_representativas():
+        cursor = mongo.db[coleccion].find(filtro)
+        if orden:
+            cursor = cursor.sort(orden)
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        etapas = _etapas_del_plan(plan)
+        reporte.append({
+            'consulta': nombre,
+            'coleccion': coleccion,
+            'etapas': etapas,
+            'collscan': 'COLLSCAN' in etapas
+        })
+    return reporte
+
+
+@app.cli.command('crear-indices')
+def crear_indices_command():
+    """Crea (de forma idempotente) los índices de todas las colecciones."""
+    fallidos = crear_indices()
+    for coleccion, nombre, error in fallidos:
+        click.echo(f"ERROR {coleccion}.{nombre}: {error}")
+    if not fallidos:
+        click.echo("Índices creados/verificados correctamente.")
+
+
+@app.cli.command('verificar-indices')
+def verificar_indices_command():
+    """Reporta qué consultas de las rutas todavía hacen COLLSCAN."""
+    for fila in verificar_indices():
+        marca = 'COLLSCAN' if fila['collscan'] else 'ok'
+        click.echo(
+            f"[{marca:8}] {fila['coleccion']}: {fila['consulta']} ({' > '.join(fila['etapas'])})")
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,9 @@
+# benchmarks/__init__.py
+"""Herramientas para medir el rendimiento de EduTrack."""
+
+
+def percentil(valores, p):
+    """Percentil `p` (0-100) de una lista de valores, por el rango más cercano."""
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
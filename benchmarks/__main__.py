@@ -0,0 +1,5 @@
+# benchmarks/__main__.py
+"""`python -m benchmarks` ejecuta el benchmark de rutas (ver benchmarks.rutas)."""
+from benchmarks.rutas import main
+
+main()
@@ -0,0 +1,122 @@
+# benchmarks/datos.py
+"""Generador de datos sintéticos para los benchmarks.
+
+Crea tutores, grupos, estudiantes y varios días de registros_habitos con el
+catálogo base de `create_initial_data`, y después reconstruye resumen_diario y las rachas.
+Con ALMACEN_REGISTROS=mensual los registros se compactan a registros_mensuales.
+Los datos son deterministas para una misma semilla, así que dos corridas con
+los mismos parámetros comparan lo mismo.
+"""
+import random
+from datetime import date, timedelta
+
+import passwords
+
+CARRERAS = ['Ingeniería en Sistemas Computacionales', 'Ingeniería Industrial',
+            'Ingeniería Civil', 'Ingeniería en Gestión Empresarial', 'Arquitectura']
+NOMBRES = ['Ana', 'Luis', 'María', 'José', 'Sofía', 'Diego', 'Valeria', 'Jorge',
+           'Camila', 'Andrés', 'Fernanda', 'Ricardo', 'Paola', 'Emilio', 'Lucía']
+APELLIDOS = ['García', 'Hernández', 'López', 'Martínez', 'González', 'Pérez',
+             'Rodríguez', 'Sánchez', 'Ramírez', 'Cruz', 'Flores', 'Gómez']
+PASSWORD = 'Benchmark123'
+
+
+def _nombre(rng):
+    return f"{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)}"
+
+
+def poblar(A, tutores=3, grupos_por_tutor=2, estudiantes_por_grupo=25, dias=30,
+           estudiantes_sin_grupo=10, proporcion_registro=0.7, semilla=0, lote=5000):
+    """Llena la base de datos de la aplicación `A` (el módulo app).
+
+    La base debe estar vacía. Devuelve un dict con los _id (como cadena) de
+    'admin', 'tutores', 'grupos', 'estudiantes' y 'habitos' para armar las
+    rutas del benchmark.
+    """
+    db = A.mongo.db
+    rng = random.Random(semilla)
+    with A.app.test_request_context():
+        A.create_initial_data()  # Catálogo base y administrador
+        habitos = A.obtener_habitos_base()
+    # Un solo hash para todos: el costo de pbkdf2 no es lo que se mide aquí
+    pwhash = passwords.hash_password(PASSWORD)
+
+    ids_tutores = []
+    for i in range(tutores):
+        nombre = _nombre(rng)
+        ids_tutores.append(str(db.usuarios.insert_one({
+            "nombre_completo": nombre,
+            "nombre_normalizado": A.normalizar_nombre(nombre),
+            "email": f"tutor{i}@bench.tecnm.mx",
+            "password": pwhash,
+            "rol": "tutor",
+            "rfc": f"RFC{i:010d}",
+            "area_adscripcion": "Ciencias Básicas",
+            "acreditacion": i % 2 == 0
+        }).inserted_id))
+
+    ids_grupos = []
+    for i, tutor_id in enumerate(t for t in ids_tutores for _ in range(grupos_por_tutor)):
+        ids_grupos.append(str(db.grupos.insert_one({
+            "nombre": f"Grupo {i + 1:03d}",
+            "ciclo_escolar": "2024-A",
+            "tutor_id": tutor_id
+        }).inserted_id))
+
+    estudiantes = []
+    total = len(ids_grupos) * estudiantes_por_grupo + estudiantes_sin_grupo
+    for i in range(total):
+        nombre = _nombre(rng)
+        estudiante = {
+            "nombre_completo": nombre,
+            "nombre_normalizado": A.normalizar_nombre(nombre),
+            "email": f"est{i}@bench.tecnm.mx",
+            "password": pwhash,
+            "rol": "estudiante",
+            "numero_control": f"B{i:07d}",
+            "carrera": rng.choice(CARRERAS),
+            "semestre": str(rng.randint(1, 9)),
+            "generacion": str(rng.randint(2019, 2024))
+        }
+        if i < len(ids_grupos) * estudiantes_por_grupo:
+            estudiante["grupo_id"] = ids_grupos[i // estudiantes_por_grupo]
+        estudiantes.append(estudiante)
+    ids_estudiantes = [str(oid) for oid in db.usuarios.insert_many(estudiantes).inserted_ids]
+
+    # Registros de los últimos `dias` días (sin incluir hoy, que usan las rutas de escritura)
+    hoy = date.today()
+    estados = ['cumplido', 'cumplido', 'incumplido', 'no_aplica']
+    pendientes = []
+    for usuario_id in ids_estudiantes:
+        for d in range(1, dias + 1):
+            fecha = (hoy - timedelta(days=d)).isoformat()
+            for habito in habitos:
+                if rng.random() < proporcion_registro:
+                    pendientes.append({
+                        "usuario_id": usuario_id,
+                        "habito_id": str(habito['_id']),
+                        "fecha": fecha,
+                        "estado": rng.choice(estados),
+                        "nota": ""
+                    })
+            if len(pendientes) >= lote:
+                db.registros_habitos.insert_many(pendientes, ordered=False)
+                pendientes = []
+    if pendientes:
+        db.registros_habitos.insert_many(pendientes, ordered=False)
+
+    if A.almacen_mensual():
+        A.compactar_registros(borrar=True)
+    A.reconstruir_resumen_diario()
+    A.recalcular_rachas()
+    A.calcular_ultima_actividad()
+    with A.app.app_context():  # El catálogo de hábitos usa `g`
+        A.calcular_reportes()
+
+    return {
+        'admin': str(db.usuarios.find_one({"rol": "administrador"})['_id']),
+        'tutores': ids_tutores,
+        'grupos': ids_grupos,
+        'estudiantes': ids_estudiantes,
+        'habitos': [str(h['_id']) for h in habitos]
+    }
@@ -0,0 +1,103 @@
+# benchmarks/login.py
+"""Benchmark de throughput de inicio de sesión (verificación de contraseñas).
+
+Simula una ola de inicios de sesión simultáneos (p. ej. a las 8am) con un
+número fijo de "workers" web (hilos) y compara dos modos:
+
+- directo: cada worker calcula check_password_hash por su cuenta (antes).
+- servicio: los workers delegan en el pool acotado de `passwords` (después).
+
+Reporta throughput, latencias y la saturación de los workers: la fracción de
+su tiempo que pasan usando CPU en su propio hilo (`time.thread_time`). En modo
+directo el hash corre en el worker y esa fracción se acerca a 1; en modo
+servicio el worker solo espera al pool, sin CPU, y podría atender otras
+peticiones. También reporta los inicios de sesión rechazados con 503
+(`ServicioOcupado`) y, en modo servicio, la profundidad máxima de la cola.
+
+Uso:
+    python -m benchmarks.login --logins 200 --workers 8
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash
+
+import passwords
+from benchmarks import percentil
+
+
+def ejecutar(modo, logins, workers, pwhash, password):
+    """Ejecuta `logins` verificaciones repartidas en `workers` hilos."""
+    verificar = check_password_hash if modo == 'directo' else passwords.verificar_password
+    latencias = []
+    cpu_workers = [0.0]
+    rechazados = [0]
+    lock = threading.Lock()
+
+    def un_login(_):
+        inicio = time.perf_counter()
+        inicio_cpu = time.thread_time()
+        try:
+            assert verificar(pwhash, password)
+        except passwords.ServicioOcupado:
+            # La aplicación respondería 503
+            with lock:
+                rechazados[0] += 1
+            return
+        cpu = time.thread_time() - inicio_cpu
+        duracion = time.perf_counter() - inicio
+        with lock:
+            latencias.append(duracion)
+            cpu_workers[0] += cpu
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as ejecutor:
+        list(ejecutor.map(un_login, range(logins)))
+    total = time.perf_counter() - inicio
+    atendidos = len(latencias)
+
+    return {
+        'modo': modo,
+        'logins': logins,
+        'workers': workers,
+        'rechazados_503': rechazados[0],
+        'segundos': round(total, 3),
+        'logins_por_segundo': round(atendidos / total, 2),
+        'latencia_p50_ms': round(statistics.median(latencias) * 1000, 1) if atendidos else None,
+        'latencia_p95_ms': round(percentil(latencias, 95) * 1000, 1) if atendidos else None,
+        'latencia_p99_ms': round(percentil(latencias, 99) * 1000, 1) if atendidos else None,
+        'cpu_worker_por_login_ms': round(cpu_workers[0] / atendidos * 1000, 2) if atendidos else None,
+        # CPU de los hilos de los workers / tiempo disponible: 1.0 = todos
+        # calculando todo el tiempo; lo que falta para 1.0 queda libre
+        'saturacion_workers': round(cpu_workers[0] / (total * workers), 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Hilos que simulan los workers web.')
+    parser.add_argument('--salida', help='Guardar los resultados en este archivo JSON.')
+    args = parser.parse_args(argv)
+
+    password = 'Admin123'
+    pwhash = passwords.hash_password(password)
+    resultados = [ejecutar('directo', args.logins, args.workers, pwhash, password)]
+    passwords.obtener_pool()  # Arrancar el pool fuera de la medición
+    resultados.append(ejecutar('servicio', args.logins, args.workers, pwhash, password))
+    resultados[-1]['cola'] = passwords.metricas()
+
+    for fila in resultados:
+        print(json.dumps(fila, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
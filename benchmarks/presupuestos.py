@@ -0,0 +1,149 @@
+# benchmarks/presupuestos.py
+"""Presupuestos de consultas a Mongo por ruta.
+
+`PRESUPUESTOS` fija cuántos comandos puede enviar a Mongo cada ruta de
+`benchmarks.rutas`. El número de consultas de una vista no debe crecer con el
+número de filas que muestra; si una ruta pasa de su presupuesto, probablemente
+alguien metió una consulta dentro de un ciclo (un N+1).
+
+Se usa de dos formas:
+
+- Desde la línea de comandos, contra un Mongo real (en CI, por ejemplo):
+
+      python -m benchmarks.presupuestos --mongo-uri mongodb://localhost:27017/edutrack_presupuestos --limpiar
+
+  Genera datos pequeños, pide cada ruta con el detector de N+1 activo y
+  termina con código 1 si alguna ruta se pasa de su presupuesto o si el
+  detector encontró una forma de comando repetida.
+
+- Como plugin de pytest, que ofrece el fixture `presupuesto_consultas`.
+  `tests/conftest.py` lo registra, así que un simple `pytest` corre
+  `tests/test_presupuestos.py` (una prueba por ruta de `PRESUPUESTOS`):
+
+      def test_dashboard_tutor(clientes, presupuesto_consultas):
+          with presupuesto_consultas(PRESUPUESTOS['dashboard tutor']):
+              clientes['tutor'].get('/dashboard')
+
+  El plugin registra su monitor en `pytest_configure`, antes de que las
+  pruebas importen la aplicación.
+"""
+import argparse
+import logging
+import os
+import sys
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+from benchmarks.rutas import MonitorConsultas, agregar_argumentos, preparar, rutas_benchmark
+
+try:
+    import pytest
+except ImportError:  # pytest solo hace falta para el fixture
+    pytest = None
+
+# Máximo de comandos a Mongo por petición, con la caché de respuestas
+# desactivada y el catálogo de hábitos ya en caché
+PRESUPUESTOS = {
+    'dashboard estudiante': 4,
+    'calendario': 3,
+    'api calendario (año)': 3,
+    'api registrar': 6,
+    # Hábitos, registros (find y bulk_write), rachas (find y bulk_write) y
+    # resumen diario, sin importar el tamaño del lote
+    'api registrar lote': 6,
+    'perfil': 1,
+    'dashboard tutor': 4,
+    'estadísticas': 3,
+    'estadísticas de estudiante': 7,
+    'estudiantes inactivos': 2,
+    'estudiantes con cumplimiento bajo': 3,
+    'dashboard admin': 3,
+    'grupos': 2,
+    'estudiantes de un grupo': 3,
+    'estudiantes': 5,
+    'búsqueda de estudiantes': 5,
+    'tutores': 2,
+    'hábitos': 2,
+}
+
+monitor = MonitorConsultas()
+
+
+class ExcesoConsultas(AssertionError):
+    """Una ruta envió a Mongo más comandos de los que permite su presupuesto."""
+
+
+@contextmanager
+def limitar_consultas(maximo, descripcion='el bloque'):
+    """Falla si el código dentro del bloque envía más de `maximo` comandos a Mongo."""
+    monitor.reiniciar()
+    yield monitor
+    if monitor.consultas > maximo:
+        raise ExcesoConsultas(
+            f"{descripcion} envió {monitor.consultas} comandos a Mongo (presupuesto: {maximo})")
+
+
+def pytest_configure(config):
+    # Antes de que las pruebas importen la aplicación y creen su MongoClient
+    monitoring.register(monitor)
+
+
+if pytest is not None:
+    @pytest.fixture
+    def presupuesto_consultas():
+        """Context manager que limita las consultas a Mongo de un bloque."""
+        return limitar_consultas
+
+
+class _AvisosNMas1(logging.Handler):
+    """Guarda los avisos de N+1 que la aplicación escribe en su logger."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.avisos = []
+
+    def emit(self, record):
+        mensaje = record.getMessage()
+        if mensaje.startswith('Posible N+1'):
+            self.avisos.append(mensaje)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verifica los presupuestos de consultas por ruta.')
+    agregar_argumentos(parser)
+    parser.set_defaults(estudiantes_por_grupo=10, dias=7)
+    args = parser.parse_args(argv)
+
+    os.environ['DETECTAR_N_MAS_1'] = '1'
+    A, ids, clientes = preparar(args, parser, monitor)
+    avisos = _AvisosNMas1()
+    A.app.logger.addHandler(avisos)
+
+    fallas = []
+    for rol, nombre, metodo, url, cuerpo in rutas_benchmark(ids):
+        cliente = clientes[rol]
+
+        def pedir():
+            return cliente.post(url, json=cuerpo) if metodo == 'POST' else cliente.get(url)
+
+        pedir()  # Calentar las cachés de catálogo y usuario
+        avisos.avisos.clear()
+        maximo = PRESUPUESTOS.get(nombre)
+        try:
+            with limitar_consultas(maximo if maximo is not None else sys.maxsize, nombre):
+                respuesta = pedir()
+        except ExcesoConsultas as e:
+            fallas.append(str(e))
+        else:
+            print(f"{nombre}: {monitor.consultas} comandos (presupuesto: {maximo}), "
+                  f"HTTP {respuesta.status_code}")
+        fallas.extend(f"{nombre}: {aviso}" for aviso in avisos.avisos)
+
+    for falla in fallas:
+        print(f"FALLA {falla}", file=sys.stderr)
+    return 1 if fallas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+# benchmarks/rutas.py
+"""Benchmark de latencia por ruta con datos sintéticos.
+
+Llena una base de datos con `benchmarks.datos`, recorre las rutas de cada rol
+con el cliente de pruebas de Flask y reporta por ruta:
+- latencia p50, p95 y p99;
+- consultas a Mongo por petición;
+- bytes de comandos enviados y de respuestas recibidas de Mongo;
+- bytes de la respuesta HTTP.
+
+Las consultas se cuentan con un CommandListener de PyMongo, así que en
+modo mongomock quedan en cero. mongomock tampoco implementa todo lo que usa la
+aplicación (los $lookup con let/pipeline, por ejemplo), así que esas rutas
+responden 500; sirve para probar el benchmark, no para medir. Las cifras que
+valen son las de un Mongo real.
+
+Dependencias adicionales (mongomock, openpyxl): pip install -r requirements-dev.txt
+
+Uso:
+    python -m benchmarks.rutas --mongo-uri mongodb://localhost:27017/edutrack_bench --salida r.json
+    python -m benchmarks.rutas --mongomock --estudiantes-por-grupo 10
+    python -m benchmarks.rutas --mongo-uri ... --comparar base.json
+"""
+import argparse
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import bson
+from pymongo import monitoring
+
+from benchmarks import percentil
+from benchmarks.datos import poblar
+
+
+class MonitorConsultas(monitoring.CommandListener):
+    """Cuenta comandos y bytes intercambiados con Mongo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self._lock:
+            self.consultas = 0
+            self.bytes_enviados = 0
+            self.bytes_recibidos = 0
+
+    def started(self, event):
+        with self._lock:
+            self.consultas += 1
+            self.bytes_enviados += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        with self._lock:
+            self.bytes_recibidos += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+
+def rutas_benchmark(ids):
+    """Lista de (rol, nombre, método, url, json) a medir."""
+    hoy = date.today()
+    estudiante = ids['estudiantes'][0]
+    grupo = ids['grupos'][0]
+    habito = ids['habitos'][0]
+    return [
+        ('estudiante', 'dashboard estudiante', 'GET', '/dashboard', None),
+        ('estudiante', 'calendario', 'GET', '/calendar', None),
+        ('estudiante', 'api calendario (año)', 'GET',
+         f'/api/calendar?from={(hoy - timedelta(days=365)).isoformat()}&to={hoy.isoformat()}', None),
+        ('estudiante', 'api registrar', 'POST', '/api/registrar',
+         {'habit_id': habito, 'status': 'cumplido'}),
+        ('estudiante', 'api registrar lote', 'POST', '/api/registrar-lote',
+         {'registros': [{'habit_id': h, 'status': 'cumplido'} for h in ids['habitos']]}),
+        ('estudiante', 'perfil', 'GET', '/profile', None),
+        ('tutor', 'dashboard tutor', 'GET', '/dashboard', None),
+        ('tutor', 'estadísticas', 'GET', '/stats', None),
+        ('tutor', 'estadísticas de estudiante', 'GET', f'/stats/user/{estudiante}', None),
+        ('tutor', 'estudiantes inactivos', 'GET', '/tutor/en-riesgo?criterio=inactividad', None),
+        ('tutor', 'estudiantes con cumplimiento bajo', 'GET',
+         '/tutor/en-riesgo?criterio=cumplimiento', None),
+        ('administrador', 'dashboard admin', 'GET', '/dashboard', None),
+        ('administrador', 'grupos', 'GET', '/admin/grupos', None),
+        ('administrador', 'estudiantes de un grupo', 'GET',
+         f'/admin/grupos/gestionar_estudiantes/{grupo}', None),
+        ('administrador', 'estudiantes', 'GET', '/admin/estudiantes', None),
+        ('administrador', 'búsqueda de estudiantes', 'GET', '/admin/estudiantes?q=ma', None),
+        ('administrador', 'tutores', 'GET', '/admin/tutores', None),
+        ('administrador', 'hábitos', 'GET', '/admin/habitos', None),
+    ]
+
+
+def medir_ruta(cliente, monitor, metodo, url, cuerpo, repeticiones):
+    """Ejecuta la ruta `repeticiones` veces (más una de calentamiento)."""
+    def pedir():
+        if metodo == 'POST':
+            return cliente.post(url, json=cuerpo)
+        return cliente.get(url)
+
+    pedir()
+    latencias, consultas, enviados, recibidos, tamanos, estados = [], [], [], [], [], {}
+    for _ in range(repeticiones):
+        monitor.reiniciar()
+        inicio = time.perf_counter()
+        respuesta = pedir()
+        latencias.append(time.perf_counter() - inicio)
+        consultas.append(monitor.consultas)
+        enviados.append(monitor.bytes_enviados)
+        recibidos.append(monitor.bytes_recibidos)
+        tamanos.append(len(respuesta.get_data()))
+        estados[respuesta.status_code] = estados.get(respuesta.status_code, 0) + 1
+
+    return {
+        'peticiones': repeticiones,
+        'estados': {str(k): v for k, v in estados.items()},
+        'latencia_p50_ms': round(statistics.median(latencias) * 1000, 2),
+        'latencia_p95_ms': round(percentil(latencias, 95) * 1000, 2),
+        'latencia_p99_ms': round(percentil(latencias, 99) * 1000, 2),
+        'consultas': round(statistics.mean(consultas), 2),
+        'bytes_mongo_enviados': round(statistics.mean(enviados)),
+        'bytes_mongo_recibidos': round(statistics.mean(recibidos)),
+        'bytes_respuesta': round(statistics.mean(tamanos)),
+    }
+
+
+def _commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(actual, base):
+    """Imprime la diferencia de p50, p95 y consultas contra un resultado anterior."""
+    anteriores = {r['ruta']: r for r in base['rutas']}
+    for fila in actual['rutas']:
+        previa = anteriores.get(fila['ruta'])
+        if not previa:
+            continue
+        cambios = []
+        for campo in ('latencia_p50_ms', 'latencia_p95_ms', 'consultas'):
+            antes, ahora = previa[campo], fila[campo]
+            delta = f"{(ahora - antes) / antes * 100:+.0f}%" if antes else 'n/a'
+            cambios.append(f"{campo}: {antes} -> {ahora} ({delta})")
+        print(f"{fila['ruta']}: " + '; '.join(cambios))
+
+
+def agregar_argumentos(parser):
+    """Opciones comunes para elegir la base de datos y el tamaño de los datos."""
+    destino = parser.add_mutually_exclusive_group(required=True)
+    destino.add_argument('--mongo-uri', help='Base de datos vacía donde generar los datos.')
+    destino.add_argument('--mongomock', action='store_true',
+                         help='Usar mongomock en memoria (solo para probar el benchmark).')
+    parser.add_argument('--limpiar', action='store_true',
+                        help='Borrar la base de datos de --mongo-uri antes de generar los datos.')
+    parser.add_argument('--tutores', type=int, default=3)
+    parser.add_argument('--grupos-por-tutor', type=int, default=2)
+    parser.add_argument('--estudiantes-por-grupo', type=int, default=25)
+    parser.add_argument('--dias', type=int, default=30)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--con-cache', action='store_true',
+                        help='Medir con la caché de respuestas activa (por omisión se desactiva).')
+
+
+def _conectar_mongomock(A):
+    """Conecta la aplicación a una base de mongomock en memoria.
+
+    PyMongo 4.9+ pasa `sort` a las operaciones de bulk_write (ReplaceOne,
+    UpdateOne) y mongomock todavía no lo acepta. La aplicación nunca lo usa,
+    así que se descarta cuando viene vacío.
+    """
+    import mongomock
+    from mongomock.collection import BulkOperationBuilder
+
+    def sin_sort(metodo):
+        def envoltura(self, *args, sort=None, **kwargs):
+            if sort is not None:
+                raise NotImplementedError('mongomock no soporta sort en bulk_write')
+            return metodo(self, *args, **kwargs)
+        return envoltura
+
+    for nombre in ('add_replace', 'add_update'):
+        metodo = getattr(BulkOperationBuilder, nombre)
+        if 'sort' not in inspect.signature(metodo).parameters:
+            setattr(BulkOperationBuilder, nombre, sin_sort(metodo))
+    A.mongo.db = mongomock.MongoClient()['edutrack_benchmark']
+
+
+def preparar(args, parser, monitor):
+    """Importa la aplicación, genera los datos y devuelve (app, ids, clientes por rol).
+
+    `monitor` se registra antes de importar la aplicación para que el cliente
+    de Mongo lo incluya.
+    """
+    # La configuración se lee al importar la aplicación
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+    if not args.con_cache:
+        os.environ['CACHE_RESPUESTAS'] = 'desactivada'
+    monitoring.register(monitor)
+    import app as A
+
+    if args.mongomock:
+        _conectar_mongomock(A)
+    elif args.limpiar:
+        A.mongo.cx.drop_database(A.mongo.db.name)
+    if A.mongo.db.usuarios.estimated_document_count():
+        parser.error('La base de datos no está vacía; use otra o agregue --limpiar.')
+
+    inicio = time.perf_counter()
+    ids = poblar(
+        A, tutores=args.tutores, grupos_por_tutor=args.grupos_por_tutor,
+        estudiantes_por_grupo=args.estudiantes_por_grupo, dias=args.dias, semilla=args.semilla)
+    A.crear_indices()
+    print(f"Datos generados en {time.perf_counter() - inicio:.1f} s: "
+          f"{len(ids['estudiantes'])} estudiantes, {A.mongo.db.registros_habitos.estimated_document_count()} registros")
+
+    return A, ids, clientes_por_rol(A, ids)
+
+
+def clientes_por_rol(A, ids):
+    """Un cliente de pruebas con sesión iniciada por rol (estudiante, tutor, administrador)."""
+    usuarios = {'estudiante': ids['estudiantes'][0], 'tutor': ids['tutores'][0],
+                'administrador': ids['admin']}
+    clientes = {}
+    for rol, user_id in usuarios.items():
+        clientes[rol] = A.app.test_client()
+        with clientes[rol].session_transaction() as sesion:
+            sesion['user_id'] = user_id
+    return clientes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    agregar_argumentos(parser)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    parser.add_argument('--salida', help='Guardar los resultados en este archivo JSON.')
+    parser.add_argument('--comparar', help='Archivo JSON de una corrida anterior.')
+    args = parser.parse_args(argv)
+
+    monitor = MonitorConsultas()
+    A, ids, clientes = preparar(args, parser, monitor)
+
+    resultados = []
+    for rol, nombre, metodo, url, cuerpo in rutas_benchmark(ids):
+        fila = {'ruta': nombre, 'rol': rol, 'metodo': metodo, 'url': url}
+        fila.update(medir_ruta(clientes[rol], monitor, metodo, url, cuerpo, args.repeticiones))
+        resultados.append(fila)
+        print(json.dumps(fila, ensure_ascii=False))
+
+    reporte = {
+        'commit': _commit_actual(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'motor': 'mongomock' if args.mongomock else 'mongodb',
+        'parametros': {k: v for k, v in vars(args).items()
+                       if k not in ('mongo_uri', 'salida', 'comparar')},
+        'rutas': resultados
+    }
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, ensure_ascii=False, indent=2)
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(reporte, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# cache_respuestas.py
+"""Backends de la caché de respuestas de las vistas del tutor.
+
+Guardan las entradas (las respuestas ya generadas) con TTL y desalojo LRU.
+Los contadores de versión que deciden si una entrada sigue vigente no viven
+aquí sino en la colección versiones de Mongo (ver `cache_tutor` en app.py),
+así que una invalidación en un worker se ve en todos. Hay dos backends:
+- 'memoria': propio de cada proceso.
+- 'sqlite': un archivo local compartido por todos los workers de gunicorn de
+  la máquina.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheMemoria:
+    """Caché LRU con TTL dentro del proceso."""
+
+    def __init__(self, tamano):
+        self.tamano = tamano
+        self._entradas = OrderedDict()  # {clave: (expira_en, valor)}
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            if entrada[0] < time.monotonic():
+                del self._entradas[clave]
+                return None
+            self._entradas.move_to_end(clave)
+            return entrada[1]
+
+    def guardar(self, clave, valor, ttl):
+        with self._lock:
+            self._entradas[clave] = (time.monotonic() + ttl, valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.tamano:
+                self._entradas.popitem(last=False)
+
+
+class CacheSqlite:
+    """Caché LRU con TTL en un archivo SQLite compartido entre procesos.
+
+    Cada hilo de cada proceso abre su propia conexión la primera vez que la
+    usa (nunca al importar), así que con `gunicorn --preload` los workers no
+    comparten la conexión del proceso padre. El modo WAL permite leer
+    mientras otro proceso escribe.
+    """
+
+    def __init__(self, ruta, tamano):
+        self.ruta = ruta
+        self.tamano = tamano
+        self._local = threading.local()
+
+    def _conexion(self):
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.ruta)), exist_ok=True)
+            con = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("""CREATE TABLE IF NOT EXISTS entradas (
+                clave TEXT PRIMARY KEY, valor BLOB, expira REAL, usado REAL)""")
+            con.execute("CREATE INDEX IF NOT EXISTS entradas_usado ON entradas (usado)")
+            self._local.con, self._local.pid = con, os.getpid()
+        return con
+
+    def obtener(self, clave):
+        con = self._conexion()
+        fila = con.execute("SELECT valor, expira FROM entradas WHERE clave = ?",
+                           (clave,)).fetchone()
+        if fila is None:
+            return None
+        ahora = time.time()
+        if fila[1] < ahora:
+            con.execute("DELETE FROM entradas WHERE clave = ?", (clave,))
+            return None
+        con.execute("UPDATE entradas SET usado = ? WHERE clave = ?", (ahora, clave))
+        return pickle.loads(fila[0])
+
+    def guardar(self, clave, valor, ttl):
+        con = self._conexion()
+        ahora = time.time()
+        con.execute("INSERT OR REPLACE INTO entradas VALUES (?, ?, ?, ?)",
+                    (clave, pickle.dumps(valor), ahora + ttl, ahora))
+        # Desalojar las menos usadas si se pasó del tamaño
+        con.execute("""DELETE FROM entradas WHERE clave IN (
+            SELECT clave FROM entradas ORDER BY usado DESC LIMIT -1 OFFSET ?)""",
+                    (self.tamano,))
+
+
+def crear_backend(config):
+    """Crea el backend indicado en CACHE_RESPUESTAS, o None si está desactivada."""
+    tipo = config['CACHE_RESPUESTAS']
+    if tipo == 'memoria':
+        return CacheMemoria(config['CACHE_RESPUESTAS_TAMANO'])
+    if tipo == 'sqlite':
+        return CacheSqlite(config['CACHE_RESPUESTAS_RUTA'], config['CACHE_RESPUESTAS_TAMANO'])
+    return None
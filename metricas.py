@@ -0,0 +1,190 @@
+# metricas.py
+"""Instrumentación por petición y exposición en formato de texto de Prometheus.
+
+`MonitorMongo` es un CommandListener de PyMongo. Suma a la petición en curso
+(guardada en una ContextVar) los comandos enviados a Mongo, su duración y los
+documentos devueltos. Las consultas que `en_paralelo` lanza en otros hilos
+copian el contexto, así que también se cuentan.
+
+Con el detector de N+1 activo, también cuenta cuántas veces se repite cada
+"forma" de comando: el comando con sus valores reemplazados por su tipo. Una
+forma que se repite muchas veces en una petición suele ser una consulta
+dentro de un ciclo.
+
+Las métricas son por proceso; con varios workers de gunicorn, Prometheus debe
+raspar cada uno (o agregarlas con una etiqueta de instancia).
+"""
+import json
+import threading
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+# Estado de la petición en curso: dict con comandos, segundos_mongo,
+# documentos, segundos_render y formas (None fuera de una petición)
+peticion_actual = ContextVar('peticion_actual', default=None)
+_lock = threading.Lock()
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_CONTEO = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+BUCKETS_DOCUMENTOS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+# Campos de un comando que no cambian lo que hace (sesión, réplica, lotes...)
+_CAMPOS_SIN_FORMA = {'$db', 'lsid', '$clusterTime', 'txnNumber', '$readPreference',
+                     'readConcern', 'writeConcern', 'cursor', 'batchSize', 'ordered',
+                     'comment', 'apiVersion', 'apiStrict', 'apiDeprecationErrors'}
+# Comandos que se repiten legítimamente al leer un cursor grande
+_COMANDOS_SIN_FORMA = {'getMore', 'killCursors', 'endSessions'}
+
+
+def nueva_peticion(detectar_n_mas_1=False):
+    """Empieza a medir una petición y devuelve su estado."""
+    estado = {'comandos': 0, 'segundos_mongo': 0.0, 'documentos': 0,
+              'segundos_render': 0.0, 'formas': {} if detectar_n_mas_1 else None}
+    peticion_actual.set(estado)
+    return estado
+
+
+def _forma(valor):
+    if isinstance(valor, dict):
+        return {k: _forma(v) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [_forma(valor[0])] if valor else []
+    return type(valor).__name__
+
+
+def forma_comando(nombre, comando):
+    """Forma de un comando: su estructura con cada valor reemplazado por su tipo.
+
+    Dos find sobre la misma colección con el mismo filtro y distintos valores
+    (p. ej. un find_one por cada _id) tienen la misma forma.
+    """
+    cuerpo = {k: v for k, v in comando.items() if k not in _CAMPOS_SIN_FORMA and k != nombre}
+    return f"{nombre} {comando.get(nombre)} {json.dumps(_forma(cuerpo), sort_keys=True)}"
+
+
+def repetidos(estado, umbral):
+    """Formas que se repitieron más de `umbral` veces en la petición: [(forma, veces)]."""
+    if not estado or not estado.get('formas'):
+        return []
+    with _lock:
+        return sorted(((forma, veces) for forma, veces in estado['formas'].items()
+                       if veces > umbral), key=lambda par: -par[1])
+
+
+def _documentos(reply):
+    cursor = reply.get('cursor') if isinstance(reply, dict) else None
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    return 0
+
+
+class MonitorMongo(monitoring.CommandListener):
+    """Acumula en la petición actual los comandos de Mongo y su duración."""
+
+    def started(self, event):
+        estado = peticion_actual.get()
+        if estado is None or estado['formas'] is None \
+                or event.command_name in _COMANDOS_SIN_FORMA:
+            return
+        forma = forma_comando(event.command_name, event.command)
+        with _lock:
+            estado['formas'][forma] = estado['formas'].get(forma, 0) + 1
+
+    def succeeded(self, event):
+        self._sumar(event.duration_micros, _documentos(event.reply))
+
+    def failed(self, event):
+        self._sumar(event.duration_micros, 0)
+
+    def _sumar(self, micros, documentos):
+        estado = peticion_actual.get()
+        if estado is None:
+            return
+        with _lock:
+            estado['comandos'] += 1
+            estado['segundos_mongo'] += micros / 1e6
+            estado['documentos'] += documentos
+
+
+class Histograma:
+    """Histograma acumulativo con etiquetas, al estilo de Prometheus."""
+
+    def __init__(self, nombre, ayuda, buckets, etiquetas):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.buckets = buckets
+        self.etiquetas = etiquetas
+        self._series = {}  # {valores de etiquetas: [conteos por bucket, suma, total]}
+
+    def observar(self, valor, *valores_etiquetas):
+        with _lock:
+            serie = self._series.get(valores_etiquetas)
+            if serie is None:
+                serie = self._series[valores_etiquetas] = [[0] * len(self.buckets), 0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with _lock:
+            series = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        for valores, (conteos, suma, total) in series:
+            etiquetas = ','.join(f'{k}="{_escapar(v)}"' for k, v in zip(self.etiquetas, valores))
+            separador = ',' if etiquetas else ''
+            for limite, conteo in zip(self.buckets, conteos):
+                lineas.append(f'{self.nombre}_bucket{{{etiquetas}{separador}le="{limite}"}} {conteo}')
+            lineas.append(f'{self.nombre}_bucket{{{etiquetas}{separador}le="+Inf"}} {total}')
+            lineas.append(f'{self.nombre}_sum{{{etiquetas}}} {suma}')
+            lineas.append(f'{self.nombre}_count{{{etiquetas}}} {total}')
+        return lineas
+
+
+class Contador:
+    """Contador con etiquetas.
+
+    Si se pasa `leer`, los valores no se incrementan aquí: `leer()` devuelve
+    {valores de etiquetas: total} de un contador que lleva otro módulo.
+    """
+
+    def __init__(self, nombre, ayuda, etiquetas=(), leer=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.leer = leer
+        self._series = {}
+
+    def incrementar(self, *valores_etiquetas):
+        with _lock:
+            self._series[valores_etiquetas] = self._series.get(valores_etiquetas, 0) + 1
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        if self.leer is not None:
+            series = sorted(self.leer().items())
+        else:
+            with _lock:
+                series = sorted(self._series.items())
+        for valores, total in series:
+            etiquetas = ','.join(f'{k}="{_escapar(v)}"' for k, v in zip(self.etiquetas, valores))
+            lineas.append(f'{self.nombre}{{{etiquetas}}} {total}' if etiquetas
+                          else f'{self.nombre} {total}')
+        return lineas
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def gauges(prefijo, valores, ayuda):
+    """Líneas de texto para un dict {nombre: valor} expuesto como gauges."""
+    lineas = []
+    for nombre, valor in sorted(valores.items()):
+        lineas.append(f"# HELP {prefijo}_{nombre} {ayuda}")
+        lineas.append(f"# TYPE {prefijo}_{nombre} gauge")
+        lineas.append(f"{prefijo}_{nombre} {valor}")
+    return lineas
@@ -0,0 +1,116 @@
+# passwords.py
+"""Servicio de hash y verificación de contraseñas en un pool de procesos.
+
+El hash pbkdf2 es intencionalmente costoso en CPU. En lugar de calcularlo en
+el worker que atiende la petición, se envía a un pool de procesos acotado: la
+cola de trabajos tiene un máximo (PASSWORD_COLA_MAX) y, si se llena, la
+petición falla de inmediato con `ServicioOcupado` en vez de acumularse.
+
+Este módulo solo importa Werkzeug y la configuración para que los procesos
+hijos arranquen rápido y no hereden la conexión a Mongo de la aplicación.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from config import Config
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Cupos de la cola de trabajos pendientes o en ejecución
+_cupos = threading.BoundedSemaphore(Config.PASSWORD_COLA_MAX)
+_metricas_lock = threading.Lock()
+_metricas = {
+    'en_cola': 0,         # trabajos enviados que no han terminado
+    'max_en_cola': 0,     # mayor profundidad observada
+    'completados': 0,
+    'rechazados': 0,      # trabajos rechazados por cola llena
+    'segundos_total': 0.0  # tiempo acumulado de espera + cálculo
+}
+
+
+class ServicioOcupado(Exception):
+    """La cola de hashes está llena; el cliente debe reintentar más tarde."""
+
+
+def hash_password(password):
+    """Genera el hash de la contraseña con el método configurado."""
+    return generate_password_hash(
+        password,
+        method=Config.PASSWORD_HASH_METHOD,
+        salt_length=Config.PASSWORD_SALT_LENGTH
+    )
+
+
+def _verificar(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def obtener_pool():
+    """Devuelve el pool de procesos compartido, creándolo la primera vez."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=Config.PASSWORD_WORKERS or os.cpu_count(),
+                # 'spawn' evita copiar los hilos y sockets del proceso web
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+def _ejecutar(funcion, *args):
+    """Ejecuta `funcion` en el pool respetando el límite de la cola."""
+    if not _cupos.acquire(timeout=Config.PASSWORD_COLA_ESPERA):
+        with _metricas_lock:
+            _metricas['rechazados'] += 1
+        raise ServicioOcupado()
+    inicio = time.perf_counter()
+    with _metricas_lock:
+        _metricas['en_cola'] += 1
+        _metricas['max_en_cola'] = max(_metricas['max_en_cola'], _metricas['en_cola'])
+    try:
+        return obtener_pool().submit(funcion, *args).result()
+    finally:
+        _cupos.release()
+        with _metricas_lock:
+            _metricas['en_cola'] -= 1
+            _metricas['completados'] += 1
+            _metricas['segundos_total'] += time.perf_counter() - inicio
+
+
+def generar_hash(password):
+    """Genera el hash de una contraseña en el pool."""
+    return _ejecutar(hash_password, password)
+
+
+def verificar_password(pwhash, password):
+    """Verifica la contraseña contra su hash en el pool."""
+    return _ejecutar(_verificar, pwhash, password)
+
+
+def necesita_rehash(pwhash):
+    """Indica si el hash se generó con un método o costo distinto al configurado."""
+    return pwhash.split('$', 1)[0] != Config.PASSWORD_HASH_METHOD
+
+
+def hash_passwords(passwords):
+    """Genera los hashes de una lista de contraseñas en paralelo, conservando el orden.
+
+    Se usa en cargas masivas (un solo cliente), por lo que no pasa por la cola
+    acotada de las peticiones interactivas.
+    """
+    if not passwords:
+        return []
+    return list(obtener_pool().map(hash_password, passwords, chunksize=4))
+
+
+def metricas():
+    """Devuelve una copia de las métricas de la cola de hashes."""
+    with _metricas_lock:
+        return dict(_metricas)
@@ -0,0 +1,61 @@
+# tests/conftest.py
+"""Fixtures de las pruebas: una base de Mongo de pruebas con datos pequeños.
+
+Las pruebas cuentan los comandos con un CommandListener de PyMongo, que
+mongomock no emite, así que necesitan un Mongo real. Se usa
+MONGO_URI_PRUEBAS (por omisión mongodb://localhost:27017/edutrack_pruebas); la
+base se borra al empezar y al terminar. Si no hay servidor, las pruebas se
+omiten, salvo en CI (variable CI o EXIGIR_MONGO_PRUEBAS=1), donde fallan para
+que un servidor caído no deje pasar los presupuestos sin medirlos.
+"""
+import os
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from benchmarks.datos import poblar
+from benchmarks.rutas import clientes_por_rol
+
+MONGO_URI_PRUEBAS = os.getenv('MONGO_URI_PRUEBAS', 'mongodb://localhost:27017/edutrack_pruebas')
+EXIGIR_MONGO = bool(os.getenv('CI')) or os.getenv('EXIGIR_MONGO_PRUEBAS', '0') == '1'
+
+# La configuración se lee al importar la aplicación. Los presupuestos suponen
+# las cachés de usuario y de autenticación calientes durante cada prueba, y el
+# detector de N+1 activo para que las pruebas revisen sus avisos.
+os.environ['MONGO_URI'] = MONGO_URI_PRUEBAS
+os.environ['CACHE_RESPUESTAS'] = 'desactivada'
+os.environ['USER_CACHE_TTL'] = '300'
+os.environ['AUTH_VERSION_TTL'] = '300'
+os.environ['DETECTAR_N_MAS_1'] = '1'
+
+
+def pytest_configure(config):
+    # Registra el monitor de consultas antes de que se importe la aplicación
+    config.pluginmanager.import_plugin('benchmarks.presupuestos')
+
+
+@pytest.fixture(scope='session')
+def datos_pruebas():
+    """(módulo app, ids) con un tutor, dos grupos de 5 estudiantes y 7 días de registros."""
+    try:
+        MongoClient(MONGO_URI_PRUEBAS, serverSelectionTimeoutMS=2000).admin.command('ping')
+    except PyMongoError as e:
+        mensaje = f"No hay un Mongo de pruebas en {MONGO_URI_PRUEBAS}: {e}"
+        if EXIGIR_MONGO:
+            pytest.fail(mensaje, pytrace=False)
+        pytest.skip(mensaje)
+
+    import app as A
+    A.mongo.cx.drop_database(A.mongo.db.name)
+    ids = poblar(A, tutores=1, grupos_por_tutor=2, estudiantes_por_grupo=5, dias=7,
+                 estudiantes_sin_grupo=3)
+    A.crear_indices()
+    yield A, ids
+    A.mongo.cx.drop_database(A.mongo.db.name)
+
+
+@pytest.fixture(scope='session')
+def clientes(datos_pruebas):
+    """Clientes de pruebas con sesión de estudiante, tutor y administrador."""
+    return clientes_por_rol(*datos_pruebas)
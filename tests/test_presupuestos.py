@@ -0,0 +1,30 @@
+# tests/test_presupuestos.py
+"""Cada ruta medida por los benchmarks debe respetar su presupuesto de consultas."""
+import pytest
+
+from benchmarks.presupuestos import PRESUPUESTOS
+from benchmarks.rutas import rutas_benchmark
+
+
+@pytest.mark.parametrize('nombre', list(PRESUPUESTOS))
+def test_presupuesto_de_consultas(nombre, datos_pruebas, clientes, presupuesto_consultas, caplog):
+    _, ids = datos_pruebas
+    rol, _, metodo, url, cuerpo = next(r for r in rutas_benchmark(ids) if r[1] == nombre)
+    cliente = clientes[rol]
+
+    def pedir():
+        return cliente.post(url, json=cuerpo) if metodo == 'POST' else cliente.get(url)
+
+    pedir()  # Calentar las cachés de catálogo, usuario y sesión
+    caplog.clear()
+    with presupuesto_consultas(PRESUPUESTOS[nombre], nombre):
+        respuesta = pedir()
+    assert respuesta.status_code == 200
+    avisos = [r.getMessage() for r in caplog.records if r.getMessage().startswith('Posible N+1')]
+    assert not avisos
+
+
+def test_todas_las_rutas_tienen_presupuesto():
+    ids = {'estudiantes': ['e'], 'grupos': ['g'], 'habitos': ['h'], 'tutores': ['t'], 'admin': 'a'}
+    sin_presupuesto = [r[1] for r in rutas_benchmark(ids) if r[1] not in PRESUPUESTOS]
+    assert not sin_presupuesto